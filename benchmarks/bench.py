@@ -0,0 +1,305 @@
+"""Microbenchmarks of the hot paths of the auth module.
+
+Runs against local stand-ins only: the memory and sqlite storage backends and
+an SMTP sink on localhost. For every benchmark the number of operations per
+second, the number of objects left behind per operation (gc tracked objects,
+Python 2.7 has no allocation counters) and the number of SQL statements per
+operation are reported.
+
+    python bench.py                  # run all benchmarks, compare with baseline.json
+    python bench.py login            # only benchmarks containing 'login'
+    python bench.py --save-baseline  # store the results as new baseline
+
+A benchmark counts as regressed if it issues more statements per operation than
+the baseline or its throughput dropped by more than the tolerance. Throughput is
+compared relative to a reference workload run in the same process (plain
+interpreter work which does not touch this repository), so a baseline saved on
+another machine or under another load still applies. Save a new baseline in
+the commit which changes the measured code.
+"""
+import os
+import sys
+import gc
+import json
+import time
+import shutil
+import asyncore
+import smtpd
+import tempfile
+import threading
+import argparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import auth
+import crypto
+import validator
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+PASSWORD = 'benchmark-password'
+
+
+class SmtpSink(smtpd.SMTPServer):
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self._running = True
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        pass
+
+    def _serve(self):
+        while self._running:
+            asyncore.loop(timeout=0.01, count=1)
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+        self.close()
+
+
+class QueryCounter(object):
+    """Counts the statements a SQL backend sends to the database."""
+    def __init__(self, db_context):
+        self.count = 0
+        connection = db_context.db_connection
+        if connection is None:
+            return
+        prepare_query = connection._prepare_query
+
+        def counting_prepare_query(sql, params):
+            self.count += 1
+            return prepare_query(sql, params)
+        connection._prepare_query = counting_prepare_query
+
+
+class Environment(object):
+    def __init__(self, smtp_port):
+        self.smtp_port = smtp_port
+        self.directory = tempfile.mkdtemp()
+        self._handlers = []
+
+    def get_config(self, backend, **options):
+        config = auth.Config()
+        config.db_backend = backend
+        config.db_catalog = 'benchmark-{0}'.format(len(self._handlers))
+        config.db_path = os.path.join(self.directory, '{0}.db'.format(config.db_catalog))
+        config.db_schema_mode = 'migrate'
+        config.smtp_host = '127.0.0.1'
+        config.smtp_port = self.smtp_port
+        config.smtp_keep_alive = True
+        config.login_max_attempts = 10 ** 9
+        for name, value in options.items():
+            setattr(config, name, value)
+        return config
+
+    def get_auth_handler(self, backend, **options):
+        auth_handler = auth.AuthHandler(self.get_config(backend, **options))
+        self._handlers.append(auth_handler)
+        return auth_handler
+
+    def close(self):
+        for auth_handler in self._handlers:
+            auth_handler.shutdown()
+        shutil.rmtree(self.directory)
+
+
+class Benchmark(object):
+    """Times operation, a callable which gets the number of the iteration.
+
+    Subclasses which need a handler create it and set operation in setup().
+    """
+    iterations = 1000
+
+    def __init__(self, name, operation=None, iterations=None):
+        self.name = name
+        self.operation = operation
+        if iterations:
+            self.iterations = iterations
+        self.query_counter = None
+
+    def setup(self, environment, iterations):
+        pass
+
+    def measure(self, environment, scale):
+        iterations = max(int(self.iterations * scale), 1)
+        self.setup(environment, iterations)
+        operation = self.operation
+        queries_before = self.query_counter.count if self.query_counter else 0
+        gc.collect()
+        gc.disable()
+        try:
+            objects_before = len(gc.get_objects())
+            start = time.time()
+            for i in xrange(iterations):
+                operation(i)
+            elapsed = time.time() - start
+            objects_after = len(gc.get_objects())
+        finally:
+            gc.enable()
+        queries = (self.query_counter.count - queries_before) if self.query_counter else 0
+        return {
+            'elapsed_per_op': elapsed / iterations,
+            'ops_per_sec': round(iterations / max(elapsed, 1e-9), 1),
+            'objects_per_op': round(float(objects_after - objects_before) / iterations, 2),
+            'queries_per_op': round(float(queries) / iterations, 2)
+        }
+
+
+class LoginBenchmark(Benchmark):
+    iterations = 3000
+
+    def __init__(self, backend, single_query, password):
+        Benchmark.__init__(self, 'login_{0}_{1}_{2}'.format(
+            'success' if password == PASSWORD else 'wrong_password',
+            'single_query' if single_query else 'default',
+            backend
+        ))
+        self.backend = backend
+        self.single_query = single_query
+        self.password = password
+
+    def setup(self, environment, iterations):
+        auth_handler = environment.get_auth_handler(self.backend, login_single_query=self.single_query)
+        auth_handler.create_users([('login@bench.com', PASSWORD)], mail_mode=auth.ImportMailMode.SKIP)
+        self.query_counter = QueryCounter(auth_handler.db_context)
+        self.operation = lambda i: auth_handler.login('login@bench.com', self.password)
+
+
+class CreateUserBenchmark(Benchmark):
+    iterations = 500
+
+    def __init__(self, backend):
+        Benchmark.__init__(self, 'create_user_{0}'.format(backend))
+        self.backend = backend
+
+    def setup(self, environment, iterations):
+        auth_handler = environment.get_auth_handler(self.backend)
+        self.query_counter = QueryCounter(auth_handler.db_context)
+        self.operation = lambda i: auth_handler.create_user('user{0}@bench.com'.format(i), PASSWORD)
+
+
+class ActivateUserBenchmark(Benchmark):
+    iterations = 2000
+
+    def __init__(self, backend):
+        Benchmark.__init__(self, 'activate_user_{0}'.format(backend))
+        self.backend = backend
+
+    def setup(self, environment, iterations):
+        auth_handler = environment.get_auth_handler(self.backend)
+        records = [('user{0}@bench.com'.format(i), PASSWORD) for i in range(iterations)]
+        results = auth_handler.create_users(records, mail_mode=auth.ImportMailMode.DEFER)
+        activations = [(crypto.b64_encode(result.email), result.activation_token) for result in results]
+        self.query_counter = QueryCounter(auth_handler.db_context)
+        self.operation = lambda i: auth_handler.activate_user(*activations[i])
+
+
+# iterations of the benchmarks of single functions
+FUNCTION_ITERATIONS = 20000
+
+
+def _reference_workload(i):
+    total = 0
+    for j in xrange(200):
+        total += len(str(j * 7919))
+    return total
+
+
+REFERENCE = Benchmark('reference', _reference_workload, FUNCTION_ITERATIONS)
+
+
+def _render_template():
+    dispatcher = auth.TemplateMailDispatcher(auth.MailConfig(auth.Config()), auth.Config().mail_body * 10)
+    args = {"{ACTIVATION_TOKEN}": crypto.create_activation_token(), "{EMAIL_IDENTIFIER}": crypto.b64_encode('user@bench.com')}
+    mail_template = dispatcher.get_template()
+    return lambda i: mail_template.render(args)
+
+
+def get_benchmarks():
+    benchmarks = []
+    for backend in ('memory', 'sqlite'):
+        for single_query in (False, True):
+            benchmarks.append(LoginBenchmark(backend, single_query, PASSWORD))
+        benchmarks.append(LoginBenchmark(backend, False, 'wrong-password'))
+        benchmarks.append(CreateUserBenchmark(backend))
+        benchmarks.append(ActivateUserBenchmark(backend))
+    salt = crypto.create_salt()
+    benchmarks.append(Benchmark('crypto_create_hash', lambda i: crypto.create_hash(PASSWORD, salt), FUNCTION_ITERATIONS))
+    benchmarks.append(Benchmark('validator_is_valid_email', lambda i: validator.is_valid_email('first.last+tag@sub.domain.com'), FUNCTION_ITERATIONS))
+    benchmarks.append(Benchmark('mail_template_render', _render_template(), FUNCTION_ITERATIONS))
+    return benchmarks
+
+
+def compare(name, result, baseline, tolerance):
+    problems = []
+    if name not in baseline:
+        return problems
+    expected = baseline[name]
+    if result['queries_per_op'] > expected['queries_per_op']:
+        problems.append('queries/op {0} > {1}'.format(result['queries_per_op'], expected['queries_per_op']))
+    if 'relative_ops' in expected and result['relative_ops'] < expected['relative_ops'] * (1 - tolerance):
+        problems.append('relative ops {0} < {1}'.format(result['relative_ops'], expected['relative_ops']))
+    return problems
+
+
+def set_relative_ops(result, reference):
+    # operations per run of the reference workload, independent of the speed of the machine
+    result['relative_ops'] = round(reference['elapsed_per_op'] / max(result.pop('elapsed_per_op'), 1e-12), 4)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Microbenchmarks of the auth hot paths.')
+    parser.add_argument('filter', nargs='?', default='', help='only run benchmarks whose name contains this text')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results in baseline.json')
+    parser.add_argument('--tolerance', type=float, default=0.3, help='allowed throughput loss compared to the baseline (default: 0.3)')
+    parser.add_argument('--scale', type=float, default=1.0, help='factor for the number of iterations of every benchmark')
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.isfile(BASELINE_FILE) and not args.save_baseline:
+        with open(BASELINE_FILE) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    sink = SmtpSink()
+    environment = Environment(sink.port)
+    results = {}
+    regressions = 0
+    try:
+        reference = REFERENCE.measure(environment, args.scale)
+        print '{0:<45} {1:>12} {2:>12} {3:>12} {4:>12}'.format('benchmark', 'ops/sec', 'relative', 'objects/op', 'queries/op')
+        for benchmark in get_benchmarks():
+            if args.filter not in benchmark.name:
+                continue
+            result = results[benchmark.name] = benchmark.measure(environment, args.scale)
+            set_relative_ops(result, reference)
+            problems = compare(benchmark.name, result, baseline, args.tolerance)
+            regressions += len(problems)
+            print '{0:<45} {1:>12} {2:>12} {3:>12} {4:>12} {5}'.format(
+                benchmark.name,
+                result['ops_per_sec'],
+                result['relative_ops'],
+                result['objects_per_op'],
+                result['queries_per_op'],
+                'REGRESSION: ' + ', '.join(problems) if problems else ''
+            )
+    finally:
+        environment.close()
+        sink.stop()
+
+    if args.save_baseline:
+        # only the counts and relative_ops are compared, a filtered run keeps the other saved results
+        saved = {}
+        if os.path.isfile(BASELINE_FILE):
+            with open(BASELINE_FILE) as baseline_file:
+                saved = json.load(baseline_file)
+        saved.update(results)
+        with open(BASELINE_FILE, 'w') as baseline_file:
+            json.dump(saved, baseline_file, indent=4, sort_keys=True)
+        print 'Baseline saved to {0}'.format(BASELINE_FILE)
+    return 1 if regressions and not args.save_baseline else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,13 +4,15 @@ CREATE TABLE IF NOT EXISTS `login_attempts` (
   `id` INT NOT NULL AUTO_INCREMENT,
   `login` VARCHAR(100) COLLATE utf8_bin NOT NULL,
   `timestamp` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-  PRIMARY KEY (`id`)
+  PRIMARY KEY (`id`),
+  INDEX `IX_login_attempts_login_timestamp` (`login`, `timestamp`),
+  INDEX `IX_login_attempts_timestamp` (`timestamp`)
 ) DEFAULT CHARSET=utf8 COLLATE=utf8_bin;
 
 CREATE TABLE IF NOT EXISTS `users` (
   `id` INT NOT NULL AUTO_INCREMENT,
   `email` VARCHAR(100) COLLATE utf8_bin NOT NULL,
-  `password` CHAR(64) COLLATE utf8_bin NOT NULL,
+  `password` VARBINARY(255) NOT NULL,
   `salt` CHAR(8) COLLATE utf8_bin NOT NULL,
   `is_activated` BOOLEAN NOT NULL DEFAULT '0',
   `activation_token` CHAR(32) COLLATE utf8_bin NOT NULL,
@@ -19,4 +21,39 @@ CREATE TABLE IF NOT EXISTS `users` (
   `modified` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
   PRIMARY KEY (`id`),
   CONSTRAINT `UK_users_email` UNIQUE (`email`)
-) DEFAULT CHARSET=utf8 COLLATE=utf8_bin;
\ No newline at end of file
+) DEFAULT CHARSET=utf8 COLLATE=utf8_bin;
+
+CREATE TABLE IF NOT EXISTS `login_attempt_buckets` (
+  `login` VARCHAR(100) COLLATE utf8_bin NOT NULL,
+  `bucket` BIGINT NOT NULL,
+  `attempts` INT NOT NULL,
+  PRIMARY KEY (`login`, `bucket`),
+  INDEX `IX_login_attempt_buckets_bucket` (`bucket`)
+) DEFAULT CHARSET=utf8 COLLATE=utf8_bin;
+
+CREATE TABLE IF NOT EXISTS `sessions` (
+  `id` VARCHAR(64) COLLATE utf8_bin NOT NULL,
+  `user_id` INT NOT NULL,
+  `email` VARCHAR(100) COLLATE utf8_bin NOT NULL,
+  `expires` BIGINT NOT NULL,
+  `revoked` BIGINT DEFAULT NULL,
+  `created` datetime NOT NULL,
+  PRIMARY KEY (`id`),
+  INDEX `IX_sessions_user_id` (`user_id`),
+  INDEX `IX_sessions_expires` (`expires`),
+  INDEX `IX_sessions_revoked` (`revoked`)
+) DEFAULT CHARSET=utf8 COLLATE=utf8_bin;
+
+CREATE TABLE IF NOT EXISTS `schema_version` (
+  `version` INT NOT NULL,
+  `description` VARCHAR(255) NOT NULL,
+  `applied` datetime NOT NULL,
+  PRIMARY KEY (`version`)
+);
+
+INSERT INTO `schema_version` (`version`, `description`, `applied`) VALUES
+  (1, 'create users and login_attempts', NOW()),
+  (2, 'index login_attempts by login and timestamp', NOW()),
+  (3, 'widen users.password for versioned password hashes', NOW()),
+  (4, 'create login_attempt_buckets', NOW()),
+  (5, 'create sessions', NOW());
@@ -0,0 +1,95 @@
+import csv
+import sys
+import time
+
+class UserPage(object):
+    def __init__(self, users, next_after_id):
+        self.users = users
+        # pass as after_id to get the next page, None after the last page
+        self.next_after_id = next_after_id
+
+class UserAdmin(object):
+    """Listings of the users for administration, e.g. support tools and exports.
+
+    Pages are selected by id (WHERE id > after_id ORDER BY id LIMIT n) instead of
+    an OFFSET, so every page costs the same, however far into the table it is,
+    and users created while paging do not shift the following pages. The rows of
+    a page are streamed from the database (a server side cursor with MySQL),
+    so neither the driver nor the module holds more than one batch of them.
+    """
+    def __init__(self, auth_handler):
+        self._user_repository = auth_handler.db_context.user
+        self._login_attempt_storage = auth_handler.db_context.login_attempt_storage
+
+    def list_users(self, after_id = 0, limit = 100, is_activated = None):
+        users = list(self._iter_page(after_id, limit, is_activated))
+        next_after_id = users[-1].user_id if len(users) == limit else None
+        return UserPage(users, next_after_id)
+
+    def iter_users(self, is_activated = None, page_size = 1000):
+        # yields the UserSummary of every user, page by page
+        after_id = 0
+        while after_id is not None:
+            count = 0
+            for user in self._iter_page(after_id, page_size, is_activated):
+                count += 1
+                after_id = user.user_id
+                yield user
+            if count < page_size:
+                after_id = None
+
+    def export_users(self, file_obj, is_activated = None, page_size = 1000):
+        # writes the users as CSV and returns their number
+        writer = csv.writer(file_obj)
+        writer.writerow(['id', 'email', 'is_activated', 'created', 'last_failed_attempt'])
+        count = 0
+        for user in self.iter_users(is_activated, page_size):
+            writer.writerow([user.user_id, user.email, int(bool(user.is_activated)), _format_time(user.created), _format_time(user.last_failed_attempt)])
+            count += 1
+        return count
+
+    def _iter_page(self, after_id, limit, is_activated):
+        return self._user_repository.iter_summaries(after_id, limit, is_activated, self._login_attempt_storage)
+
+def _format_time(timestamp):
+    if timestamp is None:
+        return ''
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(timestamp))
+
+def _parse_activated(args):
+    if '--activated' in args:
+        return True
+    if '--not-activated' in args:
+        return False
+    return None
+
+def main(args):
+    if len(args) < 2 or args[1] not in ('list', 'export'):
+        print "usage: python admin.py <config file> list [<after id>] [--activated|--not-activated]"
+        print "       python admin.py <config file> export <csv file> [--activated|--not-activated]"
+        return 2
+    import auth
+    auth_handler = auth.AuthHandler(args[0])
+    try:
+        user_admin = UserAdmin(auth_handler)
+        is_activated = _parse_activated(args)
+        positional = [arg for arg in args[2:] if not arg.startswith('--')]
+        if args[1] == 'list':
+            page = user_admin.list_users(int(positional[0]) if positional else 0, 100, is_activated)
+            for user in page.users:
+                print "{0}\t{1}\t{2}\t{3}\t{4}".format(user.user_id, user.email, int(bool(user.is_activated)), _format_time(user.created), _format_time(user.last_failed_attempt))
+            if page.next_after_id is not None:
+                print "Next page: python admin.py {0} list {1}".format(args[0], page.next_after_id)
+            return 0
+        if not positional:
+            print "The export needs a CSV file."
+            return 2
+        with open(positional[0], 'wb') as csv_file:
+            count = user_admin.export_users(csv_file, is_activated)
+        print "Exported {0} users.".format(count)
+        return 0
+    finally:
+        auth_handler.shutdown()
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,46 @@
+from importer import ImportMailMode
+from worker import WorkerPool
+
+class AsyncAuthHandler(object):
+    """Runs the calls of an AuthHandler on a pool of threads.
+
+    A helper for services which must not block the calling thread, e.g. the
+    one of an event loop. Every call returns a worker.Future right away, the
+    queries, the password hashing and the SMTP delivery run on worker_count
+    threads. The future is no asyncio, tornado or twisted future and cannot be
+    awaited or yielded: future.result() blocks until the result is available
+    and returns the User (with its login_result) or raises e.g.
+    EmailAlreadyInUseError, future.add_done_callback() calls back on a worker
+    thread, so the callback has to pass the result on with the thread safe
+    call of the loop (IOLoop.add_callback, reactor.callFromThread).
+    """
+    def __init__(self, auth_handler, worker_count = None):
+        # the auth_handler stays owned by the caller, by default config.async_workers threads are started
+        self.auth_handler = auth_handler
+        if worker_count is None:
+            worker_count = auth_handler.config.async_workers
+        self._workers = WorkerPool(worker_count, 'async-auth')
+
+    def create_user(self, email, password):
+        return self._workers.submit(self.auth_handler.create_user, email, password)
+
+    def create_users(self, records, chunk_size = 500, mail_mode = ImportMailMode.SEND, hash_workers = 0):
+        return self._workers.submit(self.auth_handler.create_users, records, chunk_size, mail_mode, hash_workers)
+
+    def activate_user(self, encoded_email, activation_token):
+        return self._workers.submit(self.auth_handler.activate_user, encoded_email, activation_token)
+
+    def resend_activation_email(self, email):
+        return self._workers.submit(self.auth_handler.resend_activation_email, email)
+
+    def login(self, email, password):
+        return self._workers.submit(self.auth_handler.login, email, password)
+
+    def get_pending_count(self):
+        return self._workers.pending_count
+
+    pending_count = property(get_pending_count)
+
+    def shutdown(self):
+        # calls submitted before the shutdown are still executed, the AuthHandler is shut down by its owner
+        self._workers.shutdown()
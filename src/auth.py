@@ -1,9 +1,16 @@
-from config import Config
+import sys
+import threading
+from config import Config, ConfigWatcher
 from database import DbContext, EmailAlreadyInUseError, EmailTooLongError
 from exception import Error
-from mail import TemplateMailDispatcher, MailDispatcher, MailConfig
+from mail import TemplateMailDispatcher, MailDispatcher, MailConfig, MailTemplate, UnknownMailTemplateError, template_directory_loader
+from outbox import MailOutbox, OutboxConfig
+from importer import UserImporter, ImportStatus, ImportMailMode, ImportResult
+from async_auth import AsyncAuthHandler
+from session import SessionTokenSigner, SessionTokensDisabledError, SessionStore, SessionStoreConfig, SessionStoreDisabledError
 import validator
 import crypto
+import metrics
 
 class LoginResult:
     NONE = 0
@@ -12,6 +19,14 @@ class LoginResult:
     USER_IS_NOT_ACTIVATED = 3
     USER_IS_LOCKED_OUT = 4
 
+_LOGIN_RESULT_NAMES = {
+    LoginResult.NONE: 'none',
+    LoginResult.SUCCESS: 'success',
+    LoginResult.USER_OR_PASSWORD_WRONG: 'user_or_password_wrong',
+    LoginResult.USER_IS_NOT_ACTIVATED: 'user_is_not_activated',
+    LoginResult.USER_IS_LOCKED_OUT: 'user_is_locked_out'
+}
+
 class PasswordToShortError(Error):
     def __init__(self, min_chars):
         super(self.__class__, self).__init__("The password must be at least {0} characters long.".format(min_chars))
@@ -21,24 +36,79 @@ class EmailIsInvalidError(Error):
         super(self.__class__, self).__init__("The email address '{0}' contains invalid characters.".format(email))
         
 class Settings(object):
+    # read-only, a changed configuration gets a new instance
     def __init__(self, config = None):
         self._set_attr_from_config("password_min_length", config)
         self._set_attr_from_config("login_attempt_expire", config)
         self._set_attr_from_config("login_max_attempts", config)
+        self._set_attr_from_config("login_single_query", config)
         self._set_attr_from_config("mail_activation_expire", config)
         self._set_attr_from_config("mail_from", config)
         self._set_attr_from_config("mail_subject", config)
         self._set_attr_from_config("mail_body", config)
         self._set_attr_from_config("mail_body_html", config)
+        object.__setattr__(self, '_is_frozen', True)
+        
+    def __setattr__(self, name, value):
+        if getattr(self, '_is_frozen', False):
+            raise AttributeError("Settings are read-only, attribute '{0}' cannot be changed.".format(name))
+        object.__setattr__(self, name, value)
         
     def _set_attr_from_config(self, attr_name, config):
         value = getattr(config,attr_name) if config else None
         setattr(self, attr_name, value)
 
+_MAIL_OPTIONS = set([
+    'smtp_host', 'smtp_port', 'smtp_local_hostname', 'smtp_timeout', 'smtp_use_ttls', 'smtp_user', 'smtp_password',
+    'smtp_keep_alive', 'smtp_pool_size', 'smtp_idle_timeout', 'smtp_noop_interval', 'mail_body', 'mail_body_html',
+    'mail_template_dir', 'mail_template_cache_size'
+])
+_ACTIVATION_TOKEN_OPTIONS = set(['activation_token_format', 'activation_token_keys', 'mail_activation_expire'])
+_SESSION_TOKEN_OPTIONS = set(['session_tokens', 'session_token_keys', 'session_lifetime'])
+# sized into the shared lockout segment and used by the pruner, only reloadable without them
+_LOCKOUT_OPTIONS = set(['login_max_attempts', 'login_attempt_expire'])
+# the options reload_config applies, all others need a new AuthHandler
+_RELOADABLE_OPTIONS = set([
+    'password_min_length', 'login_attempt_expire', 'login_max_attempts', 'login_single_query',
+    'mail_from', 'mail_subject', 'config_watch_interval'
+]) | _MAIL_OPTIONS | _ACTIVATION_TOKEN_OPTIONS | _SESSION_TOKEN_OPTIONS
+
+class _Components(object):
+    # what a User is built from, replaced as a whole when the configuration is reloaded
+    def __init__(self, settings, mail_dispatcher, token_signer, session_signer):
+        self.settings = settings
+        self.mail_dispatcher = mail_dispatcher
+        self.token_signer = token_signer
+        self.session_signer = session_signer
+
 class AuthHandler(object):   
-    def __init__(self, config_or_file_path):
+    def __init__(self, config_or_file_path, mail_delivery_callback = None, resources = None):
+        # resources (tenants.SharedResources) lets handlers of several configurations share their connection pools
+        self.mail_delivery_callback = mail_delivery_callback
+        self._resources = resources
+        self._reload_lock = threading.Lock()
+        self._watcher = None
+        # what shutdown() releases, set by _configure as soon as it exists
+        self._db_context = None
+        self.session_store = None
+        self._template_mail_dispatcher = None
+        self._shared_dispatcher = None
+        self._retired_dispatchers = []
+        self.mail_outbox = None
         config = self._get_config(config_or_file_path)
-        self._configure(config)
+        try:
+            self._configure(config)
+        except:
+            # e.g. an unknown activation_token_format, the shared pools acquired so far must be released
+            exc_info = sys.exc_info()
+            try:
+                self.shutdown()
+            except Exception:
+                pass
+            raise exc_info[0], exc_info[1], exc_info[2]
+        if config.config_watch_interval > 0 and not isinstance(config_or_file_path, Config):
+            self._watcher = ConfigWatcher(config_or_file_path, self.reload_config, config.config_watch_interval)
+            self._watcher.start()
         
     def _get_config(self, config_or_file_path):
         if isinstance(config_or_file_path, Config):
@@ -47,15 +117,161 @@ class AuthHandler(object):
             return Config(config_or_file_path)                      
     
     def _configure(self, config):
-        self._db_context = DbContext(config)
-        self.settings = Settings(config)
-        self.mail_dispatcher = TemplateMailDispatcher(MailConfig(config), self.settings.mail_body, self.settings.mail_body_html)
+        self.config = config
+        # changed options which only take effect with a new AuthHandler
+        self.pending_restart_options = set()
+        self._db_context = DbContext(config, self._resources)
+        self.session_store = None
+        if config.session_store:
+            store_config = SessionStoreConfig(
+                config.session_lifetime,
+                config.session_cache_size,
+                config.session_cache_ttl,
+                config.session_touch_interval
+            )
+            self.session_store = SessionStore(self._db_context.session, store_config)
+        self._template_mail_dispatcher, self._shared_dispatcher = self._create_mail_dispatcher(config)
+        # dispatchers replaced by a reload, closed by the next one, so mails in flight are not cut off
+        self._retired_dispatchers = []
+        mail_dispatcher = self._template_mail_dispatcher
+        self.mail_outbox = None
+        if config.mail_outbox_enabled:
+            outbox_config = OutboxConfig(config.mail_outbox_workers, config.mail_outbox_max_retries, config.mail_outbox_retry_backoff)
+            self.mail_outbox = MailOutbox(mail_dispatcher, outbox_config, self.mail_delivery_callback)
+            mail_dispatcher = self.mail_outbox
+        self._components = _Components(Settings(config), mail_dispatcher, self._create_token_signer(config), self._create_session_signer(config))
+
+    def _create_mail_dispatcher(self, config):
+        # returns the template dispatcher and, with shared resources, the dispatcher owning the shared SMTP sessions
+        mail_config = MailConfig(config)
+        shared_dispatcher = None
+        session_pool = None
+        if self._resources and mail_config.smtp_keep_alive:
+            shared_dispatcher = self._resources.acquire(mail_config.get_endpoint(), lambda: MailDispatcher(mail_config), lambda dispatcher: dispatcher.close())
+            session_pool = shared_dispatcher.session_pool
+        template_loader = template_directory_loader(config.mail_template_dir) if config.mail_template_dir else None
+        template_mail_dispatcher = TemplateMailDispatcher(
+            mail_config,
+            config.mail_body,
+            config.mail_body_html,
+            session_pool,
+            template_loader,
+            config.mail_template_cache_size
+        )
+        return template_mail_dispatcher, shared_dispatcher
+
+    def _create_token_signer(self, config):
+        if config.activation_token_format == 'uuid':
+            return None
+        if config.activation_token_format != 'signed':
+            raise crypto.UnknownActivationTokenFormatError(config.activation_token_format)
+        return crypto.ActivationTokenSigner(crypto.KeyRing.parse(config.activation_token_keys), config.mail_activation_expire)
+
+    def _create_session_signer(self, config):
+        if not config.session_tokens:
+            return None
+        return SessionTokenSigner(crypto.KeyRing.parse(config.session_token_keys), config.session_lifetime)
+
+    def get_settings(self):
+        return self._components.settings
+
+    settings = property(get_settings)
+
+    def get_mail_dispatcher(self):
+        return self._components.mail_dispatcher
+
+    def set_mail_dispatcher(self, mail_dispatcher):
+        components = self._components
+        self._components = _Components(components.settings, mail_dispatcher, components.token_signer, components.session_signer)
+
+    mail_dispatcher = property(get_mail_dispatcher, set_mail_dispatcher)
+
+    def get_token_signer(self):
+        return self._components.token_signer
+
+    token_signer = property(get_token_signer)
+
+    def get_session_signer(self):
+        return self._components.session_signer
+
+    session_signer = property(get_session_signer)
+
+    def get_db_context(self):
+        # the repositories of the handler, for tools working on many users (importer, admin, campaigns)
+        return self._db_context
+
+    db_context = property(get_db_context)
+
+    def reload_config(self, config):
+        """Applies a changed configuration without rebuilding the handler.
+
+        Settings, signers and the mail dispatcher are rebuilt only if their
+        options changed, then swapped in as one snapshot: calls in progress
+        keep the components they started with, the login path never waits for a
+        reload. Changed options of the database, the outbox and the session store
+        are not applied, they are collected in pending_restart_options.
+        Returns the names of the applied options.
+        """
+        with self._reload_lock:
+            old_config = self.config
+            changed = [name for name in Config.get_option_names() if getattr(old_config, name) != getattr(config, name)]
+            reloadable = self._get_reloadable_options()
+            for name in changed:
+                if name not in reloadable:
+                    setattr(config, name, getattr(old_config, name))
+                    self.pending_restart_options.add(name)
+            changed = set(name for name in changed if name in reloadable)
+            components = self._components
+            token_signer = components.token_signer
+            if changed & _ACTIVATION_TOKEN_OPTIONS:
+                token_signer = self._create_token_signer(config)
+            session_signer = components.session_signer
+            if changed & _SESSION_TOKEN_OPTIONS:
+                session_signer = self._create_session_signer(config)
+            settings = Settings(config)
+            mail_dispatcher = components.mail_dispatcher
+            if changed & _MAIL_OPTIONS:
+                self._close_retired_dispatchers()
+                self._retired_dispatchers.append((self._template_mail_dispatcher, self._shared_dispatcher))
+                self._template_mail_dispatcher, self._shared_dispatcher = self._create_mail_dispatcher(config)
+                if self.mail_outbox:
+                    self.mail_outbox.mail_dispatcher = self._template_mail_dispatcher
+                else:
+                    mail_dispatcher = self._template_mail_dispatcher
+            if self._watcher and 'config_watch_interval' in changed:
+                self._watcher.interval = config.config_watch_interval
+            if self.session_store and 'session_lifetime' in changed:
+                self.session_store.config.lifetime = config.session_lifetime
+            self._components = _Components(settings, mail_dispatcher, token_signer, session_signer)
+            self.config = config
+            return sorted(changed)
+
+    def _get_reloadable_options(self):
+        if self._db_context.shared_lockout or self._db_context.pruner:
+            # both keep the values they were created with
+            return _RELOADABLE_OPTIONS - _LOCKOUT_OPTIONS
+        return _RELOADABLE_OPTIONS
+
+    def _close_retired_dispatchers(self):
+        for template_mail_dispatcher, shared_dispatcher in self._retired_dispatchers:
+            template_mail_dispatcher.close()
+            if shared_dispatcher:
+                self._resources.release(shared_dispatcher)
+        self._retired_dispatchers = []
 
     def create_user(self, email, password):
         user = self.get_user(email)
         user.create(password)
         return user
         
+    def create_users(self, records, chunk_size = 500, mail_mode = ImportMailMode.SEND, hash_workers = 0):
+        return list(self.iter_create_users(records, chunk_size, mail_mode, hash_workers))
+        
+    def iter_create_users(self, records, chunk_size = 500, mail_mode = ImportMailMode.SEND, hash_workers = 0):
+        # like create_users, but yields the results chunk by chunk instead of collecting them
+        importer = UserImporter(self, chunk_size, mail_mode, hash_workers)
+        return importer.run(records)
+        
     def activate_user(self, encoded_email, activation_token):        
         email = crypto.b64_decode(encoded_email)
         user = self.get_user(email)
@@ -68,26 +284,80 @@ class AuthHandler(object):
         return user
     
     def get_user(self, email):
-        return User(email, self._db_context, self.settings, self.mail_dispatcher)
+        components = self._components
+        return User(email, self._db_context, components.settings, components.mail_dispatcher, components.token_signer, components.session_signer, self.session_store)
 
     def login(self, email, password):
         user = self.get_user(email)
         user.login(password)
         return user
+
+    def validate_session(self, session_token):
+        # returns the session.Session of a token issued by login, None if it is invalid or expired
+        session_signer = self.session_signer
+        if not session_signer:
+            raise SessionTokensDisabledError()
+        return session_signer.validate(session_token)
+
+    def validate_session_id(self, session_id):
+        # returns the session.Session of a session of the session store, None if it is unknown, expired or revoked
+        return self._get_session_store().validate(session_id)
+
+    def logout(self, session_id):
+        self._get_session_store().revoke(session_id)
+
+    def revoke_sessions(self, email):
+        # ends all sessions of the user, e.g. after the password has been reset
+        session_store = self._get_session_store()
+        record = self._db_context.user.get_record(email)
+        if record is None:
+            return 0
+        return session_store.revoke_user(record.user_id)
+
+    def _get_session_store(self):
+        if not self.session_store:
+            raise SessionStoreDisabledError()
+        return self.session_store
+        
+    def shutdown(self):
+        if self._watcher:
+            self._watcher.stop()
+        if self.mail_outbox:
+            self.mail_outbox.shutdown()
+        self._close_retired_dispatchers()
+        if self._template_mail_dispatcher:
+            self._template_mail_dispatcher.close()
+        if self._shared_dispatcher:
+            self._resources.release(self._shared_dispatcher)
+        if self.session_store:
+            self.session_store.close()
+        if self._db_context:
+            self._db_context.close()
         
 class User(object):    
-    def __init__(self, email, db_context, settings, mail_dispatcher):
+    def __init__(self, email, db_context, settings, mail_dispatcher, token_signer = None, session_signer = None, session_store = None):
         self._db_context = db_context
         self.settings = settings
         self.mail_dispatcher = mail_dispatcher
+        self.token_signer = token_signer
+        self.session_signer = session_signer
+        self.session_store = session_store
+        self.session_token = None
+        self.session_id = None
         self.email = email
         self.is_logged_in = False
         self.login_result = LoginResult.NONE
+        self.activation_mail = None
 
     def get_is_activated(self):
         return self._db_context.user.is_activated(self.email)
         
     is_activated = property(get_is_activated)
+
+    def _is_unknown_email(self):
+        # with the email index, emails which were never registered are rejected without a query
+        email_index = self._db_context.email_index
+        return email_index is not None and not email_index.might_exist(self.email)
     
     def create(self, password):
         if not validator.is_valid_email(self.email):
@@ -98,23 +368,55 @@ class User(object):
         self._send_activation_token(activation_token)
         
     def resend_activation_email(self):
+        if self._is_unknown_email():
+            return
         activation_token = self._db_context.user.renew_activation_token(self.email)
         self._send_activation_token(activation_token)
     
     def _send_activation_token(self, activation_token):
         if activation_token:
+            if self.token_signer:
+                # the stored token only serves links which were sent before the switch to signed tokens
+                activation_token = self.token_signer.create(self.email)
             encoded_email = crypto.b64_encode(self.email)
-            self.mail_dispatcher.send_mail(
+            # the outbox returns a future of the delivery, a synchronous dispatcher returns nothing
+            self.activation_mail = self.mail_dispatcher.send_mail(
                 self.settings.mail_from, 
                 self.email, 
                 self.settings.mail_subject, 
                 {"{ACTIVATION_TOKEN}": activation_token, "{EMAIL_IDENTIFIER}": encoded_email})
             
     def activate(self, activation_token):
+        if self._is_unknown_email():
+            return False
+        if self.token_signer and not crypto.is_uuid_activation_token(activation_token):
+            # forged and expired tokens are rejected without a query
+            if not self.token_signer.verify(self.email, activation_token):
+                return False
+            if self._db_context.user.mark_activated(self.email) > 0:
+                return True
+            # a valid signature does not mean the user still exists, and MySQL does not count a user which was
+            # activated already, e.g. by an earlier click on the same link
+            return self._db_context.user.exists(self.email)
         activated = self._db_context.user.activate(self.email, activation_token, self.settings.mail_activation_expire)
         return activated
     
     def login(self, password):
+        if not metrics.registry.enabled:
+            return self._login(password)
+        with metrics.registry.timer('login_seconds'):
+            result = self._login(password)
+        metrics.registry.inc('login_total', result = _LOGIN_RESULT_NAMES[self.login_result])
+        return result
+        
+    def _login(self, password):
+        if self._is_unknown_email():
+            # the result the database would give for an email without a user
+            self.login_result = LoginResult.USER_IS_NOT_ACTIVATED
+            return False
+        if self.settings.login_single_query:
+            return self._login_with_single_query(password)
+            
         if self._db_context.login_attempt.is_locked_out(self.email, self.settings.login_attempt_expire, self.settings.login_max_attempts):
             self.login_result = LoginResult.USER_IS_LOCKED_OUT
             self._db_context.login_attempt.log_failed_attempt(self.email)
@@ -127,8 +429,41 @@ class User(object):
         self.is_logged_in = self._db_context.user.login(self.email, password)            
         if self.is_logged_in:
             self.login_result = LoginResult.SUCCESS
+            if self.session_signer or self.session_store:
+                self._start_session(self._db_context.user.get_record(self.email).user_id)
+            return True
+            
+        self.login_result = LoginResult.USER_OR_PASSWORD_WRONG
+        self._db_context.login_attempt.log_failed_attempt(self.email)
+        return False
+        
+    def _login_with_single_query(self, password):
+        state = self._db_context.get_login_state(self.email, self.settings.login_attempt_expire)
+        if state.failed_attempts >= self.settings.login_max_attempts:
+            self.login_result = LoginResult.USER_IS_LOCKED_OUT
+            self._db_context.login_attempt.log_failed_attempt(self.email)
+            return False
+            
+        if not state.is_activated:
+            self.login_result = LoginResult.USER_IS_NOT_ACTIVATED
+            return False
+            
+        password_hasher = self._db_context.password_hasher
+        self.is_logged_in = password_hasher.verify(password, state.salt, state.password)
+        if self.is_logged_in:
+            if password_hasher.needs_rehash(state.password):
+                self._db_context.user.update_password_hash(self.email, password_hasher.hash(password, state.salt))
+            self.login_result = LoginResult.SUCCESS
+            if self.session_signer or self.session_store:
+                self._start_session(state.user_id)
             return True
             
         self.login_result = LoginResult.USER_OR_PASSWORD_WRONG
         self._db_context.login_attempt.log_failed_attempt(self.email)
-        return False            
\ No newline at end of file
+        return False
+
+    def _start_session(self, user_id):
+        if self.session_signer:
+            self.session_token = self.session_signer.issue(user_id, self.email)
+        if self.session_store:
+            self.session_id = self.session_store.create(user_id, self.email).session_id
@@ -0,0 +1,212 @@
+import hashlib
+import math
+import struct
+import threading
+import time
+import metrics
+
+class BloomFilter(object):
+    """Probabilistic set of strings: no false negatives, false positives at about error_rate.
+
+    Sized for capacity entries; the false positive rate grows once more are
+    added. Positions are derived from two 32 bit words of one MD5 digest by
+    double hashing.
+    """
+    def __init__(self, capacity, error_rate = 0.001):
+        self.capacity = max(int(capacity), 1)
+        self.error_rate = error_rate
+        self.bit_count = max(int(math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2)), 8)
+        self.hash_count = max(int(round(float(self.bit_count) / self.capacity * math.log(2))), 1)
+        self.count = 0
+        self._bits = bytearray((self.bit_count + 7) // 8)
+
+    def add(self, value):
+        bits = self._bits
+        for position in self._get_positions(value):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        # stops at the first unset bit, most unknown values are rejected after one or two
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        first, second = struct.unpack('<II', hashlib.md5(value).digest()[:8])
+        bits = self._bits
+        bit_count = self.bit_count
+        for i in xrange(self.hash_count):
+            position = (first + i * second) % bit_count
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def get_false_positive_rate(self):
+        # the expected rate for the entries added so far
+        return (1 - math.exp(-float(self.hash_count) * self.count / self.bit_count)) ** self.hash_count
+
+    false_positive_rate = property(get_false_positive_rate)
+
+    def get_memory_bytes(self):
+        return len(self._bits)
+
+    memory_bytes = property(get_memory_bytes)
+
+    def _get_positions(self, value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        first, second = struct.unpack('<II', hashlib.md5(value).digest()[:8])
+        bit_count = self.bit_count
+        return [(first + i * second) % bit_count for i in xrange(self.hash_count)]
+
+class EmailIndexConfig(object):
+    def __init__(self, error_rate = 0.001, refresh_interval = 5, rebuild_interval = 3600, page_size = 10000, refresh_overlap = 1000):
+        self.error_rate = error_rate
+        # seconds between loading the users created by other processes, and between complete rebuilds (0 for never)
+        self.refresh_interval = refresh_interval
+        self.rebuild_interval = rebuild_interval
+        self.page_size = page_size
+        # ids below the highest one seen which a refresh reads again, for inserts committed out of id order
+        self.refresh_overlap = refresh_overlap
+
+class EmailIndex(object):
+    """A BloomFilter of the registered emails, so unknown ones are rejected without a query.
+
+    Built from the users table when it is created, sized for twice the users
+    at that time. Users created through this process are added right away
+    (see EmailIndexedUser), a background thread loads the ones created by other
+    processes every refresh_interval seconds and rebuilds the filter every
+    rebuild_interval seconds, which resizes it. A refresh reads the users with
+    a higher id than refresh_overlap below the highest one seen, so an insert
+    which committed after inserts with higher ids is picked up as well, unless
+    more than refresh_overlap users were created in between; the next rebuild
+    picks up those. A user created by another process is therefore rejected
+    for about refresh_interval seconds. might_exist() never queries the
+    database.
+    """
+    def __init__(self, user_repository, index_config = None):
+        self._repository = user_repository
+        self.config = index_config or EmailIndexConfig()
+        self._lock = threading.Lock()
+        # emails added while a rebuild loads the table, added to the new filter as well
+        self._pending = None
+        self._filter = None
+        self._last_id = 0
+        self.last_rebuild = None
+        self.last_error = None
+        self.rebuild()
+        self._stopped = threading.Event()
+        self._thread = None
+        if self.config.refresh_interval > 0:
+            self._thread = threading.Thread(target = self._run, name = 'email-index')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def might_exist(self, email):
+        # False if the email is definitely not registered
+        if email in self._filter:
+            metrics.registry.inc('email_index_lookups_total', result = 'maybe')
+            return True
+        metrics.registry.inc('email_index_lookups_total', result = 'unknown')
+        return False
+
+    def add(self, email):
+        with self._lock:
+            self._filter.add(email)
+            if self._pending is not None:
+                self._pending.append(email)
+
+    def refresh(self):
+        # adds the users created since the last refresh, returns the number of emails which were new to the filter
+        added = 0
+        after_id = max(self._last_id - self.config.refresh_overlap, 0)
+        while True:
+            users = list(self._repository.iter_emails(after_id, self.config.page_size))
+            with self._lock:
+                for user_id, email in users:
+                    # users created through this process and the overlap are in the filter already
+                    if email not in self._filter:
+                        self._filter.add(email)
+                        added += 1
+                    self._last_id = max(self._last_id, user_id)
+            if users:
+                after_id = users[-1][0]
+            if len(users) < self.config.page_size:
+                return added
+
+    def rebuild(self):
+        with self._lock:
+            self._pending = []
+        try:
+            emails = []
+            last_id = 0
+            while True:
+                users = list(self._repository.iter_emails(last_id, self.config.page_size))
+                emails.extend(email for user_id, email in users)
+                if users:
+                    last_id = users[-1][0]
+                if len(users) < self.config.page_size:
+                    break
+            bloom_filter = BloomFilter(max(2 * len(emails), 1000), self.config.error_rate)
+            for email in emails:
+                bloom_filter.add(email)
+            with self._lock:
+                for email in self._pending:
+                    if email not in bloom_filter:
+                        bloom_filter.add(email)
+                self._filter = bloom_filter
+                self._last_id = max(self._last_id, last_id)
+                self.last_rebuild = time.time()
+        finally:
+            with self._lock:
+                self._pending = None
+
+    def get_stats(self):
+        bloom_filter = self._filter
+        return {
+            'count': bloom_filter.count,
+            'capacity': bloom_filter.capacity,
+            'hash_count': bloom_filter.hash_count,
+            'memory_bytes': bloom_filter.memory_bytes,
+            'false_positive_rate': bloom_filter.false_positive_rate
+        }
+
+    def close(self):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.config.refresh_interval):
+            try:
+                if self.config.rebuild_interval > 0 and time.time() - self.last_rebuild >= self.config.rebuild_interval:
+                    self.rebuild()
+                else:
+                    self.refresh()
+                self.last_error = None
+            except Exception, e:
+                # the filter stays usable, missed users are loaded by the next refresh
+                self.last_error = e
+
+class EmailIndexedUser(object):
+    """Adds the users created through a user repository to an EmailIndex.
+
+    Offers the same interface as the wrapped repository (database.User or a
+    backend's equivalent, possibly a cache.CachedUser); everything but the
+    creation is delegated to it.
+    """
+    def __init__(self, user, email_index):
+        self._user = user
+        self.email_index = email_index
+
+    def __getattr__(self, name):
+        # not indexed, e.g. the lookups and activation
+        return getattr(self._user, name)
+
+    def create(self, email, password):
+        activation_token = self._user.create(email, password)
+        self.email_index.add(email)
+        return activation_token
+
+    def create_many(self, users):
+        self._user.create_many(users)
+        for user in users:
+            self.email_index.add(user[0])
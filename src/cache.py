@@ -0,0 +1,154 @@
+import threading
+import time
+from collections import OrderedDict
+import metrics
+
+_NEVER = float('inf')
+
+class LruTtlCache(object):
+    """Bounded mapping whose entries expire ttl seconds after they were stored.
+
+    When max_size entries are stored, the least recently used one is evicted.
+    With a ttl of None entries only leave the cache by eviction.
+    Hits, misses and evictions are counted for get_stats().
+    """
+    def __init__(self, max_size, ttl, name = 'cache'):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[1] > time.time():
+                # re-inserting moves the entry to the most recently used end
+                self._entries[key] = entry
+                self.hits += 1
+            else:
+                entry = None
+                self.misses += 1
+        if entry is None:
+            metrics.registry.inc('cache_misses_total', cache = self.name)
+            return None
+        metrics.registry.inc('cache_hits_total', cache = self.name)
+        return entry[0]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time() + self.ttl if self.ttl is not None else _NEVER)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last = False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+class CachedUser(object):
+    """Caches the users rows of a user repository (database.User or a backend's equivalent).
+
+    Offers the same interface: reads are answered from the UserRecord in the
+    cache, writes invalidate the cached record, every other method is the one
+    of the wrapped repository. Only existing users are cached, and changes
+    made by other processes become visible after at most ttl seconds.
+    """
+    def __init__(self, user, cache, password_hasher):
+        self._user = user
+        self.cache = cache
+        self._password_hasher = password_hasher
+
+    def __getattr__(self, name):
+        # not cached, e.g. the listings
+        return getattr(self._user, name)
+
+    def get_record(self, email):
+        record = self.cache.get(email)
+        if record is None:
+            record = self._user.get_record(email)
+            if record is not None:
+                self.cache.put(email, record)
+        return record
+
+    def is_activated(self, email, keep_connection_open = False):
+        record = self.get_record(email)
+        if record:
+            return record.is_activated
+        return None
+
+    def exists(self, email, keep_connection_open = False):
+        return self.get_record(email) is not None
+
+    def create(self, email, password):
+        self.cache.invalidate(email)
+        return self._user.create(email, password)
+
+    def create_many(self, users):
+        for user in users:
+            self.cache.invalidate(user[0])
+        self._user.create_many(users)
+
+    def renew_activation_tokens(self, users):
+        self._user.renew_activation_tokens(users)
+        for user in users:
+            self.cache.invalidate(user[1])
+
+    def renew_activation_token(self, email):
+        activation_token = self._user.renew_activation_token(email)
+        self.cache.invalidate(email)
+        return activation_token
+
+    def activate(self, email, activation_token, email_activation_expire):
+        activated = self._user.activate(email, activation_token, email_activation_expire)
+        if activated:
+            self.cache.invalidate(email)
+        return activated
+
+    def mark_activated(self, email):
+        updated = self._user.mark_activated(email)
+        self.cache.invalidate(email)
+        return updated
+
+    def login(self, email, password):
+        record = self.get_record(email)
+        if not record or not self._password_hasher.verify(password, record.salt, record.password):
+            return False
+        if self._password_hasher.needs_rehash(record.password):
+            self.update_password_hash(email, self._password_hasher.hash(password, record.salt))
+        return True
+
+    def update_password_hash(self, email, hashed_password):
+        self._user.update_password_hash(email, hashed_password)
+        self.cache.invalidate(email)
+
+    def get_login_state(self, email, login_attempt_expire, include_failed_attempts = True):
+        if include_failed_attempts:
+            return self._user.get_login_state(email, login_attempt_expire)
+        record = self.get_record(email)
+        if not record:
+            return self._user.get_login_state(email, login_attempt_expire, False)
+        return record.get_login_state()
+
+    def _get_salt_from_db(self, email, keep_connection_open = False):
+        record = self.get_record(email)
+        if record:
+            return record.salt
+        return None
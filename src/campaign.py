@@ -0,0 +1,227 @@
+import calendar
+import json
+import os
+import sys
+import time
+import crypto
+import metrics
+from exception import Error
+from outbox import get_batch_dispatcher
+
+class CheckpointMismatchError(Error):
+    def __init__(self, path):
+        super(self.__class__, self).__init__("Checkpoint '{0}' belongs to a campaign with another creation window.".format(path))
+
+class CampaignConfig(object):
+    def __init__(self, created_after = None, created_before = None, chunk_size = 500, batch_size = 50, rate = 10, template_name = None):
+        # the creation window in unix timestamps, by default all users created before the campaign started
+        self.created_after = created_after
+        self.created_before = created_before
+        # users selected per statement, users renewed and mailed per SMTP batch and mails per second (0 for no limit)
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        self.rate = rate
+        # a named template of the mail dispatcher, None for mail_body
+        self.template_name = template_name
+
+class CampaignProgress(object):
+    def __init__(self, created_after, created_before, after_id = 0, sent = 0, failed_emails = None, finished = False, in_flight = None):
+        self.created_after = created_after
+        self.created_before = created_before
+        # the id of the last user whose mail has been handed to the SMTP server
+        self.after_id = after_id
+        self.sent = sent
+        self.failed_emails = failed_emails or []
+        self.finished = finished
+        # (id, email, activation token) of the users whose tokens are renewed but whose mails are not sent yet
+        self.in_flight = in_flight or []
+
+    def to_dict(self):
+        return {
+            'created_after': self.created_after,
+            'created_before': self.created_before,
+            'after_id': self.after_id,
+            'sent': self.sent,
+            'failed_emails': self.failed_emails,
+            'finished': self.finished,
+            'in_flight': self.in_flight
+        }
+
+    @classmethod
+    def from_dict(cls, values):
+        in_flight = [tuple(user) for user in values['in_flight']]
+        return cls(values['created_after'], values['created_before'], values['after_id'], values['sent'], values['failed_emails'], values['finished'], in_flight)
+
+class CampaignCheckpoint(object):
+    """The progress of a campaign in a JSON file, written before and after every batch.
+
+    The file is replaced atomically (written next to it and renamed), so an
+    interrupted campaign resumes with the batch which was being sent.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        # returns the CampaignProgress, None if there is no checkpoint yet
+        if not os.path.isfile(self.path):
+            return None
+        with open(self.path, 'rb') as checkpoint_file:
+            return CampaignProgress.from_dict(json.load(checkpoint_file))
+
+    def save(self, progress):
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as checkpoint_file:
+            json.dump(progress.to_dict(), checkpoint_file)
+        os.rename(temp_path, self.path)
+
+class _RateLimiter(object):
+    def __init__(self, rate):
+        self.rate = rate
+        self._next = None
+
+    def wait(self, count):
+        # blocks until count more mails may be sent
+        if not self.rate:
+            return
+        now = time.time()
+        if self._next is None or self._next < now:
+            self._next = now
+        if self._next > now:
+            time.sleep(self._next - now)
+        self._next += count / float(self.rate)
+
+class ActivationCampaign(object):
+    """Re-sends the activation mail to the users which are not activated yet.
+
+    E.g. after an SMTP outage dropped activation mails. Users are selected by
+    creation window, chunk_size at a time (keyset paginated by id), and handled
+    in batches of batch_size: the activation tokens of a batch are renewed with
+    one UPDATE (with signed activation tokens no update is needed at all) right
+    before its mails are sent through one SMTP session, at most rate mails per
+    second. With a checkpoint the renewed tokens are saved before the mails go
+    out and the result of every recipient after, so run() continues where an
+    interrupted campaign stopped; users of the batch which was being sent get
+    their mail again with the same token.
+    """
+    def __init__(self, auth_handler, campaign_config = None, checkpoint = None):
+        self._auth_handler = auth_handler
+        self._user_repository = auth_handler.db_context.user
+        self.config = campaign_config or CampaignConfig()
+        # one batch is renewed with one statement, three parameters per user
+        max_rows = auth_handler.db_context.get_max_rows(3)
+        self._batch_size = min(self.config.batch_size, max_rows) if max_rows else self.config.batch_size
+        self.checkpoint = checkpoint
+        self.progress = self._load_progress()
+        self._rate_limiter = _RateLimiter(self.config.rate)
+
+    def run(self, max_mails = None):
+        # sends up to max_mails mails (all by default) and returns the CampaignProgress
+        remaining = max_mails
+        if self.progress.in_flight:
+            # the batch an interrupted run was sending, its users may already hold these tokens
+            in_flight = self.progress.in_flight
+            self._send_batch(in_flight)
+            if remaining is not None:
+                remaining = max(remaining - len(in_flight), 0)
+        while not self.progress.finished and remaining != 0:
+            limit = self.config.chunk_size if remaining is None else min(self.config.chunk_size, remaining)
+            users = list(self._user_repository.iter_unactivated(
+                self.progress.after_id, limit, self.progress.created_after, self.progress.created_before))
+            for i in xrange(0, len(users), self._batch_size):
+                self._send_batch(self._renew_tokens(users[i:i + self._batch_size]))
+            if remaining is not None:
+                remaining -= len(users)
+            if len(users) < limit:
+                self.progress.finished = True
+                self._save_progress()
+        return self.progress
+
+    def _renew_tokens(self, users):
+        # returns (id, email, activation token) tuples, saved as in flight so a resumed run sends the same tokens
+        token_signer = self._auth_handler.token_signer
+        if token_signer:
+            renewed = [(user_id, email, token_signer.create(email)) for user_id, email in users]
+        else:
+            renewed = [(user_id, email, crypto.create_activation_token()) for user_id, email in users]
+            self._user_repository.renew_activation_tokens(renewed)
+        self.progress.in_flight = renewed
+        self._save_progress()
+        return renewed
+
+    def _send_batch(self, batch):
+        settings = self._auth_handler.settings
+        messages = [(
+            settings.mail_from,
+            email,
+            settings.mail_subject,
+            {"{ACTIVATION_TOKEN}": activation_token, "{EMAIL_IDENTIFIER}": crypto.b64_encode(email)},
+            self.config.template_name
+        ) for user_id, email, activation_token in batch]
+        self._rate_limiter.wait(len(messages))
+        errors = get_batch_dispatcher(self._auth_handler.mail_dispatcher).send_many(messages)
+        for (user_id, email, activation_token), error in zip(batch, errors):
+            if error:
+                self.progress.failed_emails.append(email)
+            else:
+                self.progress.sent += 1
+            self.progress.after_id = user_id
+        failed = len([error for error in errors if error])
+        metrics.registry.inc('campaign_mails_total', len(batch) - failed, result = 'sent')
+        metrics.registry.inc('campaign_mails_total', failed, result = 'failed')
+        self.progress.in_flight = []
+        self._save_progress()
+
+    def _load_progress(self):
+        progress = self.checkpoint.load() if self.checkpoint else None
+        if progress is None:
+            created_after = self.config.created_after or 0
+            # whole seconds, users created in the second the campaign starts are included
+            created_before = self.config.created_before or int(time.time()) + 1
+            return CampaignProgress(created_after, created_before)
+        for value, saved in ((self.config.created_after, progress.created_after), (self.config.created_before, progress.created_before)):
+            if value is not None and value != saved:
+                raise CheckpointMismatchError(self.checkpoint.path)
+        return progress
+
+    def _save_progress(self):
+        if self.checkpoint:
+            self.checkpoint.save(self.progress)
+
+def _parse_time(value):
+    # a unix timestamp or a date (YYYY-MM-DD, UTC)
+    if value.isdigit():
+        return int(value)
+    return calendar.timegm(time.strptime(value, '%Y-%m-%d'))
+
+def _get_option(args, name, convert, default = None):
+    if name in args and args.index(name) + 1 < len(args):
+        return convert(args[args.index(name) + 1])
+    return default
+
+def main(args):
+    if len(args) < 2:
+        print "usage: python campaign.py <config file> <checkpoint file> [--created-after <date>] [--created-before <date>]"
+        print "       [--rate <mails per second>] [--batch-size <n>] [--template <name>] [--max <n>]"
+        print "Dates are YYYY-MM-DD (UTC) or unix timestamps. Run it again with the same checkpoint file to resume."
+        return 2
+    campaign_config = CampaignConfig(
+        _get_option(args, '--created-after', _parse_time),
+        _get_option(args, '--created-before', _parse_time),
+        batch_size = _get_option(args, '--batch-size', int, 50),
+        rate = _get_option(args, '--rate', float, 10),
+        template_name = _get_option(args, '--template', str)
+    )
+    import auth
+    auth_handler = auth.AuthHandler(args[0])
+    try:
+        campaign = ActivationCampaign(auth_handler, campaign_config, CampaignCheckpoint(args[1]))
+        progress = campaign.run(_get_option(args, '--max', int))
+        print "Sent {0} mails, {1} failed.".format(progress.sent, len(progress.failed_emails))
+        if not progress.finished:
+            print "Not finished yet, run the same command again to continue."
+        return 0 if not progress.failed_emails else 1
+    finally:
+        auth_handler.shutdown()
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,4 +1,6 @@
+import os
 import os.path
+import threading
 from ConfigParser import SafeConfigParser, ParsingError, MissingSectionHeaderError
 from exception import Error
 
@@ -18,6 +20,17 @@ class MandatoryOptionMissingError(Error):
     def __init__(self, option_name):
         super(self.__class__, self).__init__("Config option '{0}' is mandatory and seems to be missing.".format(option_name))
         
+def _uses_backend(backend_name):
+    # options which are only mandatory if the given storage backend is configured
+    def is_mandatory(parser):
+        if parser.has_option(Config.CONFIG_SECTION_NAME, 'db_backend'):
+            return parser.get(Config.CONFIG_SECTION_NAME, 'db_backend') == backend_name
+        return backend_name == Config.DEFAULT_BACKEND
+    return is_mandatory
+
+def _to_bool(value):
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'on')
+        
 class _ConfigItem(object):
     def __init__(self, name, default_value = None, is_mandatory = False, convert_func = None):
         self.name = name
@@ -27,12 +40,21 @@ class _ConfigItem(object):
 	
 class Config(object):
     CONFIG_SECTION_NAME = 'auth'
+    DEFAULT_BACKEND = 'mysql'
     
     _config_items = [
+        _ConfigItem('db_backend', DEFAULT_BACKEND),
         _ConfigItem('db_host', 'localhost'),
-        _ConfigItem('db_user', None, True),
-        _ConfigItem('db_password', None, True),
-        _ConfigItem('db_catalog', None, True),
+        _ConfigItem('db_user', None, _uses_backend('mysql')),
+        _ConfigItem('db_password', None, _uses_backend('mysql')),
+        _ConfigItem('db_catalog', None, _uses_backend('mysql')),
+        _ConfigItem('db_path', None, _uses_backend('sqlite')),
+        _ConfigItem('db_schema_mode', 'check'),
+        _ConfigItem('db_pool_min_size', 0, False, lambda val: int(val)),
+        _ConfigItem('db_pool_max_size', 10, False, lambda val: int(val)),
+        _ConfigItem('db_pool_idle_timeout', 300, False, lambda val: int(val)),
+        _ConfigItem('db_pool_borrow_timeout', 10, False, lambda val: int(val)),
+        _ConfigItem('db_pool_check_on_borrow', True, False, _to_bool),
         _ConfigItem('smtp_host', 'localhost'),
         _ConfigItem('smtp_port', 25, False, lambda val: int(val)),
         _ConfigItem('smtp_local_hostname'),
@@ -40,16 +62,67 @@ class Config(object):
         _ConfigItem('smtp_use_ttls'),
         _ConfigItem('smtp_user'),
         _ConfigItem('smtp_password'),
+        _ConfigItem('smtp_keep_alive', False, False, _to_bool),
+        _ConfigItem('smtp_pool_size', 2, False, lambda val: int(val)),
+        _ConfigItem('smtp_idle_timeout', 60, False, lambda val: int(val)),
+        _ConfigItem('smtp_noop_interval', 10, False, lambda val: int(val)),
         _ConfigItem('mail_from', 'webmaster@your-site.com'),
         _ConfigItem('mail_subject', 'Welcome to Website - Please confirm your email address'),
         _ConfigItem('mail_body', 'Please go to http://your-site.com/?activate_email={ACTIVATION_TOKEN} to activate your email address.'),
         _ConfigItem('mail_body_html', None),
+        _ConfigItem('mail_template_dir', None),
+        _ConfigItem('mail_template_cache_size', 100, False, lambda val: int(val)),
+        _ConfigItem('mail_outbox_enabled', False, False, _to_bool),
+        _ConfigItem('mail_outbox_workers', 2, False, lambda val: int(val)),
+        _ConfigItem('mail_outbox_max_retries', 3, False, lambda val: int(val)),
+        _ConfigItem('mail_outbox_retry_backoff', 1.0, False, lambda val: float(val)),
         _ConfigItem('mail_activation_expire', 86400, False, lambda val: int(val)),
+        _ConfigItem('activation_token_format', 'uuid'),
+        _ConfigItem('activation_token_keys', None),
         _ConfigItem('password_min_length', 8, False, lambda val: int(val)),
+        _ConfigItem('password_kdf', 'sha512'),
+        _ConfigItem('password_kdf_iterations', 100000, False, lambda val: int(val)),
+        _ConfigItem('password_kdf_scrypt_n', 16384, False, lambda val: int(val)),
+        _ConfigItem('password_kdf_scrypt_r', 8, False, lambda val: int(val)),
+        _ConfigItem('password_kdf_scrypt_p', 1, False, lambda val: int(val)),
+        _ConfigItem('password_kdf_workers', 0, False, lambda val: int(val)),
+        _ConfigItem('session_tokens', False, False, _to_bool),
+        _ConfigItem('session_token_keys', None),
+        _ConfigItem('session_lifetime', 3600, False, lambda val: int(val)),
+        _ConfigItem('session_store', False, False, _to_bool),
+        _ConfigItem('session_cache_size', 10000, False, lambda val: int(val)),
+        _ConfigItem('session_cache_ttl', 60, False, lambda val: float(val)),
+        _ConfigItem('session_touch_interval', 60, False, lambda val: float(val)),
         _ConfigItem('login_max_attempts', 5, False, lambda val: int(val)),
-        _ConfigItem('login_attempt_expire', 43200, False, lambda val: int(val))        
+        _ConfigItem('login_attempt_expire', 43200, False, lambda val: int(val)),
+        _ConfigItem('login_single_query', False, False, _to_bool),
+        _ConfigItem('login_attempt_write_behind', False, False, _to_bool),
+        _ConfigItem('login_attempt_batch_size', 100, False, lambda val: int(val)),
+        _ConfigItem('login_attempt_buffer_size', 10000, False, lambda val: int(val)),
+        _ConfigItem('login_attempt_flush_interval', 2, False, lambda val: float(val)),
+        _ConfigItem('login_attempt_storage', 'rows'),
+        _ConfigItem('login_attempt_bucket_seconds', 300, False, lambda val: int(val)),
+        _ConfigItem('login_attempt_prune_interval', 0, False, lambda val: float(val)),
+        _ConfigItem('login_attempt_prune_batch_size', 1000, False, lambda val: int(val)),
+        _ConfigItem('lockout_shm_path', None),
+        _ConfigItem('lockout_shm_slots', 65536, False, lambda val: int(val)),
+        _ConfigItem('lockout_persist_interval', 5, False, lambda val: int(val)),
+        _ConfigItem('lockout_max_pending', 10000, False, lambda val: int(val)),
+        _ConfigItem('user_cache_size', 0, False, lambda val: int(val)),
+        _ConfigItem('user_cache_ttl', 30, False, lambda val: float(val)),
+        _ConfigItem('email_index', False, False, _to_bool),
+        _ConfigItem('email_index_error_rate', 0.001, False, lambda val: float(val)),
+        _ConfigItem('email_index_refresh_interval', 5, False, lambda val: float(val)),
+        _ConfigItem('email_index_rebuild_interval', 3600, False, lambda val: float(val)),
+        _ConfigItem('email_index_refresh_overlap', 1000, False, lambda val: int(val)),
+        _ConfigItem('async_workers', 10, False, lambda val: int(val)),
+        _ConfigItem('config_watch_interval', 0, False, lambda val: float(val))
     ]   
     
+    @classmethod
+    def get_option_names(cls):
+        return [item.name for item in cls._config_items]
+    
     def __init__(self, file_path_to_config = None):
         if not file_path_to_config:
             self._create_default_config()
@@ -86,6 +159,61 @@ class Config(object):
     def _get_value_from_config(self, parser, item):
         if parser.has_option(self.CONFIG_SECTION_NAME, item.name):
             return parser.get(self.CONFIG_SECTION_NAME, item.name)            
-        if item.is_mandatory:
+        is_mandatory = item.is_mandatory(parser) if callable(item.is_mandatory) else item.is_mandatory
+        if is_mandatory:
             raise MandatoryOptionMissingError(item.name)
-        return item.default_value
\ No newline at end of file
+        return item.default_value
+
+class ConfigWatcher(object):
+    """Passes a new Config to callback whenever the config file has changed.
+
+    The file is checked every interval seconds by its modification time and
+    size. A file which cannot be parsed is skipped (see last_error) until it
+    changes again, the callback keeps the previous configuration meanwhile.
+    """
+    def __init__(self, file_path, callback, interval = 2):
+        self.file_path = file_path
+        self.callback = callback
+        self.interval = interval
+        self.last_error = None
+        self._stat = self._get_stat()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def check(self):
+        # returns True if the file has changed and was passed to the callback
+        stat = self._get_stat()
+        if stat == self._stat:
+            return False
+        self._stat = stat
+        try:
+            self.callback(Config(self.file_path))
+            self.last_error = None
+            return True
+        except Exception, e:
+            self.last_error = e
+            return False
+
+    def start(self):
+        if self._thread:
+            return
+        self._thread = threading.Thread(target = self._run, name = 'config-watcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.check()
+
+    def _get_stat(self):
+        try:
+            stat = os.stat(self.file_path)
+            return (stat.st_mtime, stat.st_size)
+        except OSError:
+            return None
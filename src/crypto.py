@@ -3,6 +3,42 @@ import random
 import string	
 import uuid
 import base64
+import hmac
+import os
+import re
+import time
+import multiprocessing
+import threading
+from exception import Error
+
+LEGACY_KDF = 'sha512'
+PBKDF2_KDF = 'pbkdf2-sha512'
+SCRYPT_KDF = 'scrypt'
+
+class UnknownKdfError(Error):
+    def __init__(self, algorithm):
+        super(self.__class__, self).__init__("Password hash algorithm '{0}' is unknown, use one of: {1}.".format(algorithm, ", ".join(_KDF_PARAMS)))
+
+class KdfNotAvailableError(Error):
+    def __init__(self, algorithm):
+        super(self.__class__, self).__init__("Password hash algorithm '{0}' is not supported by the hashlib of this Python version.".format(algorithm))
+
+class UnknownActivationTokenFormatError(Error):
+    def __init__(self, token_format):
+        super(self.__class__, self).__init__("Activation token format '{0}' is unknown, use one of: uuid, signed.".format(token_format))
+
+class InvalidKeyRingError(Error):
+    def __init__(self, reason):
+        super(self.__class__, self).__init__("The activation token keys are invalid ({0}), expected 'key id:secret, ...'.".format(reason))
+
+class KdfConfig(object):
+    def __init__(self, algorithm = LEGACY_KDF, iterations = 100000, scrypt_n = 16384, scrypt_r = 8, scrypt_p = 1, workers = 0):
+        self.algorithm = algorithm
+        self.iterations = iterations
+        self.scrypt_n = scrypt_n
+        self.scrypt_r = scrypt_r
+        self.scrypt_p = scrypt_p
+        self.workers = workers
 
 def create_salt():
     return _create_random_string(8)
@@ -11,12 +47,212 @@ def create_activation_token():
     guid = uuid.uuid1()
     return str(guid).replace("-","")
 
+_UUID_TOKEN = re.compile('^[0-9a-f]{32}$')
+
+def is_uuid_activation_token(activation_token):
+    return bool(activation_token) and _UUID_TOKEN.match(activation_token) is not None
+
+class KeyRing(object):
+    """The keys activation tokens are signed and verified with, by key id.
+
+    The first key signs new tokens, all keys verify. To rotate, put the new key
+    in front and keep the old one until the tokens signed with it have expired.
+    """
+    def __init__(self, keys):
+        # keys is a list of (key id, secret) tuples
+        if not keys:
+            raise InvalidKeyRingError('no keys')
+        self._keys = {}
+        for key_id, secret in keys:
+            if not key_id or not secret:
+                raise InvalidKeyRingError('empty key id or secret')
+            if '.' in key_id:
+                raise InvalidKeyRingError("key id '{0}' contains a '.'".format(key_id))
+            if key_id in self._keys:
+                raise InvalidKeyRingError("key id '{0}' is used twice".format(key_id))
+            self._keys[key_id] = secret
+        self.signing_key_id = keys[0][0]
+
+    @classmethod
+    def parse(cls, text):
+        # 'key id:secret, key id:secret', as in the activation_token_keys option
+        keys = []
+        for item in (text or '').split(','):
+            if not item.strip():
+                continue
+            if ':' not in item:
+                raise InvalidKeyRingError("'{0}' has no key id".format(item.strip()))
+            key_id, secret = item.split(':', 1)
+            keys.append((key_id.strip(), secret.strip()))
+        return cls(keys)
+
+    def get_secret(self, key_id):
+        return self._keys.get(key_id)
+
+class ActivationTokenSigner(object):
+    """Creates and verifies activation tokens which need no database lookup.
+
+    A token is <key id>.<issue time>.<HMAC-SHA256 of key id, issue time and email>,
+    so it is bound to the email address of the activation link and expires
+    expire seconds after it was issued. Forged, altered and expired tokens are
+    rejected by verify() without a query.
+    """
+    # accepted difference of the clocks of the servers issuing and verifying tokens
+    CLOCK_SKEW = 60
+
+    def __init__(self, key_ring, expire):
+        self.key_ring = key_ring
+        self.expire = expire
+
+    def create(self, email, issued = None):
+        key_id = self.key_ring.signing_key_id
+        issued = '{0:x}'.format(int(time.time() if issued is None else issued))
+        return '{0}.{1}.{2}'.format(key_id, issued, self._sign(self.key_ring.get_secret(key_id), key_id, issued, email))
+
+    def verify(self, email, activation_token):
+        parts = (activation_token or '').split('.')
+        if len(parts) != 3:
+            return False
+        key_id, issued, signature = parts
+        secret = self.key_ring.get_secret(key_id)
+        if secret is None:
+            return False
+        try:
+            age = time.time() - int(issued, 16)
+        except ValueError:
+            return False
+        if age >= self.expire or age < -self.CLOCK_SKEW:
+            return False
+        return hmac.compare_digest(self._sign(secret, key_id, issued, email), signature)
+
+    def _sign(self, secret, key_id, issued, email):
+        if isinstance(email, unicode):
+            email = email.encode('utf-8')
+        digest = hmac.new(secret, '{0}.{1}.{2}'.format(key_id, issued, email), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest).rstrip('=')
+
 def _create_random_string(length):
     return ''.join(random.choice(string.ascii_uppercase + string.digits) for x in range(length))
 
 def create_hash(text, salt):
     return hashlib.sha512( salt + text ).digest()
     
+_KDF_PARAMS = {
+    LEGACY_KDF : (),
+    PBKDF2_KDF : ('i',),
+    SCRYPT_KDF : ('n', 'r', 'p')
+}
+
+class PasswordHasher(object):
+    """Creates and verifies password hashes in a versioned format.
+
+    Hashes are stored as $<algorithm>$<parameters>$<base64 digest>, e.g.
+    $pbkdf2-sha512$i=100000$..., so every hash can be verified with the
+    parameters it was created with. Hashes without this prefix are the raw
+    salted SHA-512 digests of LEGACY_KDF. needs_rehash() tells whether a
+    stored hash was created with other settings than the configured ones.
+    With workers > 0 the key derivation runs in a multiprocessing.Pool, the
+    calling thread only waits for the result and does not hold the GIL.
+    """
+    def __init__(self, kdf_config = None):
+        self.config = kdf_config or KdfConfig()
+        if self.config.algorithm not in _KDF_PARAMS:
+            raise UnknownKdfError(self.config.algorithm)
+        if self.config.algorithm == SCRYPT_KDF and not hasattr(hashlib, 'scrypt'):
+            raise KdfNotAvailableError(SCRYPT_KDF)
+        self._params = self._get_configured_params()
+        self._process_pool = None
+        self._pool_pid = None
+        self._pool_lock = threading.Lock()
+
+    def hash(self, password, salt):
+        return self._derive(self.config.algorithm, self._params, password, salt)
+
+    def hash_many(self, password_salt_pairs, process_pool = None):
+        process_pool = self._get_process_pool() or process_pool
+        tasks = [(self.config.algorithm, self._params, password, salt) for password, salt in password_salt_pairs]
+        if process_pool:
+            return process_pool.map(_derive_task, tasks, max(len(tasks) // 32, 1))
+        return [_derive(*task) for task in tasks]
+
+    def verify(self, password, salt, stored_hash):
+        if stored_hash is None or salt is None:
+            return False
+        if not stored_hash.startswith('$'):
+            # legacy digests are cheap, they are never sent to the process pool
+            return is_same_hash(create_hash(password, salt), stored_hash)
+        algorithm, params = parse_hash(stored_hash)
+        return is_same_hash(self._derive(algorithm, params, password, salt), stored_hash)
+
+    def needs_rehash(self, stored_hash):
+        if not stored_hash.startswith('$'):
+            return self.config.algorithm != LEGACY_KDF
+        return parse_hash(stored_hash) != (self.config.algorithm, self._params)
+
+    def close(self):
+        with self._pool_lock:
+            if self._process_pool and self._pool_pid == os.getpid():
+                self._process_pool.terminate()
+                self._process_pool.join()
+            self._process_pool = None
+
+    def _derive(self, algorithm, params, password, salt):
+        process_pool = self._get_process_pool() if algorithm != LEGACY_KDF else None
+        if process_pool:
+            return process_pool.apply(_derive, (algorithm, params, password, salt))
+        return _derive(algorithm, params, password, salt)
+
+    def _get_process_pool(self):
+        if self.config.workers <= 0:
+            return None
+        with self._pool_lock:
+            # a pool inherited from the parent process is not usable after a fork
+            if self._pool_pid != os.getpid():
+                self._process_pool = multiprocessing.Pool(self.config.workers)
+                self._pool_pid = os.getpid()
+            return self._process_pool
+
+    def _get_configured_params(self):
+        if self.config.algorithm == PBKDF2_KDF:
+            return (('i', int(self.config.iterations)),)
+        if self.config.algorithm == SCRYPT_KDF:
+            return (('n', int(self.config.scrypt_n)), ('r', int(self.config.scrypt_r)), ('p', int(self.config.scrypt_p)))
+        return ()
+
+def parse_hash(stored_hash):
+    # returns the algorithm and the parameters of a stored hash
+    if not stored_hash.startswith('$'):
+        return LEGACY_KDF, ()
+    parts = stored_hash.split('$')
+    if len(parts) != 4 or parts[1] not in _KDF_PARAMS:
+        # a legacy digest which happens to start with '$'
+        return LEGACY_KDF, ()
+    params = tuple((name, int(value)) for name, value in (param.split('=') for param in parts[2].split(',')))
+    return parts[1], params
+
+def _derive(algorithm, params, password, salt):
+    if algorithm == LEGACY_KDF:
+        return create_hash(password, salt)
+    values = dict(params)
+    if algorithm == PBKDF2_KDF:
+        digest = hashlib.pbkdf2_hmac('sha512', password, salt, values['i'])
+    elif algorithm == SCRYPT_KDF:
+        if not hasattr(hashlib, 'scrypt'):
+            raise KdfNotAvailableError(SCRYPT_KDF)
+        digest = hashlib.scrypt(password, salt = salt, n = values['n'], r = values['r'], p = values['p'])
+    else:
+        raise UnknownKdfError(algorithm)
+    return '${0}${1}${2}'.format(algorithm, ','.join('{0}={1}'.format(name, value) for name, value in params), base64.b64encode(digest))
+
+def _derive_task(task):
+    return _derive(*task)
+
+def is_same_hash(hashed_text, stored_hash):
+    if hashed_text is None or stored_hash is None:
+        return False
+    # CHAR columns drop trailing spaces on retrieval, the SQL comparison ignores them as well
+    return hmac.compare_digest(hashed_text.rstrip(' '), stored_hash.rstrip(' '))
+    
 def b64_encode(text):
     return base64.b64encode(text)
 
@@ -1,7 +1,27 @@
-import MySQLdb
+import re
+import sys
+import threading
+import time
 import crypto
+import metrics
+from pool import ConnectionPool, PoolConfig
+from lockout import SharedLockoutTracker, SharedLockoutConfig
+from write_behind import WriteBehindLoginAttempt, WriteBehindConfig
+from cache import LruTtlCache, CachedUser
+from bloom import EmailIndex, EmailIndexConfig, EmailIndexedUser
+from schema import apply_schema_mode
+from retention import RetentionPruner, RetentionConfig
+from statements import StatementCache
 from exception import Error
 
+try:
+    import MySQLdb
+    import MySQLdb.cursors
+except ImportError:
+    MySQLdb = None
+
+MAX_EMAIL_LENGTH = 100
+
 class EmailAlreadyInUseError(Error):
     def __init__(self, email):
         super(self.__class__, self).__init__("Email '{0}' is already registered.".format(email))
@@ -10,6 +30,18 @@ class EmailTooLongError(Error):
     def __init__(self, email, max_chars):
         super(self.__class__, self).__init__("Your email '{0}' is too long. Email address must be short than {1} characters.".format(email,max_chars))        
         
+class UnknownBackendError(Error):
+    def __init__(self, backend_name):
+        super(self.__class__, self).__init__("Storage backend '{0}' is unknown, use one of: {1}.".format(backend_name, ", ".join(sorted(_BACKENDS))))
+
+class BackendNotAvailableError(Error):
+    def __init__(self, backend_name, module_name):
+        super(self.__class__, self).__init__("Storage backend '{0}' needs the module '{1}', which is not installed.".format(backend_name, module_name))
+        
+class UnknownLoginAttemptStorageError(Error):
+    def __init__(self, storage):
+        super(self.__class__, self).__init__("Login attempt storage '{0}' is unknown, use rows or buckets.".format(storage))
+        
 class DbConnectionConfig(object):
     def __init__(self, db_host, db_user, db_password, db_catalog):
         self.db_host = db_host
@@ -17,158 +49,696 @@ class DbConnectionConfig(object):
         self.db_password = db_password
         self.db_catalog = db_catalog
         
+class LoginState(object):
+    def __init__(self, user_id, is_activated, salt, password, failed_attempts):
+        self.user_id = user_id
+        self.is_activated = is_activated
+        self.salt = salt
+        self.password = password
+        self.failed_attempts = failed_attempts
+        
+class UserRecord(object):
+    def __init__(self, user_id, is_activated, salt, password, activation_token_requested):
+        self.user_id = user_id
+        self.is_activated = is_activated
+        self.salt = salt
+        self.password = password
+        # unix timestamp or None
+        self.activation_token_requested = activation_token_requested
+        
+    def copy(self, **changes):
+        record = UserRecord(self.user_id, self.is_activated, self.salt, self.password, self.activation_token_requested)
+        for name, value in changes.items():
+            setattr(record, name, value)
+        return record
+        
+    def get_login_state(self):
+        return LoginState(self.user_id, self.is_activated, self.salt, self.password, None)
+        
+class UserSummary(object):
+    def __init__(self, user_id, email, is_activated, created, last_failed_attempt):
+        self.user_id = user_id
+        self.email = email
+        self.is_activated = is_activated
+        # unix timestamps, last_failed_attempt is None if there was none recently
+        self.created = created
+        self.last_failed_attempt = last_failed_attempt
+        
+class MySqlDialect(object):
+    name = 'mysql'
+    # the most placeholders of one statement (of a prepared statement, MySQLdb fills them in client side)
+    max_variables = 65535
+    
+    def now(self):
+        return "NOW()"
+        
+    def seconds_ago(self):
+        # expects the number of seconds as parameter
+        return "DATE_SUB(NOW(), INTERVAL %s SECOND)"
+        
+    def age_in_seconds(self, column):
+        return "TIMESTAMPDIFF(SECOND, {0}, NOW())".format(column)
+        
+    def delete_batch(self, table, condition):
+        # expects the parameters of the condition followed by the batch size
+        return "DELETE FROM {0} WHERE {1} LIMIT %s".format(table, condition)
+        
+    def count_schema_objects(self, kind):
+        # expects the name of the table or index as parameter
+        if kind == 'index':
+            return "SELECT COUNT(*) FROM information_schema.statistics WHERE table_schema = DATABASE() AND index_name = %s"
+        return "SELECT COUNT(*) FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s"
+        
+    def lock_schema(self):
+        return "SELECT GET_LOCK('simple_auth_schema', 60)"
+        
+    def is_schema_locked(self, result):
+        # GET_LOCK returns 1 if the lock was obtained, 0 after the timeout and NULL on an error
+        return result == 1
+        
+    def unlock_schema(self):
+        return "SELECT RELEASE_LOCK('simple_auth_schema')"
+        
+    def abort_schema_change(self):
+        # DDL statements commit implicitly in MySQL, there is nothing to roll back
+        return self.unlock_schema()
+        
 class DbConnection(object): 
-    is_connected = None
-    db_connection = None
+    dialect = MySqlDialect()
     
-    def __init__(self, db_connection_config):
+    def __init__(self, db_connection_config, pool_config = None, pool = None):
         self.db_host = db_connection_config.db_host
         self.db_user = db_connection_config.db_user
         self.db_password = db_connection_config.db_password
         self.db_catalog = db_connection_config.db_catalog
+        # a pool passed in is shared with the connections to other catalogs of the server
+        self.pool = pool or ConnectionPool(pool_config or PoolConfig(), self._open_connection, self._close_connection, self._ping_connection)
+        self.statements = StatementCache(self.dialect)
+        self._local = threading.local()
+    
+    def get_db_connection(self):
+        return getattr(self._local, 'connection', None)
+        
+    db_connection = property(get_db_connection)
+    
+    def warm_up(self):
+        self.pool.warm_up()
     
     def connect(self):
+        # pins a pooled connection to the current thread until close() is called
         if not self.is_connected():
-            self.db_connection = MySQLdb.connect(
-                self.db_host, 
-                self.db_user,
-                self.db_password,
-                self.db_catalog
-            )
+            self._local.connection = self._borrow()
     
     def execute_query_row(self, sql, params = None, keep_connection_open = False):
-        return self.__query(sql, params,'row')
+        return self.__query(sql, params,'row', keep_connection_open)
      
     def execute_query_all(self, sql, params = None, keep_connection_open = False):
-        return self.__query(sql, params,'all')
+        return self.__query(sql, params,'all', keep_connection_open)
     
     def execute_scalar(self, sql, params = None, keep_connection_open = False):
-        row = self.__query(sql, params,'row')
+        row = self.__query(sql, params,'row', keep_connection_open)
         if row:
             return row[0]
         return None        
     
     def execute_non_query(self, sql, params = None, keep_connection_open = False):
-        self.__query(sql, params)
+        # returns the number of affected rows
+        return self.__query(sql, params, 'rowcount', keep_connection_open)
     
     def __query(self, sql, params = None, returnValue = None, keep_connection_open = False):
-        try:
+        if keep_connection_open:
             self.connect()
-            cursor = self.db_connection.cursor()
-            cursor.execute(sql, params)        
-            result = {
-                'row' : cursor.fetchone(),
-                'all' : cursor.fetchall()
-            }
-            return result.get(returnValue)
+        is_pinned = self.is_connected()
+        connection = self.db_connection if is_pinned else self._borrow()
+        is_broken = False
+        try:
+            cursor = connection.cursor()
+            try:
+                statement_name = self.statements.record_execution(sql)
+                with self._get_query_timer(statement_name or sql):
+                    cursor.execute(*self._prepare_query(sql, params))
+                    if returnValue == 'row':
+                        return cursor.fetchone()
+                    if returnValue == 'all':
+                        return cursor.fetchall()
+                    return cursor.rowcount
+            finally:
+                cursor.close()
+        except self._get_connection_errors():
+            is_broken = True
+            metrics.registry.inc('db_connection_errors_total')
+            raise
         finally:
-            if not keep_connection_open:
-                self.close()
+            if is_broken and is_pinned:
+                self._local.connection = None
+            if is_broken or not is_pinned:
+                self.pool.give_back(connection, is_broken)
+        
+    def execute_query_iter(self, sql, params = None, batch_size = 1000):
+        # yields the rows of a server side cursor, fetched batch_size rows at a time; the cursor gets
+        # a pooled connection of its own, which goes back when the generator is exhausted or closed
+        connection = self._borrow()
+        is_broken = False
+        try:
+            cursor = self._open_streaming_cursor(connection)
+            try:
+                self.statements.record_execution(sql)
+                cursor.execute(*self._prepare_query(sql, params))
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield row
+            finally:
+                cursor.close()
+        except self._get_connection_errors():
+            is_broken = True
+            metrics.registry.inc('db_connection_errors_total')
+            raise
+        finally:
+            self.pool.give_back(connection, is_broken)
         
     def close(self):
         if self.is_connected():
-            self.db_connection.close()
-            self.db_connection = None
+            connection = self.db_connection
+            self._local.connection = None
+            self.pool.give_back(connection)
         
     def is_connected(self):
         if self.db_connection:
             return True
         return False
+    
+    def dispose(self):
+        self.close()
+        self.pool.close()
+        
+    def _prepare_query(self, sql, params):
+        return sql, params
+        
+    def _borrow(self):
+        connection = self.pool.borrow()
+        try:
+            self._select_catalog(connection)
+        except self._get_connection_errors():
+            self.pool.give_back(connection, True)
+            raise
+        return connection
+        
+    def _select_catalog(self, connection):
+        # a shared pool serves the catalogs of the server, the one a connection is on is noted on it
+        if getattr(connection, 'selected_catalog', None) != self.db_catalog:
+            connection.select_db(self.db_catalog)
+            connection.selected_catalog = self.db_catalog
+        
+    def _get_query_timer(self, statement_name_or_sql):
+        if not metrics.registry.enabled:
+            return metrics.registry.timer(None)
+        return metrics.registry.timer('db_query_seconds', statement = _get_statement_label(statement_name_or_sql))
+        
+    def _get_connection_errors(self):
+        # errors after which a connection must not go back into the pool
+        return (MySQLdb.OperationalError, MySQLdb.InterfaceError)
+        
+    def _open_streaming_cursor(self, connection):
+        # SSCursor leaves the result on the server instead of buffering it in the client
+        return connection.cursor(MySQLdb.cursors.SSCursor)
+        
+    def _open_connection(self):
+        if MySQLdb is None:
+            raise BackendNotAvailableError('mysql', 'MySQLdb')
+        connection = MySQLdb.connect(
+            self.db_host, 
+            self.db_user,
+            self.db_password,
+            self.db_catalog
+        )
+        # pooled connections live longer than a single query, without autocommit
+        # every connection would keep its own snapshot of the tables
+        connection.autocommit(True)
+        connection.selected_catalog = self.db_catalog
+        return connection
+    
+    def _close_connection(self, connection):
+        connection.close()
+        
+    def _ping_connection(self, connection):
+        connection.ping()
 
-class DbContext(object):    
-    def __init__(self, config):
+_IN_LIST = re.compile(r"IN \((%s, )*%s\)")
+_statement_labels = {}
+
+def _get_statement_label(sql):
+    # multi-row INSERTs and IN lists differ in length only, they must not end up as separate metrics
+    label = _statement_labels.get(sql)
+    if label is None:
+        label = _IN_LIST.sub("IN (...)", sql.split(" VALUES ")[0] + (" VALUES ..." if " VALUES " in sql else ""))
+        if len(_statement_labels) > 1000:
+            _statement_labels.clear()
+        _statement_labels[sql] = label
+    return label
+
+class MySqlBackend(object):
+    """Storage backends provide the user and login_attempt repositories of a DbContext.
+    
+    Other backends (see sqlite_database and memory_database) offer the same attributes
+    and are selected by the db_backend config option.
+    """
+    def __init__(self, config, pool_config, password_hasher, pool = None):
+        # a pool passed in is shared with other backends and not closed by close()
+        self._owns_pool = pool is None
+        self.db_connection = self.create_connection(config, pool_config, pool)
+        self.user = User(self.db_connection, password_hasher)
+        self.login_attempt = create_login_attempt(self.db_connection, config)
+        self.session = UserSession(self.db_connection)
+        
+    @staticmethod
+    def get_endpoint(config):
+        # configurations with the same endpoint can share one connection pool, the catalog is selected per checkout
+        return ('mysql', config.db_host, config.db_user, config.db_password)
+
+    @staticmethod
+    def create_connection(config, pool_config, pool = None):
         connection_config = DbConnectionConfig(
             config.db_host,
             config.db_user,
             config.db_password,
             config.db_catalog
         )
-        self.db_connection = DbConnection(connection_config)
-        self.user = User(self.db_connection)
-        self.login_attempt = LoginAttempt(self.db_connection)     
+        db_connection = DbConnection(connection_config, pool_config, pool)
+        db_connection.warm_up()
+        return db_connection
+        
+    def close(self):
+        if self._owns_pool:
+            self.db_connection.dispose()
+        else:
+            self.db_connection.close()
+
+def create_login_attempt(db_connection, config):
+    # the login_attempts repository of the SQL backends, selected by login_attempt_storage
+    if config.login_attempt_storage == 'buckets':
+        return BucketedLoginAttempt(db_connection, config.login_attempt_bucket_seconds)
+    if config.login_attempt_storage != 'rows':
+        raise UnknownLoginAttemptStorageError(config.login_attempt_storage)
+    return LoginAttempt(db_connection)
+
+_BACKENDS = {
+    'mysql' : ('database', 'MySqlBackend'),
+    'sqlite' : ('sqlite_database', 'SqliteBackend'),
+    'memory' : ('memory_database', 'MemoryBackend')
+}
+
+def get_backend_class(backend_name):
+    # backends are imported on first use, so only the selected one needs its driver
+    if backend_name not in _BACKENDS:
+        raise UnknownBackendError(backend_name)
+    module_name, class_name = _BACKENDS[backend_name]
+    module = __import__(module_name)
+    return getattr(module, class_name)
+
+class DbContext(object):    
+    def __init__(self, config, resources = None):
+        pool_config = PoolConfig(
+            config.db_pool_min_size,
+            config.db_pool_max_size,
+            config.db_pool_idle_timeout,
+            config.db_pool_borrow_timeout,
+            config.db_pool_check_on_borrow
+        )
+        kdf_config = crypto.KdfConfig(
+            config.password_kdf,
+            config.password_kdf_iterations,
+            config.password_kdf_scrypt_n,
+            config.password_kdf_scrypt_r,
+            config.password_kdf_scrypt_p,
+            config.password_kdf_workers
+        )
+        self.password_hasher = crypto.PasswordHasher(kdf_config)
+        # what close() releases, set as soon as it exists so a failing setup can be undone
+        self._resources = None
+        self._shared_pool = None
+        self.backend = None
+        self.email_index = None
+        self.pruner = None
+        self.shared_lockout = None
+        self.login_attempt = None
+        try:
+            self._open(config, pool_config, resources)
+        except:
+            exc_info = sys.exc_info()
+            try:
+                self.close()
+            except Exception:
+                # the error of the setup is the one to report
+                pass
+            raise exc_info[0], exc_info[1], exc_info[2]
+        
+    def _open(self, config, pool_config, resources):
+        backend_class = get_backend_class(config.db_backend)
+        # with tenants.SharedResources, configurations of the same database share the connection pool
+        endpoint = backend_class.get_endpoint(config)
+        if resources and endpoint:
+            self._shared_pool = resources.acquire(endpoint, lambda: backend_class.create_connection(config, pool_config).pool, lambda pool: pool.close())
+            self._resources = resources
+        self.backend = backend_class(config, pool_config, self.password_hasher, self._shared_pool)
+        self.db_connection = self.backend.db_connection
+        if self.db_connection is not None:
+            apply_schema_mode(self.db_connection, config.db_schema_mode)
+        self.user = self.backend.user
+        self.login_attempt = self.backend.login_attempt
+        self.session = self.backend.session
+        self.login_attempt_storage = config.login_attempt_storage
+        self.user_cache = None
+        if config.user_cache_size > 0:
+            self.user_cache = LruTtlCache(config.user_cache_size, config.user_cache_ttl, 'user')
+            self.user = CachedUser(self.user, self.user_cache, self.password_hasher)
+        if config.email_index:
+            index_config = EmailIndexConfig(
+                config.email_index_error_rate,
+                config.email_index_refresh_interval,
+                config.email_index_rebuild_interval,
+                refresh_overlap = config.email_index_refresh_overlap
+            )
+            self.email_index = EmailIndex(self.user, index_config)
+            self.user = EmailIndexedUser(self.user, self.email_index)
+        # the single query login counts rows of login_attempts, other storages are asked separately
+        self._counts_attempts_in_db = self.db_connection is None or config.login_attempt_storage == 'rows'
+        self._write_behind = None
+        if config.login_attempt_write_behind:
+            write_behind_config = WriteBehindConfig(
+                config.login_attempt_batch_size,
+                config.login_attempt_buffer_size,
+                config.login_attempt_flush_interval,
+                # three parameters per row in login_attempt_buckets, two in login_attempts
+                self.get_max_rows(3)
+            )
+            self._write_behind = WriteBehindLoginAttempt(self.login_attempt, write_behind_config)
+            self.login_attempt = self._write_behind
+        if self.db_connection is not None and config.login_attempt_prune_interval > 0:
+            retention_config = RetentionConfig(
+                config.login_attempt_prune_batch_size,
+                config.login_attempt_prune_interval,
+                bucket_seconds = config.login_attempt_bucket_seconds
+            )
+            self.pruner = RetentionPruner(self.db_connection, config.login_attempt_expire, retention_config)
+            self.pruner.start()
+        if config.lockout_shm_path:
+            lockout_config = SharedLockoutConfig(
+                config.lockout_shm_path,
+                config.lockout_shm_slots,
+                config.login_max_attempts,
+                config.lockout_persist_interval,
+                # three parameters per row in login_attempt_buckets, two in login_attempts
+                self.get_max_rows(3),
+                config.lockout_max_pending
+            )
+            self.shared_lockout = SharedLockoutTracker(self.login_attempt, lockout_config, config.login_attempt_expire)
+            self.login_attempt = self.shared_lockout
+            self._counts_attempts_in_db = False
+        
+    def get_max_rows(self, column_count):
+        # the most rows one multi-row statement with column_count parameters per row can take, None for no limit
+        if self.db_connection is None:
+            return None
+        return max(self.db_connection.dialect.max_variables // column_count, 1)
+        
+    def get_login_state(self, email, login_attempt_expire):
+        if self._counts_attempts_in_db:
+            state = self.user.get_login_state(email, login_attempt_expire)
+            if self._write_behind:
+                state.failed_attempts += self._write_behind.get_buffered_count(email, login_attempt_expire)
+            return state
+        state = self.user.get_login_state(email, login_attempt_expire, False)
+        state.failed_attempts = self.login_attempt.get_count(email, login_attempt_expire)
+        return state
+        
+    def close(self):
+        if self.email_index:
+            self.email_index.close()
+        if self.pruner:
+            self.pruner.stop()
+        if self.login_attempt:
+            self.login_attempt.close()
+        if self.backend:
+            self.backend.close()
+        if self._resources:
+            self._resources.release(self._shared_pool)
+        self.password_hasher.close()
         
 class LoginAttempt(object):   
     def __init__(self, db_connection):
         self._db_connection = db_connection
+        self._sql = db_connection.statements.get_sql
         
     def log_failed_attempt(self, email):
-        self._db_connection.execute_non_query(
-            "INSERT INTO login_attempts (login) VALUES (%s)", email
-        )
+        self._db_connection.execute_non_query(self._sql('login_attempt.insert'), email)
+        
+    def log_failed_attempts(self, attempts):
+        # attempts are (email, unix timestamp) tuples, written with a single multi-row INSERT;
+        # the age is used instead of the timestamp so that the clock of the database stays the reference
+        if not attempts:
+            return
+        now = time.time()
+        params = []
+        for email, timestamp in attempts:
+            params.extend((email, max(int(now - timestamp), 0)))
+        self._db_connection.execute_non_query(self._sql('login_attempt.insert_many', len(attempts)), params)
+        
+    def get_recent_attempts(self, login_attempt_expire):
+        now = time.time()
+        rows = self._db_connection.execute_query_all(self._sql('login_attempt.recent'), login_attempt_expire)
+        return [(row[0], now - int(row[1])) for row in rows]
      
     def is_locked_out(self, email, login_attempt_expire, login_max_attempts):
         if self.get_count(email, login_attempt_expire) >= login_max_attempts:
             return True
         return False
             
+    def get_count(self, email, login_attempt_expire):
+        result = self._db_connection.execute_scalar(self._sql('login_attempt.count'), (email, login_attempt_expire))
+        return int(result)
+        
+    def close(self):
+        # every attempt is written immediately, nothing to flush
+        pass
+        
+class BucketedLoginAttempt(object):
+    """Counts failed logins per email in buckets of bucket_seconds instead of one row per attempt.
+
+    Offers the same interface as LoginAttempt. An attempt increments the counter
+    of its bucket with an upsert, so a count sums at most
+    login_attempt_expire / bucket_seconds + 1 rows. The oldest bucket is counted
+    as a whole, attempts are therefore counted up to bucket_seconds longer than
+    login_attempt_expire.
+    """
+    def __init__(self, db_connection, bucket_seconds = 300):
+        self._db_connection = db_connection
+        self._sql = db_connection.statements.get_sql
+        self.bucket_seconds = int(bucket_seconds)
+        
+    def log_failed_attempt(self, email):
+        self.log_failed_attempts([(email, time.time())])
+        
+    def log_failed_attempts(self, attempts):
+        counts = {}
+        for email, timestamp in attempts:
+            key = (email, self._get_bucket(timestamp))
+            counts[key] = counts.get(key, 0) + 1
+        if not counts:
+            return
+        params = []
+        for (email, bucket), count in sorted(counts.items()):
+            params.extend((email, bucket, count))
+        self._db_connection.execute_non_query(self._sql('login_attempt_bucket.add', len(counts)), params)
+        
+    def get_recent_attempts(self, login_attempt_expire):
+        # the attempts of a bucket are reported with the start of the bucket as timestamp
+        rows = self._db_connection.execute_query_all(
+            self._sql('login_attempt_bucket.recent'), self._get_bucket(time.time() - login_attempt_expire)
+        )
+        return [(row[0], int(row[1])) for row in rows for i in range(int(row[2]))]
+        
+    def is_locked_out(self, email, login_attempt_expire, login_max_attempts):
+        if self.get_count(email, login_attempt_expire) >= login_max_attempts:
+            return True
+        return False
+        
     def get_count(self, email, login_attempt_expire):
         result = self._db_connection.execute_scalar(
-            "SELECT COUNT(id) FROM login_attempts WHERE login = %s AND timestamp > DATE_SUB(NOW(), INTERVAL %s SECOND)",
-            (email, login_attempt_expire)
+            self._sql('login_attempt_bucket.count'), (email, self._get_bucket(time.time() - login_attempt_expire))
         )
-        return int(result)
+        return int(result or 0)
         
-class User(object):
+    def close(self):
+        pass
+        
+    def _get_bucket(self, timestamp):
+        return int(timestamp) // self.bucket_seconds * self.bucket_seconds
+        
+class UserSession(object):
+    # expiry and revocation times are unix timestamps of the application servers
+    _TOUCH_CHUNK_SIZE = 500
+
     def __init__(self, db_connection):
         self._db_connection = db_connection
+        self._sql = db_connection.statements.get_sql
+
+    def create(self, session_id, user_id, email, expires):
+        self._db_connection.execute_non_query(self._sql('session.insert'), (session_id, user_id, email, expires))
+
+    def get(self, session_id):
+        # returns (user_id, email, expires, revoked) or None
+        return self._db_connection.execute_query_row(self._sql('session.get'), session_id)
+
+    def touch(self, session_ids, expires):
+        session_ids = list(session_ids)
+        for start in range(0, len(session_ids), self._TOUCH_CHUNK_SIZE):
+            chunk = session_ids[start:start + self._TOUCH_CHUNK_SIZE]
+            self._db_connection.execute_non_query(self._sql('session.touch', len(chunk)), [expires] + chunk)
+
+    def revoke(self, session_id, now):
+        self._db_connection.execute_non_query(self._sql('session.revoke'), (now, session_id))
+
+    def revoke_user(self, user_id, now):
+        # returns the (session_id, expires) tuples of the revoked sessions
+        sessions = self._db_connection.execute_query_all(self._sql('session.active_of_user'), (user_id, now))
+        self._db_connection.execute_non_query(self._sql('session.revoke_user'), (now, user_id))
+        return [(row[0], row[1]) for row in sessions]
+
+    def get_revoked_since(self, since, now):
+        rows = self._db_connection.execute_query_all(self._sql('session.revoked_since'), (since, now))
+        return [(row[0], row[1]) for row in rows]
+
+class User(object):
+    def __init__(self, db_connection, password_hasher):
+        self._db_connection = db_connection
+        self._sql = db_connection.statements.get_sql
+        self._password_hasher = password_hasher
 
     def is_activated(self, email, keep_connection_open = False):
-        return self._db_connection.execute_scalar("SELECT is_activated FROM users WHERE email = %s LIMIT 1", email, keep_connection_open)   
+        return self._db_connection.execute_scalar(self._sql('user.is_activated'), email, keep_connection_open)   
     
     def exists(self, email, keep_connection_open = False):
-        value = self._db_connection.execute_scalar("SELECT id FROM users WHERE email = %s LIMIT 1", email, keep_connection_open)
+        value = self._db_connection.execute_scalar(self._sql('user.exists'), email, keep_connection_open)
         return value is not None
         
     def create(self, email, password):
         if self.exists(email):
             raise EmailAlreadyInUseError(email)
-        if len(email) > 100:
-            raise EmailTooLongError(email, 100)
+        if len(email) > MAX_EMAIL_LENGTH:
+            raise EmailTooLongError(email, MAX_EMAIL_LENGTH)
         activation_token = crypto.create_activation_token()
         salt = crypto.create_salt()
-        hashed_password = crypto.create_hash(password,salt)
-        self._db_connection.execute_non_query(
-            ("INSERT INTO users (email, password, salt, activation_token, activation_token_requested, created)"
-            "VALUES (%s, %s, %s, %s, NOW(), NOW())"),
-            (email, hashed_password, salt, activation_token)
-        )
+        hashed_password = self._password_hasher.hash(password, salt)
+        self._db_connection.execute_non_query(self._sql('user.insert'), (email, hashed_password, salt, activation_token))
         return activation_token
     
+    def find_existing(self, emails):
+        if not emails:
+            return set()
+        rows = self._db_connection.execute_query_all(self._sql('user.find_existing', len(emails)), list(emails))
+        return set(row[0] for row in rows)
+        
+    def create_many(self, users):
+        # users are (email, hashed_password, salt, activation_token, is_activated) tuples
+        if not users:
+            return
+        params = []
+        for user in users:
+            params.extend(user)
+        self._db_connection.execute_non_query(self._sql('user.insert_many', len(users)), params)
+        
+    def get_record(self, email):
+        now = time.time()
+        row = self._db_connection.execute_query_row(self._sql('user.record'), email)
+        if row is None:
+            return None
+        activation_token_requested = now - int(row[4]) if row[4] is not None else None
+        return UserRecord(row[0], row[1], row[2], row[3], activation_token_requested)
+        
+    def iter_summaries(self, after_id, limit, is_activated = None, login_attempt_storage = 'rows'):
+        # yields up to limit users with an id greater than after_id, ordered by id
+        now = time.time()
+        if login_attempt_storage == 'buckets':
+            sql = self._sql('user.summaries_buckets')
+        else:
+            sql = self._sql('user.summaries')
+        activated = None if is_activated is None else int(bool(is_activated))
+        for row in self._db_connection.execute_query_iter(sql, (after_id, activated, activated, limit)):
+            last_failed_attempt = row[4]
+            if last_failed_attempt is not None and login_attempt_storage != 'buckets':
+                last_failed_attempt = now - int(last_failed_attempt)
+            yield UserSummary(row[0], row[1], row[2], now - int(row[3]), last_failed_attempt)
+        
+    def iter_emails(self, after_id, limit):
+        # yields (id, email) of up to limit users with an id greater than after_id, ordered by id
+        for row in self._db_connection.execute_query_iter(self._sql('user.emails'), (after_id, limit)):
+            yield row[0], row[1]
+
+    def iter_unactivated(self, after_id, limit, created_after, created_before):
+        # yields (id, email) of up to limit users which are not activated, created within the window (unix timestamps)
+        now = time.time()
+        params = (after_id, max(int(now - created_after), 0), max(int(now - created_before), 0), limit)
+        for row in self._db_connection.execute_query_iter(self._sql('user.unactivated'), params):
+            yield row[0], row[1]
+
+    def renew_activation_tokens(self, users):
+        # users are (id, email, activation_token) tuples, users activated meanwhile are skipped;
+        # at most max_variables / 3 users per call (see DbContext.get_max_rows)
+        if not users:
+            return
+        params = []
+        for user_id, email, activation_token in users:
+            params.extend((user_id, activation_token))
+        params.extend(user[0] for user in users)
+        self._db_connection.execute_non_query(self._sql('user.renew_activation_tokens', len(users)), params)
+
     def renew_activation_token(self, email):
         if not self.exists(email):
             return
         if self.is_activated(email):
             return
+        return self._update_activation_token(email)
+        
+    def _update_activation_token(self, email):
         activation_token = crypto.create_activation_token()
-        self._db_connection.execute_non_query(
-            ("UPDATE users SET activation_token = %s, activation_token_requested = NOW()"
-            "WHERE email = %s"), (activation_token, email)
-        )
+        self._db_connection.execute_non_query(self._sql('user.update_activation_token'), (activation_token, email))
         return activation_token
     
     def activate(self, email, activation_token, email_activation_expire):
-        token = self._db_connection.execute_scalar(
-            "SELECT activation_token FROM users WHERE email = %s AND activation_token_requested > DATE_SUB(NOW(), INTERVAL %s SECOND)", 
-            (email, email_activation_expire)
-        )
+        token = self._db_connection.execute_scalar(self._sql('user.activation_token'), (email, email_activation_expire))
         if not token == activation_token:
             return False
-        self._db_connection.execute_non_query(
-            "UPDATE users SET is_activated = 1 WHERE email = %s", email
-        )
+        self._db_connection.execute_non_query(self._sql('user.activate'), email)
         return True
+        
+    def mark_activated(self, email):
+        # for activation tokens which have been verified without the database, returns the number of updated users
+        # (0 if there is no such user, but also on MySQL if the user was activated already)
+        return self._db_connection.execute_non_query(self._sql('user.activate'), email)
     
     def login(self, email, password):
-        try:
-            salt = self._get_salt_from_db(email, True)
-            hashed_password = crypto.create_hash(password, salt)
-            result = self._db_connection.execute_scalar(
-                "SELECT id FROM users WHERE email = %s AND password = %s LIMIT 1",
-                (email, hashed_password)
-            )            
-        finally:
-            self._db_connection.close()
-        return result is not None       
+        # the stored hash carries the parameters it was created with, so it is verified in Python
+        row = self._db_connection.execute_query_row(self._sql('user.password'), email)
+        if row is None or not self._password_hasher.verify(password, row[0], row[1]):
+            return False
+        if self._password_hasher.needs_rehash(row[1]):
+            self.update_password_hash(email, self._password_hasher.hash(password, row[0]))
+        return True
+        
+    def update_password_hash(self, email, hashed_password):
+        self._db_connection.execute_non_query(self._sql('user.update_password'), (hashed_password, email))
+        
+    def get_login_state(self, email, login_attempt_expire, include_failed_attempts = True):
+        if not include_failed_attempts:
+            row = self._db_connection.execute_query_row(self._sql('user.login_state'), email) or (None, None, None, None)
+            return LoginState(row[0], row[1], row[2], row[3], None)
+        row = self._db_connection.execute_query_row(
+            self._sql('user.login_state_with_attempts'), (email, login_attempt_expire, email)
+        )
+        return LoginState(row[0], row[1], row[2], row[3], int(row[4]))
         
     def _get_salt_from_db(self, email, keep_connection_open = False):
-        return self._db_connection.execute_scalar("SELECT salt FROM users WHERE email = %s LIMIT 1", email, keep_connection_open)    
\ No newline at end of file
+        return self._db_connection.execute_scalar(self._sql('user.salt'), email, keep_connection_open)    
\ No newline at end of file
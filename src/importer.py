@@ -0,0 +1,143 @@
+import itertools
+import multiprocessing
+import crypto
+import validator
+from database import MAX_EMAIL_LENGTH
+from outbox import get_batch_dispatcher
+
+class ImportStatus:
+    CREATED = 1
+    ALREADY_EXISTS = 2
+    DUPLICATE_IN_IMPORT = 3
+    EMAIL_IS_INVALID = 4
+    EMAIL_TOO_LONG = 5
+    PASSWORD_TOO_SHORT = 6
+
+class ImportMailMode:
+    # send the activation mails right away
+    SEND = 1
+    # store the activation tokens, but leave sending the mails to the caller (e.g. resend_activation_email)
+    DEFER = 2
+    # import the users as already activated, no activation mail is needed
+    SKIP = 3
+
+class ImportResult(object):
+    def __init__(self, email, status):
+        self.email = email
+        self.status = status
+        self.activation_token = None
+        # the exception if the activation mail could not be sent
+        self.mail_error = None
+
+class UserImporter(object):
+    """Creates users from an iterable of (email, password) records, chunk by chunk.
+
+    Per chunk the emails are validated in one pass, checked for existing users
+    with a single query, hashed (in hash_workers processes if more than one),
+    inserted with a single multi-row INSERT and sent their activation mails
+    through one SMTP session. Chunks are capped so that the INSERT stays within
+    the parameter limit of the database.
+    """
+    def __init__(self, auth_handler, chunk_size = 500, mail_mode = ImportMailMode.SEND, hash_workers = 0):
+        self._auth_handler = auth_handler
+        self._user_repository = auth_handler.db_context.user
+        self._password_hasher = auth_handler.db_context.password_hasher
+        max_rows = auth_handler.db_context.get_max_rows(5)
+        self.chunk_size = min(chunk_size, max_rows) if max_rows else chunk_size
+        self.mail_mode = mail_mode
+        self.hash_workers = hash_workers
+
+    def run(self, records):
+        # yields one ImportResult per record, in the order of the records
+        process_pool = multiprocessing.Pool(self.hash_workers) if self.hash_workers > 1 else None
+        try:
+            records = iter(records)
+            while True:
+                chunk = list(itertools.islice(records, self.chunk_size))
+                if not chunk:
+                    return
+                for result in self._import_chunk(chunk, process_pool):
+                    yield result
+        finally:
+            if process_pool:
+                process_pool.terminate()
+                process_pool.join()
+
+    def _import_chunk(self, chunk, process_pool):
+        results = [ImportResult(email, None) for email, password in chunk]
+        min_length = int(self._auth_handler.settings.password_min_length)
+        invalid_emails = validator.get_invalid_emails(email for email, password in chunk)
+        candidates = []
+        seen = set()
+        for result, (email, password) in zip(results, chunk):
+            if email in invalid_emails:
+                result.status = ImportStatus.EMAIL_IS_INVALID
+            elif len(email) > MAX_EMAIL_LENGTH:
+                result.status = ImportStatus.EMAIL_TOO_LONG
+            elif len(password) < min_length:
+                result.status = ImportStatus.PASSWORD_TOO_SHORT
+            elif email in seen:
+                result.status = ImportStatus.DUPLICATE_IN_IMPORT
+            else:
+                seen.add(email)
+                candidates.append((result, password))
+
+        existing = self._user_repository.find_existing([result.email for result, password in candidates])
+        new_users = []
+        for result, password in candidates:
+            if result.email in existing:
+                result.status = ImportStatus.ALREADY_EXISTS
+            else:
+                new_users.append((result, password, crypto.create_salt()))
+
+        hashes = self._password_hasher.hash_many([(password, salt) for result, password, salt in new_users], process_pool)
+        is_activated = 1 if self.mail_mode == ImportMailMode.SKIP else 0
+        rows = []
+        for (result, password, salt), hashed_password in zip(new_users, hashes):
+            result.activation_token = crypto.create_activation_token()
+            rows.append((result.email, hashed_password, salt, result.activation_token, is_activated))
+        self._insert(rows, [result for result, password, salt in new_users])
+
+        if self.mail_mode == ImportMailMode.SEND:
+            self._send_activation_mails(results)
+        return results
+
+    def _insert(self, rows, results):
+        try:
+            self._user_repository.create_many(rows)
+        except Exception:
+            # most likely someone registered one of the emails since the check,
+            # insert row by row to find out which ones
+            for row, result in zip(rows, results):
+                try:
+                    self._user_repository.create_many([row])
+                except Exception:
+                    if not self._user_repository.exists(result.email):
+                        raise
+                    result.status = ImportStatus.ALREADY_EXISTS
+                    result.activation_token = None
+        for result in results:
+            if result.status is None:
+                result.status = ImportStatus.CREATED
+
+    def _send_activation_mails(self, results):
+        created = [result for result in results if result.status == ImportStatus.CREATED]
+        if not created:
+            return
+        settings = self._auth_handler.settings
+        token_signer = self._auth_handler.token_signer
+        messages = []
+        for result in created:
+            activation_token = token_signer.create(result.email) if token_signer else result.activation_token
+            messages.append((
+                settings.mail_from,
+                result.email,
+                settings.mail_subject,
+                {"{ACTIVATION_TOKEN}": activation_token, "{EMAIL_IDENTIFIER}": crypto.b64_encode(result.email)}
+            ))
+        try:
+            errors = get_batch_dispatcher(self._auth_handler.mail_dispatcher).send_many(messages)
+        except Exception, e:
+            errors = [e] * len(created)
+        for result, error in zip(created, errors):
+            result.mail_error = error
@@ -0,0 +1,255 @@
+import os
+import mmap
+import fcntl
+import struct
+import hashlib
+import threading
+import time
+from exception import Error
+
+class SegmentMismatchError(Error):
+    def __init__(self, path):
+        super(self.__class__, self).__init__("Lockout segment '{0}' has other dimensions (lockout_shm_slots, login_max_attempts) or is no lockout segment, use another lockout_shm_path.".format(path))
+
+class SharedLockoutConfig(object):
+    def __init__(self, path, slot_count = 65536, ring_size = 5, persist_interval = 5, max_rows = None, max_pending = 10000):
+        self.path = path
+        self.slot_count = slot_count
+        self.ring_size = ring_size
+        self.persist_interval = persist_interval
+        # the most attempts written with one statement (see DbContext.get_max_rows), None for no limit
+        self.max_rows = max_rows
+        # the most attempts waiting for the database, the oldest are dropped while it is not reachable
+        self.max_pending = max_pending
+
+class _Segment(object):
+    """Fixed size hash table of failure timestamps in a memory mapped file.
+
+    Every slot holds an 8 byte key (part of the sha1 of the email), the position of
+    the next write and a ring of the last ring_size failure timestamps, which is
+    all it takes to decide if ring_size failures happened within a time window.
+    All access is serialized by an exclusive flock on the file, so every process
+    on the host which maps the same file sees the same counters.
+    """
+    MAGIC = 'SALK'
+    VERSION = 1
+    HEADER = struct.Struct('<4sIII')
+    SLOT_HEAD = struct.Struct('<8sI')
+    MAX_PROBES = 16
+
+    def __init__(self, path, slot_count, ring_size):
+        self.slot_count = slot_count
+        self.ring_size = ring_size
+        self._ring = struct.Struct('<{0}I'.format(ring_size))
+        self._slot_size = self.SLOT_HEAD.size + self._ring.size
+        self._size = self.HEADER.size + slot_count * self._slot_size
+        self._path = path
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            self.is_new = self._initialize()
+        except:
+            os.close(self._fd)
+            raise
+        self._map = mmap.mmap(self._fd, self._size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+
+    def _initialize(self):
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            expected = self.HEADER.pack(self.MAGIC, self.VERSION, self.slot_count, self.ring_size)
+            size = os.fstat(self._fd).st_size
+            header = os.read(self._fd, self.HEADER.size)
+            if size == self._size and header == expected:
+                return False
+            # other processes may have mapped a segment with other dimensions, resizing it under them
+            # would crash them with SIGBUS; only new files and ones whose initialization was cut short are set up
+            if size and header.strip('\0'):
+                raise SegmentMismatchError(self._path)
+            os.ftruncate(self._fd, 0)
+            os.ftruncate(self._fd, self._size)
+            os.lseek(self._fd, 0, os.SEEK_SET)
+            os.write(self._fd, expected)
+            return True
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def __enter__(self):
+        if os.getpid() != self._pid:
+            self._reopen_after_fork()
+        self._lock.acquire()
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._lock.release()
+
+    def add(self, key, timestamp):
+        # has to be called within the with block
+        offset = self._find(key, True)
+        stored_key, position = self.SLOT_HEAD.unpack_from(self._map, offset)
+        ring = list(self._ring.unpack_from(self._map, offset + self.SLOT_HEAD.size))
+        if stored_key != key:
+            ring = [0] * self.ring_size
+            position = 0
+        ring[position] = timestamp
+        self.SLOT_HEAD.pack_into(self._map, offset, key, (position + 1) % self.ring_size)
+        self._ring.pack_into(self._map, offset + self.SLOT_HEAD.size, *ring)
+
+    def count(self, key, since):
+        # has to be called within the with block
+        offset = self._find(key, False)
+        if offset is None:
+            return 0
+        ring = self._ring.unpack_from(self._map, offset + self.SLOT_HEAD.size)
+        return len([timestamp for timestamp in ring if timestamp > since])
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+    def _reopen_after_fork(self):
+        # a forked process shares the open file description with its parent and flock does not
+        # exclude a process from itself, so every process needs a descriptor of its own
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        inherited_fd = self._fd
+        self._fd = os.open(self._path, os.O_RDWR)
+        # closing the inherited descriptor does not affect the parent, which keeps its own
+        os.close(inherited_fd)
+
+    def _find(self, key, claim):
+        start = struct.unpack('<Q', key)[0] % self.slot_count
+        candidate = None
+        candidate_newest = None
+        for probe in range(min(self.MAX_PROBES, self.slot_count)):
+            offset = self.HEADER.size + ((start + probe) % self.slot_count) * self._slot_size
+            stored_key = self._map[offset:offset + 8]
+            if stored_key == key:
+                return offset
+            if not claim:
+                if stored_key == '\0' * 8:
+                    return None
+                continue
+            newest = max(self._ring.unpack_from(self._map, offset + self.SLOT_HEAD.size))
+            if candidate is None or newest < candidate_newest:
+                candidate, candidate_newest = offset, newest
+        if not claim:
+            return None
+        # the key is not stored yet, take the empty slot or the slot with the oldest failures,
+        # which is only a loss if that slot was still within the time window
+        return candidate
+
+class SharedLockoutTracker(object):
+    """Keeps the failed login attempts of all worker processes in a shared memory segment.
+
+    Offers the same interface as database.LoginAttempt, the database only gets
+    the attempts written in batches by a background thread every persist_interval
+    seconds (with a persist_interval of 0 every attempt is written right away),
+    at most max_rows per statement. Up to max_pending attempts wait for the
+    database, lockouts are decided by the segment either way. A new segment gets
+    seeded with the attempts from the database, so lockouts survive restarts.
+    Counts are capped at ring_size, which is the configured login_max_attempts.
+    """
+    def __init__(self, login_attempt, lockout_config, login_attempt_expire):
+        self._login_attempt = login_attempt
+        self.config = lockout_config
+        self._segment = _Segment(lockout_config.path, lockout_config.slot_count, lockout_config.ring_size)
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self._pid = os.getpid()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._thread_pid = None
+        self.last_error = None
+        if self._segment.is_new:
+            self._seed(login_attempt_expire)
+
+    def log_failed_attempt(self, email):
+        self.log_failed_attempts([(email, int(time.time()))])
+
+    def log_failed_attempts(self, attempts):
+        for email, timestamp in attempts:
+            with self._segment:
+                self._segment.add(self._get_key(email), int(timestamp))
+        with self._pending_lock:
+            self._reset_after_fork()
+            self._pending.extend(attempts)
+            del self._pending[:-self.config.max_pending]
+        if self.config.persist_interval > 0:
+            self._ensure_thread()
+            return
+        try:
+            self.flush()
+        except Exception, e:
+            # the lockout is decided by the segment, the attempts are written with the next one
+            self.last_error = e
+
+    def is_locked_out(self, email, login_attempt_expire, login_max_attempts):
+        if self.get_count(email, login_attempt_expire) >= login_max_attempts:
+            return True
+        return False
+
+    def get_count(self, email, login_attempt_expire):
+        since = int(time.time()) - login_attempt_expire
+        with self._segment:
+            return self._segment.count(self._get_key(email), since)
+
+    def flush(self):
+        with self._pending_lock:
+            self._reset_after_fork()
+            pending = self._pending
+            self._pending = []
+        if not pending:
+            return
+        max_rows = self.config.max_rows or len(pending)
+        for i in xrange(0, len(pending), max_rows):
+            try:
+                self._login_attempt.log_failed_attempts(pending[i:i + max_rows])
+            except:
+                with self._pending_lock:
+                    self._pending[0:0] = pending[i:]
+                    del self._pending[:-self.config.max_pending]
+                raise
+
+    def close(self):
+        self._stopped.set()
+        if self._thread and self._thread_pid == os.getpid():
+            self._thread.join()
+        self.flush()
+        self._login_attempt.close()
+        self._segment.close()
+
+    def _ensure_thread(self):
+        # the thread does not survive a fork, every process starts its own on first use
+        with self._pending_lock:
+            if self._thread_pid == os.getpid() or self._stopped.is_set():
+                return
+            self._thread_pid = os.getpid()
+            self._thread = threading.Thread(target = self._run, name = 'lockout-persister')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.config.persist_interval):
+            try:
+                self.flush()
+                self.last_error = None
+            except Exception, e:
+                # the attempts stay pending and are written with the next batch
+                self.last_error = e
+
+    def _seed(self, login_attempt_expire):
+        with self._segment:
+            for email, timestamp in self._login_attempt.get_recent_attempts(login_attempt_expire):
+                self._segment.add(self._get_key(email), int(timestamp))
+
+    def _reset_after_fork(self):
+        # a forked worker inherits the pending attempts of its parent, which will persist them itself
+        if os.getpid() != self._pid:
+            self._pid = os.getpid()
+            self._pending = []
+
+    def _get_key(self, email):
+        return hashlib.sha1(email).digest()[:8]
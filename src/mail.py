@@ -1,8 +1,33 @@
+import codecs
+import os.path
+import random
+import re
 import smtplib
-from email.mime.text import MIMEText
-from email.MIMEMultipart import MIMEMultipart
+import socket
+import sys
+import time
 from email.Header import Header
 from email import Charset
+from cache import LruTtlCache
+from exception import Error
+from pool import ConnectionPool, PoolConfig
+import metrics
+
+# bodies are sent as quoted-printable UTF-8, registered once instead of for every mail
+Charset.add_charset('utf-8', Charset.QP, Charset.QP, 'utf-8')
+_UTF8 = Charset.Charset('utf-8')
+_PART_HEADERS = {
+    'plain': 'MIME-Version: 1.0\nContent-Type: text/plain; charset="utf-8"\nContent-Transfer-Encoding: quoted-printable\n',
+    'html': 'MIME-Version: 1.0\nContent-Type: text/html; charset="utf-8"\nContent-Transfer-Encoding: quoted-printable\n'
+}
+_PREAMBLE = 'This is a multi-part message in MIME format.\n'
+_FROM_LINE = re.compile(r'^From ', re.MULTILINE)
+_PLACEHOLDER = re.compile(r'(\{[A-Za-z0-9_]+\})')
+_TEMPLATE_NAME = re.compile(r'^[A-Za-z0-9_-][A-Za-z0-9_.-]*$')
+
+class UnknownMailTemplateError(Error):
+    def __init__(self, template_name):
+        super(self.__class__, self).__init__("Mail template '{0}' does not exist.".format(template_name))
 
 class MailConfig(object):
     def __init__(self, config):
@@ -13,12 +38,80 @@ class MailConfig(object):
         self.smtp_use_ttls = config.smtp_use_ttls
         self.smtp_user = config.smtp_user
         self.smtp_password = config.smtp_password
+        self.smtp_keep_alive = config.smtp_keep_alive
+        self.smtp_pool_size = config.smtp_pool_size
+        self.smtp_idle_timeout = config.smtp_idle_timeout
+        self.smtp_noop_interval = config.smtp_noop_interval
+        
+    def get_endpoint(self):
+        # configurations with the same endpoint can share their SMTP sessions
+        return ('smtp', self.smtp_host, self.smtp_port, self.smtp_local_hostname, self.smtp_use_ttls, self.smtp_user, self.smtp_password)
+
+class _SmtpSession(object):
+    def __init__(self, server):
+        self.server = server
+        self.last_used = time.time()
 
 class MailDispatcher(object):
-    def __init__(self, mail_config):
+    def __init__(self, mail_config, session_pool = None):
+        # a session_pool passed in is shared with other dispatchers of the same SMTP server and not closed by close()
         self.config = mail_config
+        self._session_pool = session_pool
+        self._owns_session_pool = session_pool is None
+        # ((from_addr, subject), encoded Subject and From headers)
+        self._envelope_cache = None
+        if session_pool is None and mail_config.smtp_keep_alive:
+            self._session_pool = ConnectionPool(
+                PoolConfig(0, mail_config.smtp_pool_size, mail_config.smtp_idle_timeout),
+                self._open_session,
+                self._close_session,
+                self._probe_session,
+                'smtp'
+            )
         
     def send_mail(self, from_addr, receiver_addr, subject, body, body_html = None):
+        try:
+            with metrics.registry.timer('mail_send_seconds'):
+                self._send_mail(from_addr, receiver_addr, subject, body, body_html)
+        except Exception:
+            metrics.registry.inc('mail_send_errors_total')
+            raise
+            
+    def _send_mail(self, from_addr, receiver_addr, subject, body, body_html):
+        msg = self._get_message_string(from_addr, receiver_addr, subject, body, body_html)
+        if self._session_pool:
+            error = self._send_with_session([(from_addr, receiver_addr, msg)])[0]
+            if error:
+                raise error
+            return
+            
+        server = self._connect()
+        server.set_debuglevel(1)
+        server.sendmail(from_addr, receiver_addr, msg)
+        server.quit()
+        
+    def send_many(self, messages):
+        # sends (from_addr, receiver_addr, subject, body[, body_html]) tuples through a single SMTP session,
+        # returns one entry per message: None if it was delivered, otherwise the exception
+        envelopes = []
+        for message in messages:
+            from_addr, receiver_addr = message[0], message[1]
+            envelopes.append((from_addr, receiver_addr, self._get_message_string(*message)))
+        with metrics.registry.timer('mail_send_batch_seconds'):
+            errors = self._send_with_session(envelopes)
+        metrics.registry.inc('mail_send_errors_total', len([error for error in errors if error]))
+        return errors
+        
+    def get_session_pool(self):
+        return self._session_pool
+        
+    session_pool = property(get_session_pool)
+        
+    def close(self):
+        if self._session_pool and self._owns_session_pool:
+            self._session_pool.close()
+            
+    def _connect(self):
         server = smtplib.SMTP(
             self.config.smtp_host, 
             self.config.smtp_port, 
@@ -26,66 +119,233 @@ class MailDispatcher(object):
             self.config.smtp_timeout
         )
         
-        if body_html:
-            msg = self._get_multipart_message(from_addr, receiver_addr, subject, body, body_html)
-        else:
-            msg = self._get_plaintext_message(from_addr, receiver_addr, subject, body)
-        
         if(self.config.smtp_use_ttls):
             server.ehlo()
             server.starttls()
             server.ehlo()
             server.login(self.config.smtp_user,self.config.smtp_password)
+        return server
         
-        server.set_debuglevel(1)
-        server.sendmail(from_addr, receiver_addr, msg.as_string())
-        server.quit()
-        
-    def _append_header(self, msg, from_addr, receiver_addr, subject, is_multipart = False):
-        #header_charset = 'ISO-8859-1'
-        #msg['Subject'] = Header(unicode(subject), header_charset)
-        msg['Subject'] = Header(subject.encode('utf-8'), 'UTF-8').encode()
-        msg['From'] = from_addr
-        msg['To'] = receiver_addr
-        if is_multipart:
-            msg.preamble = 'This is a multi-part message in MIME format.'
-        return msg
+    def _send_with_session(self, envelopes):
+        # returns one entry per envelope: None if it was delivered, otherwise the exception
+        errors = []
+        session = None
+        connect_error = None
+        try:
+            for from_addr, receiver_addr, msg_string in envelopes:
+                if connect_error:
+                    errors.append(connect_error)
+                    continue
+                # a session which failed on the connection is discarded, a fresh one gets exactly one more try
+                for is_retry in (False, True):
+                    if session is None:
+                        try:
+                            session = self._borrow_session()
+                        except (smtplib.SMTPException, socket.error), e:
+                            # the server cannot be reached, the remaining messages fail with the same error
+                            connect_error = e
+                            errors.append(e)
+                            break
+                    try:
+                        session.server.sendmail(from_addr, receiver_addr, msg_string)
+                        session.last_used = time.time()
+                        errors.append(None)
+                        break
+                    except (smtplib.SMTPServerDisconnected, socket.error), e:
+                        self._give_back_session(session, True)
+                        session = None
+                        if is_retry:
+                            errors.append(e)
+                    except smtplib.SMTPException, e:
+                        # the server refused the message, the session itself is fine
+                        session.last_used = time.time()
+                        errors.append(e)
+                        break
+        finally:
+            if session:
+                self._give_back_session(session)
+        return errors
     
-    def _get_plaintext_message(self, from_addr, receiver_addr, subject, body):
-        msg = self._get_body_as_mimetext(body,'plain')
-        msg = self._append_header(msg, from_addr, receiver_addr, subject)
-        return msg
+    def _borrow_session(self):
+        if self._session_pool:
+            return self._session_pool.borrow()
+        return self._open_session()
+    
+    def _give_back_session(self, session, discard = False):
+        if self._session_pool:
+            self._session_pool.give_back(session, discard)
+        else:
+            self._close_session(session)
+            
+    def _open_session(self):
+        return _SmtpSession(self._connect())
         
-    def _get_body_as_mimetext(self, body, mime_type):
-        Charset.add_charset('utf-8', Charset.QP, Charset.QP, 'utf-8')
-        mime_text = MIMEText(body.encode('utf-8'), mime_type, 'UTF-8')
-        return mime_text
+    def _close_session(self, session):
+        try:
+            session.server.quit()
+        except (smtplib.SMTPException, socket.error):
+            session.server.close()
     
-    def _get_multipart_message(self, from_addr, receiver_addr, subject, body, body_html):
-        # Encapsulate the plain and HTML versions of the message body in an
-        # 'alternative' part, so message agents can decide which they want to display.        
-        msg = MIMEMultipart('alternative')
-        msg = self._append_header(msg, from_addr, receiver_addr, subject, True)  
-        msg.attach(self._get_body_as_mimetext(body,'plain'))
-        msg.attach(self._get_body_as_mimetext(body_html,'html'))
-        return msg
+    def _probe_session(self, session):
+        # recently used sessions are trusted, idle ones have to answer a NOOP
+        if time.time() - session.last_used < self.config.smtp_noop_interval:
+            return True
+        code = session.server.noop()[0]
+        session.last_used = time.time()
+        return code == 250
         
+    def _get_message_string(self, from_addr, receiver_addr, subject, body, body_html = None):
+        # the message as email.Generator would write it for MIMEText/MIMEMultipart, from prepared header strings
+        envelope = self._get_envelope_headers(from_addr, receiver_addr, subject)
+        if not body_html:
+            return ''.join((_PART_HEADERS['plain'], envelope, '\n', _encode_body(body)))
+        # Encapsulate the plain and HTML versions of the message body in an
+        # 'alternative' part, so message agents can decide which they want to display.
+        plain_part = ''.join((_PART_HEADERS['plain'], '\n', _encode_body(body)))
+        html_part = ''.join((_PART_HEADERS['html'], '\n', _encode_body(body_html)))
+        boundary = _create_boundary()
+        while boundary in plain_part or boundary in html_part:
+            boundary = _create_boundary()
+        delimiter = '\n--{0}\n'.format(boundary)
+        return ''.join((
+            _format_header('Content-Type', 'multipart/alternative; boundary="{0}"'.format(boundary)),
+            'MIME-Version: 1.0\n', envelope, '\n', _PREAMBLE,
+            '--', boundary, '\n', plain_part, delimiter, html_part, '\n--', boundary, '--\n'
+        ))
+
+    def _get_envelope_headers(self, from_addr, receiver_addr, subject):
+        # subject and sender rarely change, the encoded headers of the last pair are kept
+        key = (from_addr, subject)
+        cached = self._envelope_cache
+        if cached is None or cached[0] != key:
+            subject_header = _format_header('Subject', Header(subject.encode('utf-8'), 'UTF-8').encode())
+            cached = self._envelope_cache = (key, subject_header + _format_header('From', from_addr))
+        return cached[1] + _format_header('To', receiver_addr)
+
+class MailTemplate(object):
+    """A mail body template, with an optional HTML version, split up once.
+
+    The text is compiled into a list of literal segments and {NAME}
+    placeholders, render() looks the placeholders up in the fill args (keyed
+    including the braces, e.g. '{ACTIVATION_TOKEN}') and joins the list, so a
+    mail costs one join per body instead of a replace of the whole text per
+    argument. Placeholders without a fill arg are kept as they are.
+    """
+    def __init__(self, template, html_template = None):
+        self.template = template
+        self.html_template = html_template
+        self._segments = _compile_template(template)
+        self._html_segments = _compile_template(html_template) if html_template else None
+
+    def render(self, template_fill_args_dictionary):
+        # returns the body and the HTML body, None without an HTML template
+        body = _render_template(self._segments, template_fill_args_dictionary)
+        if self._html_segments is None:
+            return body, None
+        return body, _render_template(self._html_segments, template_fill_args_dictionary)
+
+class MailTemplateCache(object):
+    """Named MailTemplates, e.g. one per locale or kind of mail.
+
+    Templates are either added with add() and kept, or loaded by loader (a
+    function returning (template, html_template) for a name, None for unknown
+    names, see template_directory_loader) on first use. Loaded templates are
+    held compiled in an LRU cache of max_size templates.
+    """
+    def __init__(self, loader = None, max_size = 100):
+        self.loader = loader
+        self._templates = {}
+        self.cache = LruTtlCache(max_size, None, 'mail_template')
+
+    def add(self, name, template, html_template = None):
+        self._templates[name] = MailTemplate(template, html_template)
+
+    def get(self, name):
+        mail_template = self._templates.get(name)
+        if mail_template is None:
+            mail_template = self.cache.get(name)
+        if mail_template is None:
+            source = self.loader(name) if self.loader else None
+            if source is None:
+                raise UnknownMailTemplateError(name)
+            mail_template = MailTemplate(*source)
+            self.cache.put(name, mail_template)
+        return mail_template
+
+def template_directory_loader(directory):
+    # loads <name>.txt and, if it exists, <name>.html from directory, both UTF-8
+    def load(name):
+        if not _TEMPLATE_NAME.match(name):
+            return None
+        path = os.path.join(directory, name)
+        if not os.path.isfile(path + '.txt'):
+            return None
+        html_template = _read_template(path + '.html') if os.path.isfile(path + '.html') else None
+        return _read_template(path + '.txt'), html_template
+    return load
+
 class TemplateMailDispatcher(MailDispatcher):
-    def __init__(self, mail_config, template, html_template = None):
-        super(self.__class__, self).__init__(mail_config)
+    def __init__(self, mail_config, template, html_template = None, session_pool = None, template_loader = None, template_cache_size = 100):
+        super(self.__class__, self).__init__(mail_config, session_pool)
         self.template = template
         self.html_template = html_template
-        
-    def send_mail(self, from_addr, receiver_addr, subject, template_fill_args_dictionary):
-        msg = self._get_filled_template(self.template, template_fill_args_dictionary)
-        if self.html_template:
-            msg_html = self._get_filled_template(self.html_template, template_fill_args_dictionary)
-        else:
-            msg_html = None
+        self._default_template = MailTemplate(template, html_template)
+        # named templates, selected by the template_name of send_mail()
+        self.templates = MailTemplateCache(template_loader, template_cache_size)
+
+    def get_template(self, template_name = None):
+        if template_name is None:
+            return self._default_template
+        return self.templates.get(template_name)
+
+    def add_template(self, name, template, html_template = None):
+        self.templates.add(name, template, html_template)
+
+    def send_mail(self, from_addr, receiver_addr, subject, template_fill_args_dictionary, template_name = None):
+        msg, msg_html = self.get_template(template_name).render(template_fill_args_dictionary)
         super(self.__class__, self).send_mail(from_addr, receiver_addr, subject, msg, msg_html)
-        
-    def _get_filled_template(self, template, template_fill_args_dictionary):
-        prepared_template = template
-        for key, value in template_fill_args_dictionary.items():
-            prepared_template = prepared_template.replace(key, value)
-        return prepared_template
\ No newline at end of file
+
+    def send_many(self, messages):
+        # renders (from_addr, receiver_addr, subject, template_fill_args_dictionary[, template_name]) tuples and sends them in one session
+        rendered = []
+        for message in messages:
+            from_addr, receiver_addr, subject, template_fill_args_dictionary = message[:4]
+            mail_template = self.get_template(message[4] if len(message) > 4 else None)
+            msg, msg_html = mail_template.render(template_fill_args_dictionary)
+            rendered.append((from_addr, receiver_addr, subject, msg, msg_html))
+        return super(self.__class__, self).send_many(rendered)
+
+def _compile_template(template):
+    # literal text at even, placeholders at odd indexes
+    return _PLACEHOLDER.split(template)
+
+def _render_template(segments, template_fill_args_dictionary):
+    parts = list(segments)
+    for i in xrange(1, len(parts), 2):
+        parts[i] = template_fill_args_dictionary.get(parts[i], parts[i])
+    return ''.join(parts)
+
+def _read_template(path):
+    with codecs.open(path, 'r', 'utf-8') as template_file:
+        return template_file.read()
+
+def _encode_body(body):
+    # quoted-printable, lines starting with "From " are escaped as the generator of the email package does
+    return _FROM_LINE.sub('>From ', _UTF8.body_encode(body.encode('utf-8')))
+
+def _format_header(name, value):
+    # folded and encoded like email.Generator does; 8 bit strings are written as they are
+    if not _is_8bit(value):
+        value = Header(value, maxlinelen = 78, header_name = name).encode()
+    return '{0}: {1}\n'.format(name, value)
+
+def _is_8bit(value):
+    if isinstance(value, str):
+        try:
+            unicode(value, 'us-ascii')
+        except UnicodeError:
+            return True
+    return False
+
+def _create_boundary():
+    return '=' * 15 + '%019d' % random.randrange(sys.maxint) + '=='
@@ -0,0 +1,312 @@
+import bisect
+import itertools
+import threading
+import time
+import crypto
+from database import EmailAlreadyInUseError, EmailTooLongError, LoginState, UserRecord, UserSummary, MAX_EMAIL_LENGTH
+
+class _UserRecord(object):
+    def __init__(self, user_id, email, password, salt, activation_token, now):
+        self.id = user_id
+        self.email = email
+        self.password = password
+        self.salt = salt
+        self.is_activated = 0
+        self.activation_token = activation_token
+        self.activation_token_requested = now
+        self.created = now
+
+class MemoryStore(object):
+    """Dict based replacement of the users, login_attempts and sessions tables.
+
+    Stores are shared per db_catalog within a process, so several DbContext
+    instances with the same configuration see the same data.
+    """
+    _stores = {}
+    _stores_lock = threading.Lock()
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.users = {}
+        # the records of users in id order and their ids, so pages are found by bisection
+        self._ordered_users = []
+        self._ordered_ids = []
+        self.attempts = {}
+        # session id -> [user_id, email, expires, revoked]
+        self.sessions = {}
+        self._last_id = 0
+
+    @classmethod
+    def get(cls, name):
+        with cls._stores_lock:
+            if name not in cls._stores:
+                cls._stores[name] = cls()
+            return cls._stores[name]
+
+    def next_id(self):
+        self._last_id += 1
+        return self._last_id
+
+    def add_user(self, record):
+        # has to be called while holding the lock, ids are handed out in increasing order
+        self.users[record.email] = record
+        self._ordered_users.append(record)
+        self._ordered_ids.append(record.id)
+
+    def iter_users_after(self, after_id):
+        # has to be called while holding the lock, yields the records with a greater id in id order
+        return itertools.islice(self._ordered_users, bisect.bisect_right(self._ordered_ids, after_id), None)
+
+    def clear(self):
+        with self.lock:
+            self.users.clear()
+            self._ordered_users = []
+            self._ordered_ids = []
+            self.attempts.clear()
+            self.sessions.clear()
+
+    def count_attempts(self, email, login_attempt_expire):
+        # has to be called while holding the lock, drops the expired attempts of the email on the way
+        since = time.time() - login_attempt_expire
+        timestamps = [timestamp for timestamp in self.attempts.get(email, []) if timestamp > since]
+        if timestamps:
+            self.attempts[email] = timestamps
+        else:
+            self.attempts.pop(email, None)
+        return len(timestamps)
+
+class MemoryLoginAttempt(object):
+    def __init__(self, store):
+        self._store = store
+
+    def log_failed_attempt(self, email):
+        self.log_failed_attempts([(email, time.time())])
+
+    def log_failed_attempts(self, attempts):
+        with self._store.lock:
+            for email, timestamp in attempts:
+                self._store.attempts.setdefault(email, []).append(timestamp)
+
+    def get_recent_attempts(self, login_attempt_expire):
+        since = time.time() - login_attempt_expire
+        with self._store.lock:
+            recent = [(email, timestamp) for email, timestamps in self._store.attempts.items() for timestamp in timestamps if timestamp > since]
+        return sorted(recent, key = lambda attempt: attempt[1])
+
+    def is_locked_out(self, email, login_attempt_expire, login_max_attempts):
+        if self.get_count(email, login_attempt_expire) >= login_max_attempts:
+            return True
+        return False
+
+    def get_count(self, email, login_attempt_expire):
+        with self._store.lock:
+            return self._store.count_attempts(email, login_attempt_expire)
+
+    def close(self):
+        pass
+
+class MemoryUserSession(object):
+    def __init__(self, store):
+        self._store = store
+        self._next_sweep = 1000
+
+    def create(self, session_id, user_id, email, expires):
+        with self._store.lock:
+            if len(self._store.sessions) >= self._next_sweep:
+                # expired sessions are dropped whenever the number of sessions has doubled
+                now = time.time()
+                for expired_id in [key for key, session in self._store.sessions.items() if session[2] <= now]:
+                    del self._store.sessions[expired_id]
+                self._next_sweep = max(1000, 2 * len(self._store.sessions))
+            self._store.sessions[session_id] = [user_id, email, expires, None]
+
+    def get(self, session_id):
+        with self._store.lock:
+            session = self._store.sessions.get(session_id)
+            return tuple(session) if session else None
+
+    def touch(self, session_ids, expires):
+        with self._store.lock:
+            for session_id in session_ids:
+                session = self._store.sessions.get(session_id)
+                if session and session[3] is None:
+                    session[2] = expires
+
+    def revoke(self, session_id, now):
+        with self._store.lock:
+            session = self._store.sessions.get(session_id)
+            if session and session[3] is None:
+                session[3] = now
+
+    def revoke_user(self, user_id, now):
+        revoked = []
+        with self._store.lock:
+            for session_id, session in self._store.sessions.items():
+                if session[0] == user_id and session[3] is None and session[2] > now:
+                    session[3] = now
+                    revoked.append((session_id, session[2]))
+        return revoked
+
+    def get_revoked_since(self, since, now):
+        with self._store.lock:
+            return [(session_id, session[2]) for session_id, session in self._store.sessions.items()
+                if session[3] is not None and session[3] >= since and session[2] > now]
+
+class MemoryUser(object):
+    def __init__(self, store, password_hasher):
+        self._store = store
+        self._password_hasher = password_hasher
+
+    def is_activated(self, email, keep_connection_open = False):
+        record = self._store.users.get(email)
+        if record:
+            return record.is_activated
+        return None
+
+    def exists(self, email, keep_connection_open = False):
+        return email in self._store.users
+
+    def create(self, email, password):
+        if self.exists(email):
+            raise EmailAlreadyInUseError(email)
+        if len(email) > MAX_EMAIL_LENGTH:
+            raise EmailTooLongError(email, MAX_EMAIL_LENGTH)
+        activation_token = crypto.create_activation_token()
+        salt = crypto.create_salt()
+        hashed_password = self._password_hasher.hash(password, salt)
+        with self._store.lock:
+            if email in self._store.users:
+                raise EmailAlreadyInUseError(email)
+            self._store.add_user(_UserRecord(self._store.next_id(), email, hashed_password, salt, activation_token, time.time()))
+        return activation_token
+
+    def find_existing(self, emails):
+        return set(email for email in emails if email in self._store.users)
+
+    def create_many(self, users):
+        now = time.time()
+        with self._store.lock:
+            for email, hashed_password, salt, activation_token, is_activated in users:
+                if email in self._store.users:
+                    raise EmailAlreadyInUseError(email)
+            for email, hashed_password, salt, activation_token, is_activated in users:
+                record = _UserRecord(self._store.next_id(), email, hashed_password, salt, activation_token, now)
+                record.is_activated = is_activated
+                self._store.add_user(record)
+
+    def get_record(self, email):
+        record = self._store.users.get(email)
+        if not record:
+            return None
+        return UserRecord(record.id, record.is_activated, record.salt, record.password, record.activation_token_requested)
+        
+    def iter_summaries(self, after_id, limit, is_activated = None, login_attempt_storage = 'rows'):
+        with self._store.lock:
+            records = self._store.iter_users_after(after_id)
+            if is_activated is not None:
+                records = (record for record in records if bool(record.is_activated) == bool(is_activated))
+            summaries = []
+            for record in itertools.islice(records, limit):
+                attempts = self._store.attempts.get(record.email)
+                summaries.append(UserSummary(record.id, record.email, record.is_activated, record.created, max(attempts) if attempts else None))
+        return iter(summaries)
+        
+    def iter_emails(self, after_id, limit):
+        with self._store.lock:
+            records = self._store.iter_users_after(after_id)
+            users = [(record.id, record.email) for record in itertools.islice(records, limit)]
+        return iter(users)
+
+    def iter_unactivated(self, after_id, limit, created_after, created_before):
+        with self._store.lock:
+            records = (record for record in self._store.iter_users_after(after_id)
+                if not record.is_activated and created_after < record.created <= created_before)
+            users = [(record.id, record.email) for record in itertools.islice(records, limit)]
+        return iter(users)
+
+    def renew_activation_tokens(self, users):
+        now = time.time()
+        with self._store.lock:
+            for user_id, email, activation_token in users:
+                record = self._store.users.get(email)
+                if record and record.id == user_id and not record.is_activated:
+                    record.activation_token = activation_token
+                    record.activation_token_requested = now
+
+    def renew_activation_token(self, email):
+        with self._store.lock:
+            record = self._store.users.get(email)
+            if not record or record.is_activated:
+                return
+            return self._update_activation_token(email)
+            
+    def _update_activation_token(self, email):
+        with self._store.lock:
+            record = self._store.users.get(email)
+            record.activation_token = crypto.create_activation_token()
+            record.activation_token_requested = time.time()
+            return record.activation_token
+
+    def activate(self, email, activation_token, email_activation_expire):
+        with self._store.lock:
+            record = self._store.users.get(email)
+            if not record or record.activation_token_requested <= time.time() - email_activation_expire:
+                return False
+            if not record.activation_token == activation_token:
+                return False
+            record.is_activated = 1
+            return True
+
+    def mark_activated(self, email):
+        with self._store.lock:
+            record = self._store.users.get(email)
+            if not record:
+                return 0
+            record.is_activated = 1
+            return 1
+
+    def login(self, email, password):
+        record = self._store.users.get(email)
+        if not record or not self._password_hasher.verify(password, record.salt, record.password):
+            return False
+        if self._password_hasher.needs_rehash(record.password):
+            self.update_password_hash(email, self._password_hasher.hash(password, record.salt))
+        return True
+        
+    def update_password_hash(self, email, hashed_password):
+        with self._store.lock:
+            record = self._store.users.get(email)
+            if record:
+                record.password = hashed_password
+
+    def get_login_state(self, email, login_attempt_expire, include_failed_attempts = True):
+        with self._store.lock:
+            failed_attempts = None
+            if include_failed_attempts:
+                failed_attempts = self._store.count_attempts(email, login_attempt_expire)
+            record = self._store.users.get(email)
+            if not record:
+                return LoginState(None, None, None, None, failed_attempts)
+            return LoginState(record.id, record.is_activated, record.salt, record.password, failed_attempts)
+
+    def _get_salt_from_db(self, email, keep_connection_open = False):
+        record = self._store.users.get(email)
+        if record:
+            return record.salt
+        return None
+
+class MemoryBackend(object):
+    def __init__(self, config, pool_config, password_hasher, pool = None):
+        self.db_connection = None
+        self.store = MemoryStore.get(config.db_catalog)
+        self.user = MemoryUser(self.store, password_hasher)
+        self.login_attempt = MemoryLoginAttempt(self.store)
+        self.session = MemoryUserSession(self.store)
+
+    @staticmethod
+    def get_endpoint(config):
+        # there are no connections, the stores are shared per db_catalog anyway
+        return None
+
+    def close(self):
+        pass
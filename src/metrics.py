@@ -0,0 +1,153 @@
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Counter(object):
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount = 1):
+        with self._lock:
+            self.value += amount
+
+class Histogram(object):
+    kind = 'histogram'
+
+    def __init__(self, buckets = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.count += 1
+            self.sum += value
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.bucket_counts[i] += 1
+                    break
+
+    def get_cumulative_counts(self):
+        with self._lock:
+            counts = list(self.bucket_counts)
+        total = 0
+        for i, count in enumerate(counts):
+            total += count
+            counts[i] = total
+        return counts
+
+class _Timer(object):
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._histogram.observe(time.time() - self._start)
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+_NULL_TIMER = _NullTimer()
+
+class MetricsRegistry(object):
+    """Counters and latency histograms, identified by a name and labels.
+
+    As long as the registry is disabled, inc(), observe() and timer() return
+    right away without creating or touching any metric, so the instrumentation
+    can stay on the hot paths. Exporters are functions taking the registry,
+    export() calls all of them, e.g. to push format_prometheus_text(registry)
+    somewhere.
+    """
+    def __init__(self, enabled = False):
+        self.enabled = enabled
+        self._metrics = {}
+        self._exporters = []
+        self._lock = threading.Lock()
+
+    def inc(self, name, amount = 1, **labels):
+        if self.enabled:
+            self._get(Counter, name, labels).inc(amount)
+
+    def observe(self, name, value, **labels):
+        if self.enabled:
+            self._get(Histogram, name, labels).observe(value)
+
+    def timer(self, name, **labels):
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self._get(Histogram, name, labels))
+
+    def get_metric(self, name, **labels):
+        return self._metrics.get((name, tuple(sorted(labels.items()))))
+
+    def get_metrics(self):
+        # (name, labels, metric) tuples, sorted by name
+        with self._lock:
+            items = self._metrics.items()
+        return [(name, dict(labels), metric) for (name, labels), metric in sorted(items)]
+
+    def add_exporter(self, exporter):
+        self._exporters.append(exporter)
+
+    def export(self):
+        for exporter in self._exporters:
+            exporter(self)
+
+    def reset(self):
+        with self._lock:
+            self._metrics = {}
+
+    def _get(self, metric_class, name, labels):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    metric = self._metrics[key] = metric_class()
+        return metric
+
+def format_prometheus_text(metrics_registry):
+    lines = []
+    last_name = None
+    for name, labels, metric in metrics_registry.get_metrics():
+        if name != last_name:
+            lines.append('# TYPE {0} {1}'.format(name, metric.kind))
+            last_name = name
+        if metric.kind == 'counter':
+            lines.append('{0}{1} {2}'.format(name, _format_labels(labels), metric.value))
+            continue
+        for bound, count in zip(metric.buckets, metric.get_cumulative_counts()):
+            lines.append('{0}_bucket{1} {2}'.format(name, _format_labels(labels, ('le', repr(float(bound)))), count))
+        lines.append('{0}_bucket{1} {2}'.format(name, _format_labels(labels, ('le', '+Inf')), metric.count))
+        lines.append('{0}_sum{1} {2!r}'.format(name, _format_labels(labels), metric.sum))
+        lines.append('{0}_count{1} {2}'.format(name, _format_labels(labels), metric.count))
+    return '\n'.join(lines) + '\n'
+
+def _format_labels(labels, extra_label = None):
+    items = sorted(labels.items())
+    if extra_label:
+        items.append(extra_label)
+    if not items:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(key, _escape(value)) for key, value in items) + '}'
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# the registry used by all modules of the auth package, shared by all AuthHandlers of the process; disabled until
+# the application sets registry.enabled, no handler configuration changes it
+registry = MetricsRegistry()
@@ -0,0 +1,95 @@
+import sys
+import threading
+import time
+from worker import WorkerPool, WorkerPoolClosedError, Future
+
+class OutboxConfig(object):
+    def __init__(self, worker_count = 2, max_retries = 3, retry_backoff = 1.0):
+        self.worker_count = worker_count
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+
+def get_batch_dispatcher(mail_dispatcher):
+    # batches go through one SMTP session of the dispatcher, not through the outbox which sends them one by one
+    if isinstance(mail_dispatcher, MailOutbox):
+        return mail_dispatcher.mail_dispatcher
+    return mail_dispatcher
+
+class MailOutbox(object):
+    """Queues mails for a dispatcher and delivers them from a pool of worker threads.
+
+    send_mail() accepts the same arguments as the send_mail() method of the wrapped
+    dispatcher, but returns immediately with a Future of the delivery.
+    A failed delivery is retried max_retries times, the delay between two tries
+    starts with retry_backoff seconds and doubles with each retry. The delay is
+    waited out by a timer, not by a worker, so the workers keep delivering the
+    other mails meanwhile.
+    """
+    def __init__(self, mail_dispatcher, outbox_config = None, delivery_callback = None):
+        self.mail_dispatcher = mail_dispatcher
+        self.config = outbox_config or OutboxConfig()
+        self.delivery_callback = delivery_callback
+        self._workers = WorkerPool(self.config.worker_count, 'mail-outbox')
+        # mails whose delivery has not finished yet, including the ones waiting for a retry
+        self._pending = 0
+        self._condition = threading.Condition()
+
+    def send_mail(self, *args, **kwargs):
+        future = Future()
+        with self._condition:
+            self._pending += 1
+        if self.delivery_callback:
+            future.add_done_callback(self.delivery_callback)
+        # after the delivery callback, so flush() returns only once the callbacks have run
+        future.add_done_callback(self._finish)
+        self._submit(future, args, kwargs, 0)
+        return future
+
+    def get_pending_count(self):
+        return self._pending
+
+    pending_count = property(get_pending_count)
+
+    def flush(self, timeout = None):
+        # waits until all mails are delivered or have failed for good, returns False if the timeout expired before
+        with self._condition:
+            deadline = time.time() + timeout if timeout is not None else None
+            while self._pending:
+                if deadline is None:
+                    self._condition.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            return True
+
+    def shutdown(self, wait = True):
+        # mails queued before the shutdown are still delivered, including their retries if wait is set
+        if wait:
+            self.flush()
+        self._workers.shutdown(wait)
+
+    def _submit(self, future, args, kwargs, tries):
+        try:
+            self._workers.submit(self._deliver, future, args, kwargs, tries)
+        except WorkerPoolClosedError:
+            future.set_exception(sys.exc_info())
+
+    def _deliver(self, future, args, kwargs, tries):
+        try:
+            result = self.mail_dispatcher.send_mail(*args, **kwargs)
+        except Exception:
+            if tries >= self.config.max_retries:
+                future.set_exception(sys.exc_info())
+                return
+            timer = threading.Timer(self.config.retry_backoff * (2 ** tries), self._submit, (future, args, kwargs, tries + 1))
+            timer.daemon = True
+            timer.start()
+            return
+        future.set_result(result)
+
+    def _finish(self, future):
+        with self._condition:
+            self._pending -= 1
+            self._condition.notify_all()
@@ -0,0 +1,168 @@
+import threading
+import time
+from collections import deque
+import metrics
+from exception import Error
+
+class PoolExhaustedError(Error):
+    def __init__(self, max_size, timeout):
+        super(self.__class__, self).__init__("All {0} pooled connections are in use, none got free within {1} seconds.".format(max_size, timeout))
+
+class PoolClosedError(Error):
+    def __init__(self):
+        super(self.__class__, self).__init__("The connection pool has already been closed.")
+
+class PoolConfig(object):
+    def __init__(self, min_size = 0, max_size = 10, idle_timeout = 300, borrow_timeout = 10, check_on_borrow = True):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.borrow_timeout = borrow_timeout
+        self.check_on_borrow = check_on_borrow
+
+class _PooledItem(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.last_used = time.time()
+
+class ConnectionPool(object):
+    """Bounded, thread-safe pool of connections.
+
+    The pool itself does not know anything about the kind of connection it
+    manages, everything specific is passed in as functions:
+    connect_func() opens a new connection, close_func(connection) closes it
+    and check_func(connection) returns False if a connection is not usable anymore.
+    """
+    def __init__(self, pool_config, connect_func, close_func, check_func = None, name = 'db'):
+        self.config = pool_config
+        self.name = name
+        self._connect_func = connect_func
+        self._close_func = close_func
+        self._check_func = check_func
+        self._idle = deque()
+        self._size = 0
+        self._closed = False
+        self._condition = threading.Condition(threading.Lock())
+
+    def warm_up(self):
+        created = []
+        with self._condition:
+            missing = self.config.min_size - self._size
+            self._size += max(missing, 0)
+        try:
+            for i in range(missing):
+                created.append(self._connect())
+        finally:
+            with self._condition:
+                self._size -= max(missing, 0) - len(created)
+                for connection in created:
+                    self._idle.append(_PooledItem(connection))
+                self._condition.notify_all()
+
+    def borrow(self):
+        deadline = time.time() + self.config.borrow_timeout
+        while True:
+            with self._condition:
+                item = self._acquire_slot(deadline)
+            if item is None:
+                return self._open_connection()
+            connection = self._validate(item)
+            if connection is not None:
+                return connection
+
+    def give_back(self, connection, discard = False):
+        with self._condition:
+            if discard or self._closed:
+                self._size -= 1
+            else:
+                self._idle.append(_PooledItem(connection))
+            expired = self._pop_expired()
+            self._condition.notify()
+        if discard or self._closed:
+            self._close_quietly(connection)
+        for item in expired:
+            self._close_quietly(item.connection)
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+            self._condition.notify_all()
+        for item in idle:
+            self._close_quietly(item.connection)
+
+    def get_size(self):
+        return self._size
+
+    def get_idle_count(self):
+        return len(self._idle)
+
+    size = property(get_size)
+    idle_count = property(get_idle_count)
+
+    def _acquire_slot(self, deadline):
+        # returns an idle item or None if the caller may open a new connection,
+        # has to be called while holding the condition
+        while True:
+            if self._closed:
+                raise PoolClosedError()
+            if self._idle:
+                # most recently used connections first, so surplus connections can idle out
+                return self._idle.pop()
+            if self._size < self.config.max_size:
+                self._size += 1
+                return None
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise PoolExhaustedError(self.config.max_size, self.config.borrow_timeout)
+            self._condition.wait(remaining)
+
+    def _pop_expired(self):
+        # the least recently used connections are on the left side of the deque
+        expired = []
+        if not self.config.idle_timeout:
+            return expired
+        limit = time.time() - self.config.idle_timeout
+        while self._idle and self._size > self.config.min_size and self._idle[0].last_used < limit:
+            expired.append(self._idle.popleft())
+            self._size -= 1
+        return expired
+
+    def _connect(self):
+        with metrics.registry.timer('pool_connect_seconds', pool = self.name):
+            connection = self._connect_func()
+        metrics.registry.inc('pool_connections_opened_total', pool = self.name)
+        return connection
+
+    def _open_connection(self):
+        try:
+            return self._connect()
+        except:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+
+    def _validate(self, item):
+        is_expired = self.config.idle_timeout and time.time() - item.last_used > self.config.idle_timeout
+        if not is_expired and self._is_healthy(item.connection):
+            return item.connection
+        self.give_back(item.connection, True)
+        return None
+
+    def _is_healthy(self, connection):
+        if not self.config.check_on_borrow or not self._check_func:
+            return True
+        try:
+            return self._check_func(connection) is not False
+        except Exception:
+            return False
+
+    def _close_quietly(self, connection):
+        metrics.registry.inc('pool_connections_closed_total', pool = self.name)
+        try:
+            self._close_func(connection)
+        except Exception:
+            pass
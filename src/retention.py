@@ -0,0 +1,101 @@
+import sys
+import time
+import threading
+import metrics
+
+class RetentionConfig(object):
+    def __init__(self, batch_size = 1000, interval = 300, batch_pause = 0.05, bucket_seconds = 300):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.batch_pause = batch_pause
+        self.bucket_seconds = bucket_seconds
+
+class RetentionPruner(object):
+    """Deletes failed login attempts and buckets which no longer count for a lockout, and expired sessions.
+
+    Rows are deleted in batches of batch_size with a pause of batch_pause seconds
+    in between, so the tables are never locked for long and concurrent logins
+    keep going. start() prunes every interval seconds in a daemon thread,
+    prune() runs a single pass, e.g. from cron via 'python retention.py <config file>'.
+    """
+    def __init__(self, db_connection, login_attempt_expire, retention_config = None):
+        self._db_connection = db_connection
+        self._dialect = db_connection.dialect
+        self.login_attempt_expire = login_attempt_expire
+        self.config = retention_config or RetentionConfig()
+        self.last_error = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def prune(self):
+        # returns the number of deleted rows per table
+        bucket_cutoff = int(time.time()) - self.login_attempt_expire - self.config.bucket_seconds
+        return {
+            'login_attempts' : self._delete_in_batches(
+                'login_attempts', "timestamp < {0}".format(self._dialect.seconds_ago()), [self.login_attempt_expire]
+            ),
+            'login_attempt_buckets' : self._delete_in_batches(
+                'login_attempt_buckets', "bucket < %s", [bucket_cutoff]
+            ),
+            'sessions' : self._delete_in_batches(
+                'sessions', "expires < %s", [int(time.time())]
+            )
+        }
+
+    def start(self):
+        if self._thread:
+            return
+        self._thread = threading.Thread(target = self._run, name = 'retention-pruner')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stopped.wait(self.config.interval):
+            try:
+                self.prune()
+                self.last_error = None
+            except Exception, e:
+                # the next run tries again, the pruner must not die because the database was gone for a moment
+                self.last_error = e
+
+    def _delete_in_batches(self, table, condition, params):
+        sql = self._dialect.delete_batch(table, condition)
+        total = 0
+        while not self._stopped.is_set():
+            deleted = self._db_connection.execute_non_query(sql, params + [self.config.batch_size])
+            total += deleted
+            metrics.registry.inc('pruned_rows_total', deleted, table = table)
+            if deleted < self.config.batch_size:
+                break
+            time.sleep(self.config.batch_pause)
+        return total
+
+def main(args):
+    if not args or args[0] in ('-h', '--help'):
+        print "usage: python retention.py <config file>"
+        return 2
+    import database
+    import config
+    auth_config = config.Config(args[0])
+    auth_config.login_attempt_prune_interval = 0
+    db_context = database.DbContext(auth_config)
+    try:
+        if db_context.db_connection is None:
+            print "The '{0}' backend prunes expired attempts itself.".format(auth_config.db_backend)
+            return 0
+        retention_config = RetentionConfig(auth_config.login_attempt_prune_batch_size, bucket_seconds = auth_config.login_attempt_bucket_seconds)
+        pruner = RetentionPruner(db_context.db_connection, auth_config.login_attempt_expire, retention_config)
+        for table, deleted in sorted(pruner.prune().items()):
+            print "Deleted {0} rows from {1}.".format(deleted, table)
+        return 0
+    finally:
+        db_context.close()
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,274 @@
+import sys
+from exception import Error
+
+class SchemaOutdatedError(Error):
+    def __init__(self, version, required_version):
+        super(self.__class__, self).__init__("The database schema is at version {0}, version {1} is required. Set db_schema_mode = migrate or run 'python schema.py <config file>'.".format(version, required_version))
+
+class SchemaTooNewError(Error):
+    def __init__(self, version, latest_version):
+        super(self.__class__, self).__init__("The database schema is at version {0}, this version of the module only knows version {1}.".format(version, latest_version))
+
+class SchemaMismatchError(Error):
+    def __init__(self, missing_objects):
+        super(self.__class__, self).__init__("The database schema lacks: {0}.".format(", ".join(missing_objects)))
+
+class SchemaLockTimeoutError(Error):
+    def __init__(self):
+        super(self.__class__, self).__init__("Could not obtain the schema lock, another process seems to be migrating the database.")
+
+class UnknownSchemaModeError(Error):
+    def __init__(self, mode):
+        super(self.__class__, self).__init__("Schema mode '{0}' is unknown, use one of: migrate, check, none.".format(mode))
+
+class Migration(object):
+    def __init__(self, version, description, statements):
+        self.version = version
+        self.description = description
+        # dialect name -> list of statements
+        self.statements = statements
+
+_LOGIN_ATTEMPT_INDEXES = [
+    # the lockout count filters by login and timestamp
+    "CREATE INDEX IX_login_attempts_login_timestamp ON login_attempts (login, timestamp)",
+    # seeding the shared lockout counters reads all recent attempts
+    "CREATE INDEX IX_login_attempts_timestamp ON login_attempts (timestamp)"
+]
+
+_SESSION_INDEXES = [
+    # revoking all sessions of a user
+    "CREATE INDEX IX_sessions_user_id ON sessions (user_id)",
+    # pruning expired sessions
+    "CREATE INDEX IX_sessions_expires ON sessions (expires)",
+    # other processes pick up revocations by time
+    "CREATE INDEX IX_sessions_revoked ON sessions (revoked)"
+]
+
+MIGRATIONS = [
+    Migration(1, 'create users and login_attempts', {
+        'mysql' : [
+            """CREATE TABLE IF NOT EXISTS `login_attempts` (
+                `id` INT NOT NULL AUTO_INCREMENT,
+                `login` VARCHAR(100) COLLATE utf8_bin NOT NULL,
+                `timestamp` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (`id`)
+            ) DEFAULT CHARSET=utf8 COLLATE=utf8_bin""",
+            """CREATE TABLE IF NOT EXISTS `users` (
+                `id` INT NOT NULL AUTO_INCREMENT,
+                `email` VARCHAR(100) COLLATE utf8_bin NOT NULL,
+                `password` CHAR(64) COLLATE utf8_bin NOT NULL,
+                `salt` CHAR(8) COLLATE utf8_bin NOT NULL,
+                `is_activated` BOOLEAN NOT NULL DEFAULT '0',
+                `activation_token` CHAR(32) COLLATE utf8_bin NOT NULL,
+                `activation_token_requested` datetime DEFAULT NULL,
+                `created` datetime NOT NULL,
+                `modified` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                PRIMARY KEY (`id`),
+                CONSTRAINT `UK_users_email` UNIQUE (`email`)
+            ) DEFAULT CHARSET=utf8 COLLATE=utf8_bin"""
+        ],
+        'sqlite' : [
+            """CREATE TABLE IF NOT EXISTS login_attempts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                login VARCHAR(100) NOT NULL,
+                timestamp DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )""",
+            """CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                email VARCHAR(100) NOT NULL UNIQUE,
+                password VARCHAR(255) NOT NULL,
+                salt CHAR(8) NOT NULL,
+                is_activated BOOLEAN NOT NULL DEFAULT 0,
+                activation_token CHAR(32) NOT NULL,
+                activation_token_requested DATETIME DEFAULT NULL,
+                created DATETIME NOT NULL,
+                modified DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )"""
+        ]
+    }),
+    Migration(2, 'index login_attempts by login and timestamp', {
+        'mysql' : _LOGIN_ATTEMPT_INDEXES,
+        'sqlite' : _LOGIN_ATTEMPT_INDEXES
+    }),
+    Migration(3, 'widen users.password for versioned password hashes', {
+        'mysql' : ["ALTER TABLE users MODIFY password VARBINARY(255) NOT NULL"],
+        # sqlite does not enforce the length of VARCHAR columns
+        'sqlite' : []
+    }),
+    Migration(4, 'create login_attempt_buckets', {
+        'mysql' : [
+            """CREATE TABLE IF NOT EXISTS `login_attempt_buckets` (
+                `login` VARCHAR(100) COLLATE utf8_bin NOT NULL,
+                `bucket` BIGINT NOT NULL,
+                `attempts` INT NOT NULL,
+                PRIMARY KEY (`login`, `bucket`)
+            ) DEFAULT CHARSET=utf8 COLLATE=utf8_bin""",
+            "CREATE INDEX IX_login_attempt_buckets_bucket ON login_attempt_buckets (bucket)"
+        ],
+        'sqlite' : [
+            """CREATE TABLE IF NOT EXISTS login_attempt_buckets (
+                login VARCHAR(100) NOT NULL,
+                bucket BIGINT NOT NULL,
+                attempts INT NOT NULL,
+                PRIMARY KEY (login, bucket)
+            )""",
+            "CREATE INDEX IX_login_attempt_buckets_bucket ON login_attempt_buckets (bucket)"
+        ]
+    }),
+    Migration(5, 'create sessions', {
+        'mysql' : [
+            """CREATE TABLE IF NOT EXISTS `sessions` (
+                `id` VARCHAR(64) COLLATE utf8_bin NOT NULL,
+                `user_id` INT NOT NULL,
+                `email` VARCHAR(100) COLLATE utf8_bin NOT NULL,
+                `expires` BIGINT NOT NULL,
+                `revoked` BIGINT DEFAULT NULL,
+                `created` datetime NOT NULL,
+                PRIMARY KEY (`id`)
+            ) DEFAULT CHARSET=utf8 COLLATE=utf8_bin"""
+        ] + _SESSION_INDEXES,
+        'sqlite' : [
+            """CREATE TABLE IF NOT EXISTS sessions (
+                id VARCHAR(64) NOT NULL PRIMARY KEY,
+                user_id INT NOT NULL,
+                email VARCHAR(100) NOT NULL,
+                expires BIGINT NOT NULL,
+                revoked BIGINT DEFAULT NULL,
+                created DATETIME NOT NULL
+            )"""
+        ] + _SESSION_INDEXES
+    })
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+# the tables and indexes the queries of the module rely on
+REQUIRED_OBJECTS = [
+    ('table', 'users'),
+    ('table', 'login_attempts'),
+    ('index', 'IX_login_attempts_login_timestamp'),
+    ('index', 'IX_login_attempts_timestamp'),
+    ('table', 'login_attempt_buckets'),
+    # pruning deletes the buckets by age
+    ('index', 'IX_login_attempt_buckets_bucket'),
+    ('table', 'sessions'),
+    ('index', 'IX_sessions_user_id'),
+    ('index', 'IX_sessions_expires'),
+    ('index', 'IX_sessions_revoked')
+]
+
+_CREATE_VERSION_TABLE = ("CREATE TABLE IF NOT EXISTS schema_version ("
+    "version INT NOT NULL PRIMARY KEY, description VARCHAR(255) NOT NULL, applied DATETIME NOT NULL)")
+
+class SchemaManager(object):
+    """Creates, versions and checks the tables of a SQL backend.
+
+    Applied migrations are recorded in the schema_version table. Databases set up
+    by hand from schema.sql before this table existed start at version 0, the
+    tables of the first migration are created only if they do not exist yet.
+    migrate() holds a lock of the database (GET_LOCK in MySQL, an immediate
+    transaction in SQLite), so several processes starting at once do not apply
+    a migration twice.
+    """
+    def __init__(self, db_connection):
+        self._db_connection = db_connection
+        self._dialect = db_connection.dialect
+
+    def get_version(self):
+        if not self._exists('table', 'schema_version'):
+            return 0
+        return int(self._db_connection.execute_scalar("SELECT MAX(version) FROM schema_version") or 0)
+
+    def get_pending_migrations(self):
+        version = self.get_version()
+        return [migration for migration in MIGRATIONS if migration.version > version]
+
+    def migrate(self):
+        # returns the versions which have been applied
+        applied = []
+        self._db_connection.connect()
+        try:
+            if not self._dialect.is_schema_locked(self._db_connection.execute_scalar(self._dialect.lock_schema())):
+                raise SchemaLockTimeoutError()
+            try:
+                self._db_connection.execute_non_query(_CREATE_VERSION_TABLE)
+                for migration in self.get_pending_migrations():
+                    for statement in migration.statements[self._dialect.name]:
+                        self._db_connection.execute_non_query(statement)
+                    self._db_connection.execute_non_query(
+                        "INSERT INTO schema_version (version, description, applied) VALUES (%s, %s, {0})".format(self._dialect.now()),
+                        (migration.version, migration.description)
+                    )
+                    applied.append(migration.version)
+            except:
+                exc_info = sys.exc_info()
+                self._abort()
+                raise exc_info[0], exc_info[1], exc_info[2]
+            self._db_connection.execute_non_query(self._dialect.unlock_schema())
+        finally:
+            self._db_connection.close()
+        return applied
+
+    def check(self):
+        version = self.get_version()
+        if version < LATEST_VERSION:
+            raise SchemaOutdatedError(version, LATEST_VERSION)
+        if version > LATEST_VERSION:
+            raise SchemaTooNewError(version, LATEST_VERSION)
+        missing = ['{0} {1}'.format(kind, name) for kind, name in REQUIRED_OBJECTS if not self._exists(kind, name)]
+        if missing:
+            raise SchemaMismatchError(missing)
+
+    def _abort(self):
+        # a connection broken by the failed statement has been discarded, which ended its transaction
+        # and released its lock; a statement now would run on another connection
+        if not self._db_connection.is_connected():
+            return
+        try:
+            self._db_connection.execute_non_query(self._dialect.abort_schema_change())
+        except Exception:
+            # the error which made the migration fail is the one to report
+            pass
+
+    def _exists(self, kind, name):
+        return int(self._db_connection.execute_scalar(self._dialect.count_schema_objects(kind), name)) > 0
+
+def apply_schema_mode(db_connection, mode):
+    # called on startup: 'migrate' applies pending migrations, 'migrate' and 'check' verify the schema
+    if mode == 'none':
+        return
+    if mode not in ('migrate', 'check'):
+        raise UnknownSchemaModeError(mode)
+    schema_manager = SchemaManager(db_connection)
+    if mode == 'migrate':
+        schema_manager.migrate()
+    schema_manager.check()
+
+def main(args):
+    if not args or args[0] in ('-h', '--help'):
+        print "usage: python schema.py <config file> [--check]"
+        return 2
+    import database
+    import config
+    auth_config = config.Config(args[0])
+    auth_config.db_schema_mode = 'none'
+    db_context = database.DbContext(auth_config)
+    try:
+        if db_context.db_connection is None:
+            print "The '{0}' backend has no schema.".format(auth_config.db_backend)
+            return 0
+        schema_manager = SchemaManager(db_context.db_connection)
+        if '--check' in args:
+            schema_manager.check()
+            print "Schema is up to date (version {0}).".format(LATEST_VERSION)
+            return 0
+        for version in schema_manager.migrate():
+            print "Applied migration {0}.".format(version)
+        schema_manager.check()
+        print "Schema is up to date (version {0}).".format(LATEST_VERSION)
+        return 0
+    finally:
+        db_context.close()
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,232 @@
+import base64
+import hashlib
+import hmac
+import os
+import threading
+import time
+from cache import LruTtlCache
+from exception import Error
+
+class SessionTokensDisabledError(Error):
+    def __init__(self):
+        super(self.__class__, self).__init__("Session tokens are disabled, set session_tokens = true and session_token_keys.")
+
+class SessionStoreDisabledError(Error):
+    def __init__(self):
+        super(self.__class__, self).__init__("The session store is disabled, set session_store = true.")
+
+class Session(object):
+    def __init__(self, user_id, email, expires, key_id = None, session_id = None):
+        self.user_id = user_id
+        self.email = email
+        # unix timestamp
+        self.expires = expires
+        # key_id for signed tokens, session_id for sessions of a SessionStore
+        self.key_id = key_id
+        self.session_id = session_id
+
+class SessionTokenSigner(object):
+    """Issues and validates signed session tokens.
+
+    A token is <key id>.<user id>.<expiry>.<base64 email>.<HMAC-SHA256 of the rest>,
+    ids and expiry in hex. Validation only computes one HMAC, there is no
+    session table to look up, so a token stays valid until it expires (or its
+    key is removed from the key ring). Keys are a crypto.KeyRing: the first key
+    signs, all keys validate.
+    """
+    def __init__(self, key_ring, lifetime):
+        self.key_ring = key_ring
+        self.lifetime = lifetime
+        # keyed HMAC objects per key id, copying one is cheaper than setting up the key again
+        self._macs = {}
+
+    def issue(self, user_id, email, now = None):
+        key_id = self.key_ring.signing_key_id
+        expires = int(time.time() if now is None else now) + self.lifetime
+        if isinstance(email, unicode):
+            email = email.encode('utf-8')
+        payload = '{0}.{1:x}.{2:x}.{3}'.format(key_id, user_id, expires, _b64_encode(email))
+        return '{0}.{1}'.format(payload, self._sign(key_id, payload))
+
+    def validate(self, token):
+        # returns the Session, None for forged, altered, expired and malformed tokens
+        if not token:
+            return None
+        if isinstance(token, unicode):
+            try:
+                token = token.encode('ascii')
+            except UnicodeError:
+                return None
+        payload, _, signature = token.rpartition('.')
+        parts = payload.split('.')
+        if len(parts) != 4:
+            return None
+        key_id, user_id, expires, email = parts
+        try:
+            expires = int(expires, 16)
+            if expires <= time.time():
+                return None
+            if not hmac.compare_digest(self._sign(key_id, payload) or '', signature):
+                return None
+            return Session(int(user_id, 16), _b64_decode(email), expires, key_id)
+        except (ValueError, TypeError):
+            return None
+
+    def _sign(self, key_id, payload):
+        mac = self._macs.get(key_id)
+        if mac is None:
+            secret = self.key_ring.get_secret(key_id)
+            if secret is None:
+                return None
+            mac = self._macs[key_id] = hmac.new(secret, digestmod = hashlib.sha256)
+        mac = mac.copy()
+        mac.update(payload)
+        return _b64_encode(mac.digest())
+
+class SessionStoreConfig(object):
+    def __init__(self, lifetime = 3600, cache_size = 10000, cache_ttl = 60, touch_interval = 60):
+        self.lifetime = lifetime
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.touch_interval = touch_interval
+
+class SessionStore(object):
+    """Sessions stored in the sessions table, which can be revoked.
+
+    Sessions expire lifetime seconds after they were last validated (sliding
+    expiry). Validated sessions are kept in an LRU+TTL cache, so validation is
+    a lookup in the cache and in the set of revoked session ids in the common
+    case. Extending the expiry is written in batches: a session is extended at
+    most once per touch_interval seconds, a background thread writes all
+    extended sessions with one UPDATE every touch_interval seconds and loads the
+    sessions revoked by other processes, which therefore end within
+    touch_interval seconds as well. Revoked ids are kept until the sessions
+    would have expired.
+    """
+    def __init__(self, session_repository, store_config = None):
+        self._repository = session_repository
+        self.config = store_config or SessionStoreConfig()
+        self.cache = LruTtlCache(self.config.cache_size, self.config.cache_ttl, 'session')
+        # session id -> expires
+        self._revoked = {}
+        self._revoked_checked = time.time()
+        self._touched = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self.last_error = None
+        self._thread = threading.Thread(target = self._run, name = 'session-store')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def create(self, user_id, email):
+        session = Session(user_id, email, int(time.time()) + self.config.lifetime, session_id = _create_session_id())
+        self._repository.create(session.session_id, user_id, email, session.expires)
+        self.cache.put(session.session_id, session)
+        return session
+
+    def validate(self, session_id):
+        # returns the Session, None for unknown, expired and revoked sessions
+        if not session_id or session_id in self._revoked:
+            return None
+        session = self.cache.get(session_id)
+        if session is None:
+            session = self._load(session_id)
+            if session is None:
+                return None
+        now = time.time()
+        if session.expires <= now:
+            self.cache.invalidate(session_id)
+            return None
+        if session.expires - now < self.config.lifetime - self.config.touch_interval:
+            session.expires = int(now) + self.config.lifetime
+            with self._lock:
+                self._touched.add(session_id)
+        return session
+
+    def revoke(self, session_id):
+        session = self.validate(session_id)
+        if session is None:
+            return
+        self._repository.revoke(session_id, int(time.time()))
+        self._add_revoked([(session_id, session.expires)])
+
+    def revoke_user(self, user_id):
+        # e.g. after a password reset, returns the number of revoked sessions
+        revoked = self._repository.revoke_user(user_id, int(time.time()))
+        self._add_revoked(revoked)
+        return len(revoked)
+
+    def flush(self):
+        # writes the extended expiry of the touched sessions
+        with self._lock:
+            touched = self._touched
+            self._touched = set()
+        if not touched:
+            return
+        try:
+            self._repository.touch(touched, int(time.time()) + self.config.lifetime)
+        except:
+            with self._lock:
+                self._touched.update(session_id for session_id in touched if session_id not in self._revoked)
+            raise
+
+    def refresh_revoked(self):
+        # loads the sessions revoked since the last call, also by other processes, and forgets expired ones
+        now = time.time()
+        # the margin covers revocations by servers whose clocks are slightly behind
+        since = int(self._revoked_checked) - self.config.touch_interval
+        self._revoked_checked = now
+        revoked = self._repository.get_revoked_since(since, int(now))
+        with self._lock:
+            for session_id in [key for key, expires in self._revoked.items() if expires <= now]:
+                del self._revoked[session_id]
+        self._add_revoked(revoked)
+
+    def get_revoked_count(self):
+        return len(self._revoked)
+
+    revoked_count = property(get_revoked_count)
+
+    def close(self):
+        self._stopped.set()
+        self._thread.join()
+        self.flush()
+
+    def _load(self, session_id):
+        row = self._repository.get(session_id)
+        if row is None:
+            return None
+        user_id, email, expires, revoked = row
+        if revoked is not None:
+            self._add_revoked([(session_id, expires)])
+            return None
+        session = Session(user_id, email, expires, session_id = session_id)
+        self.cache.put(session_id, session)
+        return session
+
+    def _add_revoked(self, sessions):
+        with self._lock:
+            for session_id, expires in sessions:
+                self._revoked[session_id] = expires
+                self._touched.discard(session_id)
+        for session_id, expires in sessions:
+            self.cache.invalidate(session_id)
+
+    def _run(self):
+        while not self._stopped.wait(self.config.touch_interval):
+            try:
+                self.flush()
+                self.refresh_revoked()
+                self.last_error = None
+            except Exception, e:
+                # touches are written with the next batch, the store must not die because the database was gone for a moment
+                self.last_error = e
+
+def _create_session_id():
+    return _b64_encode(os.urandom(24))
+
+def _b64_encode(text):
+    return base64.urlsafe_b64encode(text).rstrip('=')
+
+def _b64_decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
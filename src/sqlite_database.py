@@ -0,0 +1,119 @@
+import os
+import sqlite3
+from database import DbConnection, User, UserSession, create_login_attempt
+
+class SqliteDialect(object):
+    name = 'sqlite'
+    # SQLITE_MAX_VARIABLE_NUMBER of SQLite before 3.32
+    max_variables = 999
+
+    def now(self):
+        return "datetime('now')"
+
+    def seconds_ago(self):
+        # expects the number of seconds as parameter
+        return "datetime('now', '-' || %s || ' seconds')"
+
+    def age_in_seconds(self, column):
+        return "CAST((julianday('now') - julianday({0})) * 86400 AS INTEGER)".format(column)
+
+    def delete_batch(self, table, condition):
+        # DELETE ... LIMIT is a compile time option of SQLite, the batch is selected by rowid instead
+        return "DELETE FROM {0} WHERE rowid IN (SELECT rowid FROM {0} WHERE {1} LIMIT %s)".format(table, condition)
+
+    def count_schema_objects(self, kind):
+        # expects the name of the table or index as parameter
+        return "SELECT COUNT(*) FROM sqlite_master WHERE type = '{0}' AND name = %s".format(kind)
+
+    def lock_schema(self):
+        return "BEGIN IMMEDIATE"
+
+    def is_schema_locked(self, result):
+        # BEGIN IMMEDIATE raises an OperationalError if the lock is not obtained within the busy timeout
+        return True
+
+    def unlock_schema(self):
+        return "COMMIT"
+
+    def abort_schema_change(self):
+        return "ROLLBACK"
+
+class SqliteConnection(DbConnection):
+    """Pooled connections to a SQLite database file, running in WAL mode.
+
+    Queries are written for MySQLdb, so the %s placeholders are translated to
+    the qmark style of sqlite3 and single parameters are wrapped into a tuple.
+    """
+    dialect = SqliteDialect()
+
+    def __init__(self, db_path, pool_config = None, busy_timeout = 10, pool = None):
+        self.db_path = db_path
+        self.busy_timeout = busy_timeout
+        self._translated = {}
+        super(SqliteConnection, self).__init__(_SqliteConnectionConfig(db_path), pool_config, pool)
+
+    def _prepare_query(self, sql, params):
+        translated = self._translated.get(sql)
+        if translated is None:
+            translated = self._translated[sql] = sql.replace('%s', '?')
+        if params is None:
+            params = ()
+        elif not isinstance(params, (tuple, list)):
+            params = (params,)
+        return translated, params
+
+    def _get_connection_errors(self):
+        return (sqlite3.OperationalError, sqlite3.InterfaceError)
+
+    def _open_streaming_cursor(self, connection):
+        # sqlite3 cursors step through the result on demand
+        return connection.cursor()
+
+    def _open_connection(self):
+        # the pool hands a connection to one thread at a time, but not always to the same one
+        # sqlite3 keeps the compiled statements of a connection by SQL text, the named statements
+        # of database.py and their multi-row variants have to fit in
+        connection = sqlite3.connect(self.db_path, self.busy_timeout, check_same_thread = False, isolation_level = None, cached_statements = 256)
+        # stored password hashes are binary strings
+        connection.text_factory = str
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def _ping_connection(self, connection):
+        connection.execute("SELECT 1")
+
+    def _select_catalog(self, connection):
+        # pools are shared per database file
+        pass
+
+class _SqliteConnectionConfig(object):
+    def __init__(self, db_path):
+        self.db_host = None
+        self.db_user = None
+        self.db_password = None
+        self.db_catalog = db_path
+
+class SqliteBackend(object):
+    def __init__(self, config, pool_config, password_hasher, pool = None):
+        self._owns_pool = pool is None
+        self.db_connection = self.create_connection(config, pool_config, pool)
+        self.user = User(self.db_connection, password_hasher)
+        self.login_attempt = create_login_attempt(self.db_connection, config)
+        self.session = UserSession(self.db_connection)
+
+    @staticmethod
+    def get_endpoint(config):
+        return ('sqlite', os.path.abspath(config.db_path))
+
+    @staticmethod
+    def create_connection(config, pool_config, pool = None):
+        db_connection = SqliteConnection(config.db_path, pool_config, pool = pool)
+        db_connection.warm_up()
+        return db_connection
+
+    def close(self):
+        if self._owns_pool:
+            self.db_connection.dispose()
+        else:
+            self.db_connection.close()
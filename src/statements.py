@@ -0,0 +1,148 @@
+import threading
+from exception import Error
+
+class UnknownStatementError(Error):
+    def __init__(self, name):
+        super(self.__class__, self).__init__("Statement '{0}' is not registered.".format(name))
+
+class Statement(object):
+    """A named SQL statement of the repositories in database.py.
+
+    The SQL is either one template or a dict with a template per dialect name.
+    Templates may use {now}, {seconds_ago} and the ages in seconds {timestamp_age},
+    {token_age}, {created_age} and {last_attempt_age}, which are filled in by the dialect, and {rows}, which is replaced by row_count
+    copies of the row template (multi-row INSERTs, IN lists, CASE branches), joined by row_separator. Statements with a row
+    template may also use {row_list}, row_count comma separated %s for an IN list of one parameter per row.
+    """
+    def __init__(self, name, sql, row = None, row_separator = ", "):
+        self.name = name
+        self.sql = sql
+        self.row = row
+        self.row_separator = row_separator
+
+    def format(self, dialect, row_count = None):
+        template = self.sql[dialect.name] if isinstance(self.sql, dict) else self.sql
+        values = {
+            'now' : dialect.now(),
+            'seconds_ago' : dialect.seconds_ago(),
+            'timestamp_age' : dialect.age_in_seconds('timestamp'),
+            'token_age' : dialect.age_in_seconds('activation_token_requested'),
+            'created_age' : dialect.age_in_seconds('u.created'),
+            'last_attempt_age' : dialect.age_in_seconds('(SELECT MAX(a.timestamp) FROM login_attempts a WHERE a.login = u.email)')
+        }
+        if self.row:
+            values['rows'] = self.row_separator.join([self.row.format(**values)] * row_count)
+            values['row_list'] = ", ".join(["%s"] * row_count)
+        return template.format(**values)
+
+class StatementRegistry(object):
+    def __init__(self, statements = ()):
+        self._statements = {}
+        for statement in statements:
+            self.register(statement)
+
+    def register(self, statement):
+        self._statements[statement.name] = statement
+
+    def get(self, name):
+        statement = self._statements.get(name)
+        if statement is None:
+            raise UnknownStatementError(name)
+        return statement
+
+    def get_names(self):
+        return sorted(self._statements)
+
+STATEMENTS = StatementRegistry([
+    Statement('login_attempt.insert', "INSERT INTO login_attempts (login) VALUES (%s)"),
+    Statement('login_attempt.insert_many', "INSERT INTO login_attempts (login, timestamp) VALUES {rows}", "(%s, {seconds_ago})"),
+    Statement('login_attempt.recent', "SELECT login, {timestamp_age} FROM login_attempts WHERE timestamp > {seconds_ago} ORDER BY timestamp"),
+    Statement('login_attempt.count', "SELECT COUNT(id) FROM login_attempts WHERE login = %s AND timestamp > {seconds_ago}"),
+    Statement('login_attempt_bucket.add', {
+        'mysql' : "INSERT INTO login_attempt_buckets (login, bucket, attempts) VALUES {rows} ON DUPLICATE KEY UPDATE attempts = attempts + VALUES(attempts)",
+        'sqlite' : "INSERT INTO login_attempt_buckets (login, bucket, attempts) VALUES {rows} ON CONFLICT (login, bucket) DO UPDATE SET attempts = attempts + excluded.attempts"
+    }, "(%s, %s, %s)"),
+    Statement('login_attempt_bucket.recent', "SELECT login, bucket, attempts FROM login_attempt_buckets WHERE bucket >= %s ORDER BY bucket"),
+    Statement('login_attempt_bucket.count', "SELECT SUM(attempts) FROM login_attempt_buckets WHERE login = %s AND bucket >= %s"),
+    Statement('user.is_activated', "SELECT is_activated FROM users WHERE email = %s LIMIT 1"),
+    Statement('user.exists', "SELECT id FROM users WHERE email = %s LIMIT 1"),
+    Statement('user.insert', "INSERT INTO users (email, password, salt, activation_token, activation_token_requested, created) VALUES (%s, %s, %s, %s, {now}, {now})"),
+    Statement('user.find_existing', "SELECT email FROM users WHERE email IN ({rows})", "%s"),
+    Statement('user.insert_many', "INSERT INTO users (email, password, salt, activation_token, is_activated, activation_token_requested, created) VALUES {rows}", "(%s, %s, %s, %s, %s, {now}, {now})"),
+    Statement('user.record', "SELECT id, is_activated, salt, password, {token_age} FROM users WHERE email = %s LIMIT 1"),
+    Statement('user.update_activation_token', "UPDATE users SET activation_token = %s, activation_token_requested = {now} WHERE email = %s"),
+    Statement('user.activation_token', "SELECT activation_token FROM users WHERE email = %s AND activation_token_requested > {seconds_ago}"),
+    Statement('user.activate', "UPDATE users SET is_activated = 1 WHERE email = %s"),
+    Statement('user.password', "SELECT salt, password FROM users WHERE email = %s LIMIT 1"),
+    Statement('user.update_password', "UPDATE users SET password = %s WHERE email = %s"),
+    Statement('user.login_state', "SELECT id, is_activated, salt, password FROM users WHERE email = %s LIMIT 1"),
+    # the derived table guarantees a row (and therefore the attempt count) for unknown emails as well
+    Statement('user.login_state_with_attempts', ("SELECT u.id, u.is_activated, u.salt, u.password, "
+        "(SELECT COUNT(id) FROM login_attempts WHERE login = %s AND timestamp > {seconds_ago}) "
+        "FROM (SELECT 1) AS d LEFT JOIN users u ON u.email = %s LIMIT 1")),
+    Statement('user.salt', "SELECT salt FROM users WHERE email = %s LIMIT 1"),
+    Statement('session.insert', "INSERT INTO sessions (id, user_id, email, expires, created) VALUES (%s, %s, %s, %s, {now})"),
+    Statement('session.get', "SELECT user_id, email, expires, revoked FROM sessions WHERE id = %s"),
+    Statement('session.touch', "UPDATE sessions SET expires = %s WHERE id IN ({rows}) AND revoked IS NULL", "%s"),
+    Statement('session.revoke', "UPDATE sessions SET revoked = %s WHERE id = %s AND revoked IS NULL"),
+    Statement('session.active_of_user', "SELECT id, expires FROM sessions WHERE user_id = %s AND revoked IS NULL AND expires > %s"),
+    Statement('session.revoke_user', "UPDATE sessions SET revoked = %s WHERE user_id = %s AND revoked IS NULL"),
+    Statement('session.revoked_since', "SELECT id, expires FROM sessions WHERE revoked >= %s AND expires > %s"),
+    # keyset pagination by id, the activation filter is skipped if its parameter is NULL
+    Statement('user.summaries', ("SELECT u.id, u.email, u.is_activated, {created_age}, {last_attempt_age} FROM users u "
+        "WHERE u.id > %s AND (%s IS NULL OR u.is_activated = %s) ORDER BY u.id LIMIT %s")),
+    Statement('user.summaries_buckets', ("SELECT u.id, u.email, u.is_activated, {created_age}, "
+        "(SELECT MAX(b.bucket) FROM login_attempt_buckets b WHERE b.login = u.email) FROM users u "
+        "WHERE u.id > %s AND (%s IS NULL OR u.is_activated = %s) ORDER BY u.id LIMIT %s")),
+    Statement('user.emails', "SELECT id, email FROM users WHERE id > %s ORDER BY id LIMIT %s"),
+    # expects the ages of the creation window in seconds, the older bound first
+    Statement('user.unactivated', ("SELECT id, email FROM users WHERE id > %s AND is_activated = 0 "
+        "AND created > {seconds_ago} AND created <= {seconds_ago} ORDER BY id LIMIT %s")),
+    # a new token per user in one statement, three parameters per user
+    Statement('user.renew_activation_tokens', ("UPDATE users SET activation_token = CASE id {rows} END, activation_token_requested = {now} "
+        "WHERE id IN ({row_list}) AND is_activated = 0"), "WHEN %s THEN %s", " ")
+])
+
+class StatementCache(object):
+    """The statements of the registry, formatted for one dialect, and their execution counts.
+
+    A formatted statement is the same string object on every call, so drivers
+    which cache prepared statements by SQL text (sqlite3 per connection) parse it
+    once per pooled connection; for MySQLdb, which has no server side prepared
+    statements, the formatting is done only once.
+    """
+    # multi-row statements are cached per row count, a bound for unusual batch sizes
+    MAX_SIZE = 512
+
+    def __init__(self, dialect, registry = STATEMENTS):
+        self._dialect = dialect
+        self._registry = registry
+        self._sql = {}
+        self._names = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def get_sql(self, name, row_count = None):
+        key = (name, row_count)
+        sql = self._sql.get(key)
+        if sql is None:
+            sql = self._registry.get(name).format(self._dialect, row_count)
+            with self._lock:
+                if len(self._sql) >= self.MAX_SIZE:
+                    self._sql.clear()
+                    self._names.clear()
+                self._sql[key] = sql
+                self._names[sql] = name
+        return sql
+
+    def record_execution(self, sql):
+        # returns the name of the statement, None for SQL which is not from the registry
+        name = self._names.get(sql)
+        if name is not None:
+            with self._lock:
+                self._counts[name] = self._counts.get(name, 0) + 1
+        return name
+
+    def get_counts(self):
+        with self._lock:
+            return dict(self._counts)
@@ -0,0 +1,209 @@
+import threading
+import time
+from config import Config
+from exception import Error
+
+class UnknownTenantError(Error):
+    def __init__(self, tenant_key):
+        super(self.__class__, self).__init__("Tenant '{0}' is not configured.".format(tenant_key))
+
+class SharedResources(object):
+    """Reference counted resources, e.g. connection pools, shared by endpoint.
+
+    acquire() creates the resource of an endpoint on first use and returns the
+    same one to every later caller, release() closes it once the last user has
+    released it. Resources are created without holding the lock; of two created
+    for one endpoint at the same time the later one is closed right away. The pool sizes of the configuration which acquired a pool first
+    apply to all configurations sharing it.
+    """
+    def __init__(self):
+        # endpoint -> [resource, reference count, close function]
+        self._entries = {}
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, endpoint, create_func, close_func):
+        with self._lock:
+            entry = self._entries.get(endpoint)
+            if entry is not None:
+                entry[1] += 1
+                return entry[0]
+        # created outside the lock, opening a pool connects to the server and must not hold up other endpoints
+        resource = create_func()
+        with self._lock:
+            entry = self._entries.get(endpoint)
+            if entry is None:
+                entry = self._entries[endpoint] = [resource, 0, close_func]
+                self._endpoints[id(resource)] = endpoint
+            entry[1] += 1
+            shared = entry[0]
+        if shared is not resource:
+            # another caller created the resource of the endpoint in the meantime
+            close_func(resource)
+        return shared
+
+    def release(self, resource):
+        with self._lock:
+            endpoint = self._endpoints[id(resource)]
+            entry = self._entries[endpoint]
+            entry[1] -= 1
+            if entry[1] > 0:
+                return
+            del self._entries[endpoint]
+            del self._endpoints[id(resource)]
+        entry[2](resource)
+
+    def get_count(self):
+        return len(self._entries)
+
+    count = property(get_count)
+
+class _Tenant(object):
+    def __init__(self):
+        # set once the handler has been created (or its creation failed), other requests of the tenant wait for it
+        self.ready = threading.Event()
+        self.auth_handler = None
+        self.error = None
+        self.last_used = time.time()
+        self.in_use = 0
+
+class TenantRegistry(object):
+    """AuthHandlers of many tenants in one process, created on first use.
+
+    config_source maps a tenant key to a config file path or a Config, either as
+    a dict or as a function (returning None for unknown tenants). Files are
+    parsed once per registry. The handlers share their database pools and SMTP
+    sessions per endpoint (see SharedResources), so tenants on the same MySQL
+    server (with the same account, in any catalog) or SMTP relay use the same
+    connections. Handlers which
+    have not been used for idle_timeout seconds are shut down, as is the least
+    recently used one if more than max_tenants are open; evicted tenants are
+    created again on their next request. Handlers used within use() are never
+    evicted while the block runs. A handler is created outside the lock of the
+    registry, so requests of other tenants do not wait for it.
+    """
+    def __init__(self, config_source, idle_timeout = 600, max_tenants = None, mail_delivery_callback = None):
+        self._config_source = config_source
+        self.idle_timeout = idle_timeout
+        self.max_tenants = max_tenants
+        self.mail_delivery_callback = mail_delivery_callback
+        self.resources = SharedResources()
+        self._tenants = {}
+        self._configs = {}
+        self._last_eviction = time.time()
+        self._lock = threading.RLock()
+
+    def get(self, tenant_key):
+        # the handler stays open for at least idle_timeout seconds, use use() for longer running work
+        tenant = self._get_tenant(tenant_key, False)
+        self._evict_if_due()
+        return tenant.auth_handler
+
+    def use(self, tenant_key):
+        return _TenantLease(self, tenant_key)
+
+    def get_tenant_keys(self):
+        with self._lock:
+            return sorted(self._tenants)
+
+    def evict_idle(self):
+        # returns the keys of the evicted tenants
+        evicted = []
+        with self._lock:
+            self._last_eviction = time.time()
+            idle_since = time.time() - self.idle_timeout
+            for tenant_key, tenant in self._tenants.items():
+                if self._is_evictable(tenant) and tenant.last_used < idle_since:
+                    evicted.append((tenant_key, self._tenants.pop(tenant_key)))
+            if self.max_tenants is not None:
+                idle = sorted((tenant.last_used, tenant_key) for tenant_key, tenant in self._tenants.items() if self._is_evictable(tenant))
+                for last_used, tenant_key in idle[:max(len(self._tenants) - self.max_tenants, 0)]:
+                    evicted.append((tenant_key, self._tenants.pop(tenant_key)))
+        for tenant_key, tenant in evicted:
+            tenant.auth_handler.shutdown()
+        return [tenant_key for tenant_key, tenant in evicted]
+
+    def close(self):
+        with self._lock:
+            tenants = self._tenants.values()
+            self._tenants = {}
+        for tenant in tenants:
+            # waits for handlers which are still being created
+            tenant.ready.wait()
+            if tenant.auth_handler:
+                tenant.auth_handler.shutdown()
+
+    def _get_tenant(self, tenant_key, is_lease):
+        # returns the tenant once its handler exists, with is_lease it is marked as in use
+        with self._lock:
+            tenant = self._tenants.get(tenant_key)
+            is_creator = tenant is None
+            if is_creator:
+                tenant = self._tenants[tenant_key] = _Tenant()
+            if is_lease:
+                tenant.in_use += 1
+            tenant.last_used = time.time()
+        if is_creator:
+            self._create_handler(tenant_key, tenant)
+            return tenant
+        tenant.ready.wait()
+        if tenant.error is not None:
+            raise tenant.error
+        return tenant
+
+    def _create_handler(self, tenant_key, tenant):
+        import auth
+        try:
+            tenant.auth_handler = auth.AuthHandler(self._get_config(tenant_key), self.mail_delivery_callback, self.resources)
+        except Exception, e:
+            # the requests waiting for the handler get the same error, the next request tries again
+            tenant.error = e
+            with self._lock:
+                if self._tenants.get(tenant_key) is tenant:
+                    del self._tenants[tenant_key]
+            raise
+        finally:
+            tenant.ready.set()
+
+    def _is_evictable(self, tenant):
+        # has to be called while holding the lock
+        return not tenant.in_use and tenant.ready.is_set()
+
+    def _get_config(self, tenant_key):
+        if callable(self._config_source):
+            config = self._config_source(tenant_key)
+        else:
+            config = self._config_source.get(tenant_key)
+        if config is None:
+            raise UnknownTenantError(tenant_key)
+        if isinstance(config, Config):
+            return config
+        with self._lock:
+            if config in self._configs:
+                return self._configs[config]
+        parsed = Config(config)
+        with self._lock:
+            return self._configs.setdefault(config, parsed)
+
+    def _evict_if_due(self):
+        # idle tenants are looked for at most every tenth of idle_timeout, the size limit on every call
+        over_limit = self.max_tenants is not None and len(self._tenants) > self.max_tenants
+        if over_limit or time.time() - self._last_eviction > self.idle_timeout / 10.0:
+            self.evict_idle()
+
+class _TenantLease(object):
+    def __init__(self, registry, tenant_key):
+        self._registry = registry
+        self._tenant_key = tenant_key
+        self._tenant = None
+
+    def __enter__(self):
+        self._tenant = self._registry._get_tenant(self._tenant_key, True)
+        self._registry._evict_if_due()
+        return self._tenant.auth_handler
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self._registry._lock:
+            self._tenant.in_use -= 1
+            self._tenant.last_used = time.time()
+        return False
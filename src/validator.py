@@ -1,6 +1,12 @@
 import re
 
+_EMAIL_PATTERN = re.compile("^[a-zA-Z0-9\._%\-\+]+@[a-zA-Z0-9\._%\-]+\.[a-zA-Z]{2,6}$")
+
 def is_valid_email(email):
-    if re.match("^[a-zA-Z0-9\._%\-\+]+@[a-zA-Z0-9\._%\-]+\.[a-zA-Z]{2,6}$", email) != None:    
+    if _EMAIL_PATTERN.match(email) != None:    
         return True
     return False   
+
+def get_invalid_emails(emails):
+    match = _EMAIL_PATTERN.match
+    return set(email for email in emails if match(email) is None)
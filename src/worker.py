@@ -0,0 +1,140 @@
+import sys
+import time
+import threading
+import Queue
+from exception import Error
+
+class WorkerPoolClosedError(Error):
+    def __init__(self, name):
+        super(self.__class__, self).__init__("Worker pool '{0}' has been shut down and does not accept new tasks.".format(name))
+
+class FutureTimeoutError(Error):
+    def __init__(self, timeout):
+        super(self.__class__, self).__init__("The result was not available within {0} seconds.".format(timeout))
+
+class Future(object):
+    """Result of a task which gets executed in the background."""
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = None
+        self._exc_info = None
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout = None):
+        if not self._event.wait(timeout):
+            raise FutureTimeoutError(timeout)
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout = None):
+        if not self._event.wait(timeout):
+            raise FutureTimeoutError(timeout)
+        if self._exc_info:
+            return self._exc_info[1]
+        return None
+
+    def add_done_callback(self, callback):
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        self._run_callback(callback)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exc_info):
+        self._exc_info = exc_info
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._event.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        for callback in callbacks:
+            self._run_callback(callback)
+
+    def _run_callback(self, callback):
+        try:
+            callback(self)
+        except Exception:
+            # a failing callback must neither kill the worker nor hide the result from other callbacks
+            pass
+
+class WorkerPool(object):
+    """Fixed number of daemon threads executing submitted functions."""
+    def __init__(self, worker_count, name = 'worker'):
+        self.name = name
+        self._queue = Queue.Queue()
+        self._pending = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._threads = []
+        for i in range(max(int(worker_count), 1)):
+            thread = threading.Thread(target = self._work, name = '{0}-{1}'.format(name, i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, func, *args, **kwargs):
+        future = Future()
+        with self._condition:
+            if self._closed:
+                raise WorkerPoolClosedError(self.name)
+            self._pending += 1
+            # queued under the lock, so a concurrent shutdown() cannot put its sentinels in front of the task
+            self._queue.put((future, func, args, kwargs))
+        return future
+
+    def get_pending_count(self):
+        return self._pending
+
+    pending_count = property(get_pending_count)
+
+    def join(self, timeout = None):
+        # waits until all submitted tasks are done, returns False if the timeout expired before
+        with self._condition:
+            if timeout is None:
+                while self._pending:
+                    self._condition.wait()
+                return True
+            deadline = time.time() + timeout
+            while self._pending:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            return True
+
+    def shutdown(self, wait = True):
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+        for thread in self._threads:
+            self._queue.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+            future, func, args, kwargs = task
+            try:
+                future.set_result(func(*args, **kwargs))
+            except:
+                future.set_exception(sys.exc_info())
+            finally:
+                with self._condition:
+                    self._pending -= 1
+                    self._condition.notify_all()
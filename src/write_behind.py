@@ -0,0 +1,147 @@
+import os
+import threading
+import time
+
+class WriteBehindConfig(object):
+    def __init__(self, batch_size = 100, max_buffer_size = 10000, flush_interval = 2, max_rows = None):
+        self.batch_size = batch_size
+        self.max_buffer_size = max_buffer_size
+        self.flush_interval = flush_interval
+        # the most attempts written with one statement (see DbContext.get_max_rows), None for no limit
+        self.max_rows = max_rows
+
+class WriteBehindLoginAttempt(object):
+    """Buffers failed login attempts and writes them with multi-row INSERTs.
+
+    Offers the same interface as database.LoginAttempt. A background thread writes
+    the buffer as soon as batch_size attempts are buffered, at the latest every
+    flush_interval seconds, at most max_rows with one statement. If the buffer
+    reaches max_buffer_size, the caller writes synchronously, a failed write
+    keeps the unwritten attempts buffered and does not fail the login; while
+    the database is not reachable only the newest max_buffer_size attempts are
+    kept. Counts include the attempts which are not written yet.
+    """
+    def __init__(self, login_attempt, write_behind_config = None):
+        self._login_attempt = login_attempt
+        self.config = write_behind_config or WriteBehindConfig()
+        self._buffer = []
+        self._in_flight = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._timer = None
+        self._pid = None
+        self.last_error = None
+
+    def log_failed_attempt(self, email):
+        self.log_failed_attempts([(email, time.time())])
+
+    def log_failed_attempts(self, attempts):
+        self._reset_after_fork()
+        with self._lock:
+            self._ensure_timer()
+            self._buffer.extend(attempts)
+            size = len(self._buffer)
+        if size >= self.config.max_buffer_size:
+            try:
+                self.flush()
+            except Exception, e:
+                self.last_error = e
+        elif size >= self.config.batch_size:
+            self._wakeup.set()
+
+    def is_locked_out(self, email, login_attempt_expire, login_max_attempts):
+        if self.get_count(email, login_attempt_expire) >= login_max_attempts:
+            return True
+        return False
+
+    def get_count(self, email, login_attempt_expire):
+        # attempts in flight might already be committed when the database counts, so in the worst
+        # case a batch is counted twice for a moment, which errs on the side of locking out
+        count = self._login_attempt.get_count(email, login_attempt_expire)
+        return count + self.get_buffered_count(email, login_attempt_expire)
+
+    def get_buffered_count(self, email, login_attempt_expire):
+        self._reset_after_fork()
+        since = time.time() - login_attempt_expire
+        with self._lock:
+            return len([1 for login, timestamp in self._buffer + self._in_flight if login == email and timestamp > since])
+
+    def get_recent_attempts(self, login_attempt_expire):
+        self._reset_after_fork()
+        since = time.time() - login_attempt_expire
+        with self._lock:
+            buffered = [attempt for attempt in self._buffer + self._in_flight if attempt[1] > since]
+        return self._login_attempt.get_recent_attempts(login_attempt_expire) + buffered
+
+    def get_buffer_size(self):
+        return len(self._buffer)
+
+    buffer_size = property(get_buffer_size)
+
+    def flush(self):
+        self._reset_after_fork()
+        with self._flush_lock:
+            with self._lock:
+                self._in_flight = self._buffer
+                self._buffer = []
+            try:
+                max_rows = self.config.max_rows or len(self._in_flight)
+                while self._in_flight:
+                    written = self._in_flight[:max_rows]
+                    self._login_attempt.log_failed_attempts(written)
+                    with self._lock:
+                        # the database counts them from now on
+                        self._in_flight = self._in_flight[len(written):]
+                self.last_error = None
+            except:
+                with self._lock:
+                    self._buffer[0:0] = self._in_flight
+                    del self._buffer[:-self.config.max_buffer_size]
+                raise
+            finally:
+                with self._lock:
+                    self._in_flight = []
+
+    def close(self):
+        self._closed = True
+        self._wakeup.set()
+        if self._timer and self._timer.is_alive():
+            self._timer.join()
+        self.flush()
+        self._login_attempt.close()
+
+    def _reset_after_fork(self):
+        # locks held by other threads of the parent at fork time would never be released in the child,
+        # and its buffer belongs to the parent, which writes it
+        if self._pid is None or self._pid == os.getpid():
+            return
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._buffer = []
+        self._in_flight = []
+        self._timer = None
+        self._pid = None
+
+    def _ensure_timer(self):
+        # the timer thread does not survive a fork, every process starts its own on first use
+        if self._pid == os.getpid() or self._closed:
+            return
+        self._pid = os.getpid()
+        self._timer = threading.Thread(target = self._run_timer, name = 'login-attempt-writer')
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _run_timer(self):
+        while not self._closed:
+            self._wakeup.wait(self.config.flush_interval)
+            self._wakeup.clear()
+            if self._closed:
+                return
+            try:
+                self.flush()
+            except Exception, e:
+                # the attempts stay buffered and are written with the next batch
+                self.last_error = e
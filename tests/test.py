@@ -1,16 +1,55 @@
+import os
 import sys
+import time
+import tempfile
+import asyncore
+import smtpd
+import smtplib
+import socket
+import threading
 import unittest
-import MySQLdb
+import StringIO
 import datetime
+import re
+import shutil
+import sqlite3
+from email.mime.text import MIMEText
+from email.MIMEMultipart import MIMEMultipart
+from email.Header import Header
 from ConfigParser import SafeConfigParser
 
 sys.path.append('../src')
 import auth
 
 from config import FileNotExistsError
+from config import ConfigWatcher
 from config import SectionMissingError
 from config import MandatoryOptionMissingError
 from database import EmailAlreadyInUseError, EmailTooLongError
+from database import UnknownBackendError, DbConnection, DbConnectionConfig
+from memory_database import MemoryStore, MemoryUserSession
+from pool import ConnectionPool, PoolConfig, PoolExhaustedError
+from outbox import MailOutbox, OutboxConfig
+from worker import WorkerPool, WorkerPoolClosedError
+from mail import MailTemplate, MailTemplateCache, UnknownMailTemplateError
+from mail import template_directory_loader
+from lockout import SharedLockoutTracker, SharedLockoutConfig, SegmentMismatchError
+from write_behind import WriteBehindLoginAttempt, WriteBehindConfig
+from metrics import MetricsRegistry, format_prometheus_text
+from cache import LruTtlCache
+from bloom import BloomFilter, EmailIndex, EmailIndexConfig
+import schema
+from sqlite_database import SqliteConnection
+from retention import RetentionPruner, RetentionConfig
+from admin import UserAdmin
+from campaign import ActivationCampaign, CampaignConfig, CampaignCheckpoint
+from campaign import CheckpointMismatchError
+from session import SessionTokenSigner, SessionStore, SessionStoreConfig
+from tenants import TenantRegistry, UnknownTenantError, SharedResources
+from statements import STATEMENTS, StatementCache
+from database import MySqlDialect
+from sqlite_database import SqliteDialect
+import metrics
 import crypto
 
 
@@ -77,6 +116,83 @@ class ConfigTest(unittest.TestCase):
                 self.assertEqual(getattr(config, name), value)
 
 
+class ConfigReloadTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.config_path = os.path.join(self.directory, 'auth.cfg')
+        self._write_config("login_max_attempts = 5\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write_config(self, options):
+        with open(self.config_path, 'w') as config_file:
+            config_file.write("[auth]\ndb_backend = memory\n" + options)
+
+    def test_watcher(self):
+        configs = []
+        watcher = ConfigWatcher(self.config_path, configs.append)
+        self.assertEqual(watcher.check(), False)
+        self._write_config("login_max_attempts = 10\n")
+        self.assertEqual(watcher.check(), True)
+        self.assertEqual(configs[0].login_max_attempts, 10)
+        self.assertEqual(watcher.check(), False)
+        self._write_config("[broken\n")
+        self.assertEqual(watcher.check(), False)
+        self.assertTrue(watcher.last_error is not None)
+        self.assertEqual(len(configs), 1)
+
+    def test_reload(self):
+        auth_handler = auth.AuthHandler(self.config_path)
+        settings = auth_handler.settings
+        with self.assertRaises(AttributeError):
+            settings.login_max_attempts = 10
+        dispatcher = auth_handler.mail_dispatcher
+        user = auth_handler.get_user(TestConfig.EMAIL_ADDRESS)
+        self._write_config("login_max_attempts = 10\ndb_catalog = other\n")
+        self.assertEqual(auth_handler.reload_config(auth.Config(self.config_path)),
+                         ['login_max_attempts'])
+        self.assertEqual(auth_handler.settings.login_max_attempts, 10)
+        self.assertTrue(auth_handler.mail_dispatcher is dispatcher)
+        self.assertEqual(auth_handler.pending_restart_options, set(['db_catalog']))
+        self.assertEqual(auth_handler.config.db_catalog, None)
+        # a user keeps the snapshot it was created with
+        self.assertEqual(user.settings.login_max_attempts, 5)
+        self._write_config("login_max_attempts = 10\nmail_body = {ACTIVATION_TOKEN}\n"
+                           "session_tokens = true\nsession_token_keys = k:secret\n")
+        self.assertEqual(auth_handler.reload_config(auth.Config(self.config_path)),
+                         ['mail_body', 'session_token_keys', 'session_tokens'])
+        self.assertFalse(auth_handler.mail_dispatcher is dispatcher)
+        self.assertEqual(auth_handler.mail_dispatcher.template, '{ACTIVATION_TOKEN}')
+        self.assertTrue(auth_handler.session_signer is not None)
+        self.assertEqual(auth_handler.reload_config(auth.Config(self.config_path)), [])
+        auth_handler.shutdown()
+
+    def test_watch_interval(self):
+        self._write_config("config_watch_interval = 0.01\n")
+        auth_handler = auth.AuthHandler(self.config_path)
+        self._write_config("config_watch_interval = 0.01\nlogin_max_attempts = 7\n")
+        for i in range(200):
+            if auth_handler.settings.login_max_attempts == 7:
+                break
+            time.sleep(0.01)
+        self.assertEqual(auth_handler.settings.login_max_attempts, 7)
+        auth_handler.shutdown()
+
+    def test_reload_with_shared_lockout(self):
+        shm_path = os.path.join(self.directory, 'lockout.shm')
+        self._write_config("lockout_shm_path = {0}\n".format(shm_path))
+        auth_handler = auth.AuthHandler(self.config_path)
+        self._write_config("lockout_shm_path = {0}\nlogin_max_attempts = 10\n"
+                           "password_min_length = 6\n".format(shm_path))
+        self.assertEqual(auth_handler.reload_config(auth.Config(self.config_path)),
+                         ['password_min_length'])
+        self.assertEqual(auth_handler.pending_restart_options,
+                         set(['login_max_attempts']))
+        self.assertEqual(auth_handler.settings.login_max_attempts, 5)
+        auth_handler.shutdown()
+
+
 class CryptoTest(unittest.TestCase):
     def test_create_salt(self):
         salt = crypto.create_salt()
@@ -94,6 +210,545 @@ class CryptoTest(unittest.TestCase):
         encoded = crypto.b64_encode(text)
         self.assertEqual(text, crypto.b64_decode(encoded))
 
+    def test_signed_activation_token(self):
+        email = TestConfig.EMAIL_ADDRESS
+        old_signer = crypto.ActivationTokenSigner(
+            crypto.KeyRing.parse('a:old secret'), 3600)
+        signer = crypto.ActivationTokenSigner(
+            crypto.KeyRing.parse('b:new secret, a:old secret'), 3600)
+        token = signer.create(email)
+        self.assertTrue(token.startswith('b.'))
+        self.assertTrue(signer.verify(email, token))
+        self.assertFalse(signer.verify('other@example.com', token))
+        self.assertFalse(signer.verify(email, token[:-1]))
+        self.assertFalse(signer.verify(email, 'garbage'))
+        self.assertFalse(signer.verify(email, 'c' + token[1:]))
+        self.assertFalse(old_signer.verify(email, token))
+        self.assertTrue(signer.verify(email, old_signer.create(email)))
+        self.assertFalse(signer.verify(email, signer.create(email, time.time() - 3600)))
+        self.assertFalse(crypto.is_uuid_activation_token(token))
+        self.assertTrue(crypto.is_uuid_activation_token(
+            crypto.create_activation_token()))
+        with self.assertRaises(crypto.InvalidKeyRingError):
+            crypto.KeyRing.parse('')
+        with self.assertRaises(crypto.InvalidKeyRingError):
+            crypto.KeyRing.parse('secret without key id')
+
+
+class CatalogConnection(object):
+    # a MySQL connection as far as the selection of the catalog goes
+    def __init__(self):
+        self.selected = []
+
+    def select_db(self, catalog):
+        self.selected.append(catalog)
+
+
+class TenantRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        shared_path = os.path.join(self.directory, 'shared.cfg')
+        with open(shared_path, 'w') as config_file:
+            config_file.write("[auth]\ndb_backend = sqlite\ndb_path = {0}\n"
+                              "db_schema_mode = migrate\n"
+                              "smtp_keep_alive = true\n".format(
+                                  os.path.join(self.directory, 'shared.db')))
+        own = auth.Config()
+        own.db_backend = 'sqlite'
+        own.db_path = os.path.join(self.directory, 'own.db')
+        own.db_schema_mode = 'migrate'
+        self.configs = {'a': shared_path, 'b': shared_path, 'c': own}
+        self.registry = TenantRegistry(self.configs.get, idle_timeout=60)
+
+    def tearDown(self):
+        self.registry.close()
+        shutil.rmtree(self.directory)
+
+    def test_shared_pools(self):
+        a = self.registry.get('a')
+        b = self.registry.get('b')
+        c = self.registry.get('c')
+        self.assertFalse(a is b)
+        self.assertTrue(a.db_context.db_connection.pool is
+                        b.db_context.db_connection.pool)
+        self.assertFalse(a.db_context.db_connection.pool is
+                         c.db_context.db_connection.pool)
+        self.assertTrue(a._template_mail_dispatcher.session_pool is
+                        b._template_mail_dispatcher.session_pool)
+        self.assertEqual(self.registry.resources.count, 3)
+        self.assertTrue(self.registry.get('a') is a)
+        a.create_users([(TestConfig.EMAIL_ADDRESS, 'abcdefgh')],
+                       mail_mode=auth.ImportMailMode.SKIP)
+        self.assertEqual(b.login(TestConfig.EMAIL_ADDRESS, 'abcdefgh').login_result,
+                         auth.LoginResult.SUCCESS)
+        with self.assertRaises(UnknownTenantError):
+            self.registry.get('unknown')
+
+    def test_catalog_per_checkout(self):
+        pool = ConnectionPool(PoolConfig(0, 1), CatalogConnection,
+                              lambda connection: None)
+        site_a = DbConnection(
+            DbConnectionConfig('localhost', 'user', 'password', 'site_a'),
+            pool=pool)
+        site_b = DbConnection(
+            DbConnectionConfig('localhost', 'user', 'password', 'site_b'),
+            pool=pool)
+        for db_connection in (site_a, site_a, site_b, site_b):
+            db_connection.connect()
+            connection = db_connection.db_connection
+            db_connection.close()
+        self.assertEqual(connection.selected, ['site_a', 'site_b'])
+        self.assertEqual(pool.size, 1)
+
+    def test_resource_created_outside_lock(self):
+        resources = SharedResources()
+        closed = []
+        other = []
+        inner = []
+
+        served = []
+
+        def acquire(endpoint, acquired):
+            thread = threading.Thread(target=lambda: acquired.append(
+                resources.acquire(endpoint, object, closed.append)))
+            thread.daemon = True
+            thread.start()
+            thread.join(5)
+
+        def create():
+            # another endpoint is served while this one is created
+            acquire('other', other)
+            # a concurrent caller creating the same endpoint first
+            acquire('endpoint', inner)
+            served.extend((len(other), len(inner)))
+            return object()
+        outer = resources.acquire('endpoint', create, closed.append)
+        self.assertEqual(served, [1, 1])
+        self.assertTrue(outer is inner[0])
+        self.assertEqual(len(closed), 1)
+        self.assertFalse(closed[0] is outer)
+        resources.release(outer)
+        resources.release(inner[0])
+        resources.release(other[0])
+        self.assertEqual(resources.count, 0)
+        self.assertEqual(len(closed), 3)
+
+    def test_evict_idle(self):
+        a = self.registry.get('a')
+        self.registry.get('b')
+        with self.registry.use('c') as c:
+            self.registry._tenants['a'].last_used -= 61
+            self.registry._tenants['c'].last_used -= 61
+            self.assertEqual(self.registry.evict_idle(), ['a'])
+        self.assertEqual(self.registry.get_tenant_keys(), ['b', 'c'])
+        # b still uses the shared pools
+        self.assertEqual(self.registry.resources.count, 3)
+        self.assertFalse(self.registry.get('a') is a)
+        self.registry.max_tenants = 1
+        self.registry._tenants['a'].last_used -= 1
+        self.registry.get('b')
+        self.assertEqual(self.registry.get_tenant_keys(), ['b'])
+        self.assertEqual(self.registry.resources.count, 2)
+        self.registry.close()
+        self.assertEqual(self.registry.resources.count, 0)
+
+    def test_failed_construction(self):
+        self.registry.get('a')
+        broken = auth.Config(self.configs['a'])
+        broken.activation_token_format = 'jwt'
+        self.configs['d'] = broken
+        with self.assertRaises(crypto.UnknownActivationTokenFormatError):
+            self.registry.get('d')
+        self.assertEqual(self.registry.get_tenant_keys(), ['a'])
+        # the failed handler released its references to the shared pools
+        self.registry.close()
+        self.assertEqual(self.registry.resources.count, 0)
+
+    def test_created_outside_lock(self):
+        entered = threading.Event()
+        release = threading.Event()
+        timeouts = []
+
+        def get_config(tenant_key):
+            if tenant_key == 'slow':
+                entered.set()
+                if not release.wait(5):
+                    timeouts.append(tenant_key)
+            return self.configs.get(tenant_key, self.configs['c'])
+        self.registry = TenantRegistry(get_config, idle_timeout=60)
+        handlers = []
+        slow = threading.Thread(
+            target=lambda: handlers.append(self.registry.get('slow')))
+        slow.start()
+        self.assertTrue(entered.wait(5))
+        # other tenants are served while the slow one is created
+        self.assertTrue(self.registry.get('a') is not None)
+        waiting = threading.Thread(
+            target=lambda: handlers.append(self.registry.get('slow')))
+        waiting.start()
+        release.set()
+        slow.join(5)
+        waiting.join(5)
+        self.assertEqual(timeouts, [])
+        self.assertEqual(len(handlers), 2)
+        self.assertTrue(handlers[0] is handlers[1])
+
+
+class SessionTokenTest(unittest.TestCase):
+    def test_issue_and_validate(self):
+        key_ring = crypto.KeyRing.parse('new:secret 2, old:secret 1')
+        signer = SessionTokenSigner(key_ring, 60)
+        old_signer = SessionTokenSigner(crypto.KeyRing.parse('old:secret 1'), 60)
+        token = signer.issue(42, TestConfig.EMAIL_ADDRESS)
+        session = signer.validate(token)
+        self.assertEqual(session.user_id, 42)
+        self.assertEqual(session.email, TestConfig.EMAIL_ADDRESS)
+        self.assertEqual(session.key_id, 'new')
+        self.assertTrue(0 < session.expires - time.time() <= 60)
+        self.assertEqual(signer.validate(unicode(token)).user_id, 42)
+        self.assertEqual(old_signer.validate(token), None)
+        self.assertEqual(signer.validate(old_signer.issue(1, 'a@b.c')).email, 'a@b.c')
+        self.assertEqual(signer.validate(token.replace('.2a.', '.2b.')), None)
+        self.assertEqual(signer.validate(token[:-2]), None)
+        self.assertEqual(signer.validate('x' + token), None)
+        self.assertEqual(signer.validate(None), None)
+        self.assertEqual(signer.validate(u'\xe4.b.c.d.e'), None)
+        expired = signer.issue(42, TestConfig.EMAIL_ADDRESS, time.time() - 61)
+        self.assertEqual(signer.validate(expired), None)
+
+
+class RecordingSessionRepository(object):
+    def __init__(self):
+        self.session = MemoryUserSession(MemoryStore())
+        self.gets = 0
+        self.touches = []
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+    def get(self, session_id):
+        self.gets += 1
+        return self.session.get(session_id)
+
+    def touch(self, session_ids, expires):
+        self.touches.append(sorted(session_ids))
+        self.session.touch(session_ids, expires)
+
+
+class SessionStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.repository = RecordingSessionRepository()
+        self.store = SessionStore(self.repository,
+                                  SessionStoreConfig(100, touch_interval=3600))
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_cached_validation(self):
+        session = self.store.create(1, TestConfig.EMAIL_ADDRESS)
+        for i in range(10):
+            self.assertEqual(self.store.validate(session.session_id).user_id, 1)
+        self.assertEqual(self.repository.gets, 0)
+        self.store.cache.clear()
+        self.assertEqual(self.store.validate(session.session_id).user_id, 1)
+        self.assertEqual(self.repository.gets, 1)
+
+    def test_sliding_expiry(self):
+        self.store.config.touch_interval = 10
+        first = self.store.create(1, TestConfig.EMAIL_ADDRESS)
+        second = self.store.create(2, 'other@example.com')
+        for session in (first, second):
+            session.expires -= 20
+            for i in range(3):
+                self.store.validate(session.session_id)
+            self.assertTrue(session.expires >= time.time() + 99)
+        self.store.flush()
+        self.store.flush()
+        self.assertEqual(self.repository.touches,
+                         [sorted([first.session_id, second.session_id])])
+        first.expires = time.time() - 1
+        self.assertEqual(self.store.validate(first.session_id), None)
+
+    def test_revoke(self):
+        session = self.store.create(1, TestConfig.EMAIL_ADDRESS)
+        other = self.store.create(1, TestConfig.EMAIL_ADDRESS)
+        self.store.revoke(session.session_id)
+        self.assertEqual(self.store.validate(session.session_id), None)
+        self.assertEqual(self.store.revoked_count, 1)
+        # another process still has the session in its cache until it refreshes
+        other_store = SessionStore(self.repository)
+        self.assertEqual(other_store.validate(other.session_id).user_id, 1)
+        self.assertEqual(self.store.revoke_user(1), 1)
+        self.assertEqual(self.store.validate(other.session_id), None)
+        other_store.refresh_revoked()
+        self.assertEqual(other_store.validate(other.session_id), None)
+        other_store.close()
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.is_open = True
+        self.is_healthy = True
+
+
+class PoolTest(unittest.TestCase):
+    def _get_pool(self, pool_config):
+        def check(connection):
+            return connection.is_healthy
+
+        def close(connection):
+            connection.is_open = False
+
+        return ConnectionPool(pool_config, FakeConnection, close, check)
+
+    def test_reuse_connection(self):
+        pool = self._get_pool(PoolConfig(0, 2))
+        connection = pool.borrow()
+        pool.give_back(connection)
+        self.assertTrue(pool.borrow() is connection)
+        self.assertEqual(pool.size, 1)
+
+    def test_warm_up(self):
+        pool = self._get_pool(PoolConfig(3, 5))
+        pool.warm_up()
+        self.assertEqual(pool.size, 3)
+        self.assertEqual(pool.idle_count, 3)
+
+    def test_max_size(self):
+        pool = self._get_pool(PoolConfig(0, 1, 300, 0))
+        connection = pool.borrow()
+        with self.assertRaises(PoolExhaustedError):
+            pool.borrow()
+        pool.give_back(connection)
+        self.assertTrue(pool.borrow() is connection)
+
+    def test_check_on_borrow(self):
+        pool = self._get_pool(PoolConfig(0, 1))
+        connection = pool.borrow()
+        pool.give_back(connection)
+        connection.is_healthy = False
+        replacement = pool.borrow()
+        self.assertFalse(replacement is connection)
+        self.assertFalse(connection.is_open)
+        self.assertEqual(pool.size, 1)
+
+    def test_close(self):
+        pool = self._get_pool(PoolConfig(2, 2))
+        pool.warm_up()
+        connection = pool.borrow()
+        pool.close()
+        self.assertEqual(pool.size, 1)
+        pool.give_back(connection)
+        self.assertFalse(connection.is_open)
+        self.assertEqual(pool.size, 0)
+
+
+class RecordingLoginAttempt(object):
+    def __init__(self, recent_attempts=None):
+        self.persisted = []
+        self.batches = []
+        self.recent_attempts = recent_attempts or []
+        self.error = None
+
+    def log_failed_attempts(self, attempts):
+        if self.error:
+            raise self.error
+        if attempts:
+            self.batches.append(len(attempts))
+        self.persisted.extend(attempts)
+
+    def get_count(self, email, login_attempt_expire):
+        return len([1 for login, timestamp in self.persisted
+                    if login == email])
+
+    def get_recent_attempts(self, login_attempt_expire):
+        return self.recent_attempts
+
+    def close(self):
+        pass
+
+
+class SharedLockoutTest(unittest.TestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp()
+        os.close(handle)
+        os.remove(self.path)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def _get_tracker(self, login_attempt=None, persist_interval=60,
+                     max_rows=None, max_pending=10000):
+        lockout_config = SharedLockoutConfig(self.path, 64, 3,
+                                             persist_interval, max_rows,
+                                             max_pending)
+        return SharedLockoutTracker(
+            login_attempt or RecordingLoginAttempt(),
+            lockout_config,
+            43200
+        )
+
+    def test_lockout(self):
+        tracker = self._get_tracker()
+        email = TestConfig.EMAIL_ADDRESS
+        for i in range(3):
+            self.assertEqual(tracker.is_locked_out(email, 43200, 3), False)
+            tracker.log_failed_attempt(email)
+        self.assertEqual(tracker.is_locked_out(email, 43200, 3), True)
+        self.assertEqual(tracker.get_count('other@domain.com', 43200), 0)
+        time.sleep(1.1)
+        self.assertEqual(tracker.get_count(email, 1), 0)
+        tracker.close()
+
+    def test_shared_between_processes(self):
+        tracker = self._get_tracker()
+        pid = os.fork()
+        if pid == 0:
+            self._get_tracker().log_failed_attempt('child@domain.com')
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(tracker.get_count('child@domain.com', 43200), 1)
+        tracker.close()
+
+    def test_persist(self):
+        login_attempt = RecordingLoginAttempt()
+        tracker = self._get_tracker(login_attempt, 0)
+        tracker.log_failed_attempt(TestConfig.EMAIL_ADDRESS)
+        self.assertEqual(len(login_attempt.persisted), 1)
+        tracker.close()
+
+    def test_periodic_persist(self):
+        login_attempt = RecordingLoginAttempt()
+        tracker = self._get_tracker(login_attempt, 0.05)
+        tracker.log_failed_attempt(TestConfig.EMAIL_ADDRESS)
+        deadline = time.time() + 5
+        while not login_attempt.persisted and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(login_attempt.persisted), 1)
+        tracker.close()
+
+    def test_persist_within_variable_limit(self):
+        login_attempt = RecordingLoginAttempt()
+        tracker = self._get_tracker(login_attempt, 0, max_rows=2)
+        tracker.log_failed_attempts(
+            [(TestConfig.EMAIL_ADDRESS, time.time())] * 5
+        )
+        self.assertEqual(login_attempt.batches, [2, 2, 1])
+        tracker.close()
+
+    def test_bounded_pending(self):
+        login_attempt = RecordingLoginAttempt()
+        login_attempt.error = Exception('database is not reachable')
+        tracker = self._get_tracker(login_attempt, 0, max_pending=3)
+        for i in range(5):
+            tracker.log_failed_attempts([('user{0}@domain.com'.format(i),
+                                          time.time())])
+        self.assertEqual(tracker.last_error, login_attempt.error)
+        self.assertEqual(tracker.get_count('user0@domain.com', 43200), 1)
+        login_attempt.error = None
+        tracker.flush()
+        self.assertEqual([attempt[0] for attempt in login_attempt.persisted],
+                         ['user2@domain.com', 'user3@domain.com',
+                          'user4@domain.com'])
+        tracker.close()
+
+    def test_segment_mismatch(self):
+        tracker = self._get_tracker()
+        tracker.log_failed_attempt(TestConfig.EMAIL_ADDRESS)
+        size = os.path.getsize(self.path)
+        self.assertRaises(
+            SegmentMismatchError,
+            SharedLockoutTracker,
+            RecordingLoginAttempt(),
+            SharedLockoutConfig(self.path, 64, 5, 60),
+            43200
+        )
+        self.assertEqual(os.path.getsize(self.path), size)
+        self.assertEqual(tracker.get_count(TestConfig.EMAIL_ADDRESS, 43200), 1)
+        tracker.close()
+
+    def test_seed_from_database(self):
+        login_attempt = RecordingLoginAttempt(
+            [(TestConfig.EMAIL_ADDRESS, time.time() - 10)] * 3
+        )
+        tracker = self._get_tracker(login_attempt)
+        self.assertEqual(
+            tracker.is_locked_out(TestConfig.EMAIL_ADDRESS, 43200, 3),
+            True
+        )
+        tracker.close()
+
+
+class WriteBehindTest(unittest.TestCase):
+    def test_batch(self):
+        login_attempt = RecordingLoginAttempt()
+        writer = WriteBehindLoginAttempt(
+            login_attempt,
+            WriteBehindConfig(5, 100, 60)
+        )
+        for i in range(4):
+            writer.log_failed_attempt(TestConfig.EMAIL_ADDRESS)
+        self.assertEqual(login_attempt.persisted, [])
+        self.assertEqual(writer.get_count(TestConfig.EMAIL_ADDRESS, 60), 4)
+        writer.log_failed_attempt(TestConfig.EMAIL_ADDRESS)
+        # the buffer is empty before the batch is written, so wait for the batch
+        deadline = time.time() + 5
+        while not login_attempt.batches and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(login_attempt.batches, [5])
+        self.assertEqual(writer.get_count(TestConfig.EMAIL_ADDRESS, 60), 5)
+        writer.close()
+
+    def test_flush_on_close(self):
+        login_attempt = RecordingLoginAttempt()
+        writer = WriteBehindLoginAttempt(
+            login_attempt,
+            WriteBehindConfig(100, 100, 60)
+        )
+        writer.log_failed_attempt(TestConfig.EMAIL_ADDRESS)
+        writer.log_failed_attempt('other@domain.com')
+        writer.close()
+        self.assertEqual(login_attempt.batches, [2])
+
+    def test_flush_within_variable_limit(self):
+        login_attempt = RecordingLoginAttempt()
+        writer = WriteBehindLoginAttempt(
+            login_attempt,
+            WriteBehindConfig(100, 100, 60, 2)
+        )
+        for i in range(5):
+            writer.log_failed_attempt(TestConfig.EMAIL_ADDRESS)
+        writer.close()
+        self.assertEqual(login_attempt.batches, [2, 2, 1])
+
+    def test_bounded_buffer(self):
+        login_attempt = RecordingLoginAttempt()
+        writer = WriteBehindLoginAttempt(
+            login_attempt,
+            WriteBehindConfig(100, 3, 60)
+        )
+        for i in range(3):
+            writer.log_failed_attempt(TestConfig.EMAIL_ADDRESS)
+        self.assertEqual(login_attempt.batches, [3])
+        self.assertEqual(writer.buffer_size, 0)
+        writer.close()
+
+    def test_failed_synchronous_flush(self):
+        login_attempt = RecordingLoginAttempt()
+        login_attempt.error = Exception('database is not reachable')
+        writer = WriteBehindLoginAttempt(
+            login_attempt,
+            WriteBehindConfig(100, 3, 60)
+        )
+        for i in range(3):
+            writer.log_failed_attempt(TestConfig.EMAIL_ADDRESS)
+        self.assertEqual(writer.last_error, login_attempt.error)
+        self.assertEqual(writer.buffer_size, 3)
+        self.assertEqual(writer.get_count(TestConfig.EMAIL_ADDRESS, 60), 3)
+        login_attempt.error = None
+        writer.close()
+        self.assertEqual(login_attempt.batches, [3])
+
 
 class DatabaseTest(unittest.TestCase):
     def setUp(self):
@@ -124,12 +779,19 @@ class TestMailDispatcher(auth.MailDispatcher):
     def __init__(self, mail_config):
         super(self.__class__, self).__init__(mail_config)
         self.activation_token = None
+        self.batches = []
 
     def send_mail(self, from_addr, receiver_addr, subject,
                   template_fill_args_dictionary):
         token = "{ACTIVATION_TOKEN}"
         self.activation_token = template_fill_args_dictionary[token]
 
+    def send_many(self, messages):
+        self.batches.append([message[1] for message in messages])
+        for message in messages:
+            self.send_mail(*message)
+        return [None] * len(messages)
+
 
 class MailTest(unittest.TestCase):
     def test_send(self):
@@ -187,6 +849,323 @@ class MailTest(unittest.TestCase):
             )
 
 
+class MailTemplateTest(unittest.TestCase):
+    ARGS = {"{ACTIVATION_TOKEN}": "1234567890", "{EMAIL_IDENTIFIER}": "dXNlcg"}
+
+    def _get_stdlib_message(self, subject, body, body_html=None):
+        if body_html:
+            msg = MIMEMultipart('alternative')
+        else:
+            msg = MIMEText(body.encode('utf-8'), 'plain', 'UTF-8')
+        msg['Subject'] = Header(subject.encode('utf-8'), 'UTF-8').encode()
+        msg['From'] = 'from@domain.com'
+        msg['To'] = 'to@domain.com'
+        if body_html:
+            msg.preamble = 'This is a multi-part message in MIME format.'
+            msg.attach(MIMEText(body.encode('utf-8'), 'plain', 'UTF-8'))
+            msg.attach(MIMEText(body_html.encode('utf-8'), 'html', 'UTF-8'))
+        return msg.as_string()
+
+    def test_render(self):
+        template = MailTemplate(
+            u"Token {ACTIVATION_TOKEN} for {EMAIL_IDENTIFIER}, {UNKNOWN} {",
+            u"<b>{ACTIVATION_TOKEN}</b>"
+        )
+        self.assertEqual(template.render(self.ARGS), (
+            u"Token 1234567890 for dXNlcg, {UNKNOWN} {",
+            u"<b>1234567890</b>"
+        ))
+        self.assertEqual(MailTemplate("no placeholders").render(self.ARGS),
+                         ("no placeholders", None))
+
+    def test_message_matches_email_package(self):
+        dispatcher = auth.MailDispatcher(auth.MailConfig(auth.Config()))
+        boundary = re.compile(r'={15}\d{19}==')
+        body = u"\xdcnic\xF6d\xC9 " * 20 + u"\nFrom here on\n"
+        for subject, body_html in [
+            (u"\xdcnic\xF6d\xC9 test", None),
+            ("A subject which is long enough to be folded by the header "
+             "encoding of the email package", u"<b>\xdc</b>\nFrom x=y")
+        ]:
+            expected = self._get_stdlib_message(subject, body, body_html)
+            msg = dispatcher._get_message_string(
+                'from@domain.com', 'to@domain.com', subject, body, body_html)
+            self.assertEqual(boundary.sub('B', msg),
+                             boundary.sub('B', expected))
+
+    def test_named_templates(self):
+        directory = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(directory, 'de.txt'), 'w') as f:
+                f.write(u"Hallo \xdc {ACTIVATION_TOKEN}".encode('utf-8'))
+            with open(os.path.join(directory, 'de.html'), 'w') as f:
+                f.write("<p>{ACTIVATION_TOKEN}</p>")
+            with open(os.path.join(directory, 'fr.txt'), 'w') as f:
+                f.write("Bonjour {ACTIVATION_TOKEN}")
+            templates = MailTemplateCache(
+                template_directory_loader(directory), 1)
+            templates.add('en', "Hello {ACTIVATION_TOKEN}")
+            self.assertEqual(templates.get('de').render(self.ARGS), (
+                u"Hallo \xdc 1234567890", u"<p>1234567890</p>"))
+            self.assertEqual(templates.get('fr').render(self.ARGS),
+                             (u"Bonjour 1234567890", None))
+            self.assertEqual(templates.get('en').render(self.ARGS),
+                             ("Hello 1234567890", None))
+            # loaded templates are bounded, added ones are kept
+            self.assertEqual(templates.cache.get_stats()['size'], 1)
+            self.assertEqual(templates.cache.get_stats()['evictions'], 1)
+            for name in ('es', '../de', '.de'):
+                with self.assertRaises(UnknownMailTemplateError):
+                    templates.get(name)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_dispatcher_template_name(self):
+        dispatcher = auth.TemplateMailDispatcher(
+            auth.MailConfig(auth.Config()), "Default {ACTIVATION_TOKEN}")
+        dispatcher.add_template('reminder', "Reminder {ACTIVATION_TOKEN}")
+        sent = []
+        dispatcher._send_mail = lambda *args: sent.append(args[3])
+        dispatcher.send_mail('from@domain.com', 'to@domain.com', 'subject',
+                             self.ARGS)
+        dispatcher.send_mail('from@domain.com', 'to@domain.com', 'subject',
+                             self.ARGS, 'reminder')
+        self.assertEqual(sent, ["Default 1234567890", "Reminder 1234567890"])
+        with self.assertRaises(UnknownMailTemplateError):
+            dispatcher.send_mail('from@domain.com', 'to@domain.com',
+                                 'subject', self.ARGS, 'missing')
+
+
+class LocalSmtpServer(smtpd.SMTPServer):
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.connection_count = 0
+        self.received = []
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._running = True
+        self._thread.start()
+
+    def handle_accept(self):
+        self.connection_count += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.received.append(rcpttos[0])
+
+    def _serve(self):
+        while self._running:
+            asyncore.loop(timeout=0.01, count=1)
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+        self.close()
+
+
+class ScriptedSmtpServer(object):
+    def __init__(self, failures):
+        # receiver -> exceptions raised by the next sendmail calls for it
+        self.failures = failures
+        self.sent = []
+        self.closed = False
+
+    def sendmail(self, from_addr, receiver_addr, msg_string):
+        if self.failures.get(receiver_addr):
+            raise self.failures[receiver_addr].pop(0)
+        self.sent.append(receiver_addr)
+
+    def quit(self):
+        raise socket.error("connection reset")
+
+    def close(self):
+        self.closed = True
+
+
+class ScriptedMailDispatcher(auth.MailDispatcher):
+    def __init__(self, mail_config, failures, connect_failures=0):
+        super(ScriptedMailDispatcher, self).__init__(mail_config)
+        self.failures = failures
+        self.connect_failures = connect_failures
+        self.servers = []
+
+    def _connect(self):
+        if self.connect_failures:
+            self.connect_failures -= 1
+            raise socket.error("connection refused")
+        self.servers.append(ScriptedSmtpServer(self.failures))
+        return self.servers[-1]
+
+
+class SmtpErrorTest(unittest.TestCase):
+    def _send_many(self, dispatcher, receivers):
+        return dispatcher.send_many([
+            ('from@domain.com', receiver, 'subject', u'body')
+            for receiver in receivers
+        ])
+
+    def test_send_many_errors(self):
+        refused = smtplib.SMTPRecipientsRefused({})
+        failures = {
+            'refused@domain.com': [refused],
+            'dropped@domain.com': [socket.error("reset")],
+            'lost@domain.com': [socket.error("reset"), socket.error("reset")]
+        }
+        config = auth.Config()
+        config.smtp_keep_alive = True
+        dispatcher = ScriptedMailDispatcher(auth.MailConfig(config), failures)
+        errors = self._send_many(dispatcher, [
+            'a@domain.com', 'refused@domain.com', 'dropped@domain.com',
+            'lost@domain.com', 'b@domain.com'
+        ])
+        self.assertEqual(errors[:3], [None, refused, None])
+        self.assertTrue(isinstance(errors[3], socket.error))
+        self.assertEqual(errors[4], None)
+        # the dropped sessions were discarded and closed, not given back to the pool
+        self.assertEqual([server.closed for server in dispatcher.servers],
+                         [True, True, True, False])
+        self.assertEqual(dispatcher.session_pool.idle_count, 1)
+        dispatcher.close()
+
+    def test_send_many_unreachable(self):
+        dispatcher = ScriptedMailDispatcher(
+            auth.MailConfig(auth.Config()), {}, 1)
+        errors = self._send_many(dispatcher, ['a@domain.com', 'b@domain.com'])
+        self.assertTrue(all(isinstance(error, socket.error)
+                            for error in errors))
+        self.assertEqual(len(errors), 2)
+
+
+class SmtpSessionTest(unittest.TestCase):
+    def setUp(self):
+        self.server = LocalSmtpServer()
+        self.config = auth.Config()
+        self.config.smtp_host = '127.0.0.1'
+        self.config.smtp_port = self.server.port
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_send_many(self):
+        dispatcher = auth.MailDispatcher(auth.MailConfig(self.config))
+        messages = [
+            ('from@domain.com', 'to{0}@domain.com'.format(i), 'subject',
+             u'body \xdcnic\xF6d\xC9')
+            for i in range(5)
+        ]
+        self.assertEqual(dispatcher.send_many(messages), [None] * 5)
+        self.assertEqual(len(self.server.received), 5)
+        self.assertEqual(self.server.connection_count, 1)
+
+    def test_keep_alive(self):
+        self.config.smtp_keep_alive = True
+        self.config.smtp_noop_interval = 0
+        dispatcher = auth.TemplateMailDispatcher(
+            auth.MailConfig(self.config),
+            self.config.mail_body
+        )
+        for i in range(3):
+            dispatcher.send_mail(
+                'from@domain.com',
+                'to{0}@domain.com'.format(i),
+                'subject',
+                {"{ACTIVATION_TOKEN}": "1234567890"}
+            )
+        self.assertEqual(len(self.server.received), 3)
+        self.assertEqual(self.server.connection_count, 1)
+        dispatcher.close()
+
+
+class FlakyMailDispatcher(object):
+    def __init__(self, failures):
+        self.failures = failures
+        self.sent = []
+
+    def send_mail(self, from_addr, receiver_addr, subject,
+                  template_fill_args_dictionary):
+        if self.failures:
+            self.failures -= 1
+            raise IOError("SMTP relay not available")
+        self.sent.append(receiver_addr)
+
+
+class OutboxTest(unittest.TestCase):
+    def test_deliver(self):
+        dispatcher = FlakyMailDispatcher(0)
+        outbox = MailOutbox(dispatcher, OutboxConfig(2, 0, 0))
+        futures = [
+            outbox.send_mail('from@domain.com', 'to{0}@domain.com'.format(i),
+                             'subject', {})
+            for i in range(10)
+        ]
+        self.assertEqual(outbox.flush(5), True)
+        self.assertEqual(all(future.done() for future in futures), True)
+        self.assertEqual(len(dispatcher.sent), 10)
+        outbox.shutdown()
+
+    def test_retry(self):
+        delivered = []
+        dispatcher = FlakyMailDispatcher(2)
+        outbox = MailOutbox(dispatcher, OutboxConfig(1, 2, 0.01),
+                            delivered.append)
+        future = outbox.send_mail('from@domain.com', 'to@domain.com',
+                                  'subject', {})
+        future.result(5)
+        outbox.shutdown()
+        self.assertEqual(dispatcher.sent, ['to@domain.com'])
+        self.assertEqual(delivered, [future])
+
+    def test_give_up(self):
+        dispatcher = FlakyMailDispatcher(3)
+        outbox = MailOutbox(dispatcher, OutboxConfig(1, 1, 0.01))
+        future = outbox.send_mail('from@domain.com', 'to@domain.com',
+                                  'subject', {})
+        with self.assertRaises(IOError):
+            future.result(5)
+        outbox.shutdown()
+        self.assertEqual(dispatcher.sent, [])
+
+    def test_backoff_does_not_block_workers(self):
+        dispatcher = FlakyMailDispatcher(1)
+        outbox = MailOutbox(dispatcher, OutboxConfig(1, 1, 0.5))
+        first = outbox.send_mail('from@domain.com', 'first@domain.com',
+                                 'subject', {})
+        second = outbox.send_mail('from@domain.com', 'second@domain.com',
+                                  'subject', {})
+        # the only worker delivers the second mail while the first one waits for its retry
+        second.result(0.4)
+        self.assertEqual(dispatcher.sent, ['second@domain.com'])
+        self.assertFalse(first.done())
+        self.assertEqual(outbox.flush(5), True)
+        self.assertEqual(dispatcher.sent,
+                         ['second@domain.com', 'first@domain.com'])
+        outbox.shutdown()
+
+
+class WorkerPoolTest(unittest.TestCase):
+    def test_shutdown_while_submitting(self):
+        for i in range(20):
+            pool = WorkerPool(2, 'test')
+            futures = []
+
+            def submit():
+                for j in range(50):
+                    try:
+                        futures.append(pool.submit(lambda: j))
+                    except WorkerPoolClosedError:
+                        return
+
+            threads = [threading.Thread(target=submit) for j in range(4)]
+            for thread in threads:
+                thread.start()
+            pool.shutdown()
+            for thread in threads:
+                thread.join()
+            # every accepted task has run
+            self.assertEqual(pool.join(5), True)
+            self.assertTrue(all(future.done() for future in futures))
+
 class ValidatorTest(unittest.TestCase):
     def test_validate_email(self):
         self.assertEqual(
@@ -250,6 +1229,25 @@ class AuthTest(unittest.TestCase):
         user = auth_handler.login(TestConfig.EMAIL_ADDRESS, password)
         self.assertEqual(user.is_logged_in, True)
 
+    def test_activate_twice(self):
+        config = auth.Config(Files.CLEAN_CONFIG)
+        auth_handler = self._get_initialized_test_auth_handler(config)
+        user = auth_handler.create_user(TestConfig.EMAIL_ADDRESS, 'abcdef')
+        uuid_token = user.mail_dispatcher.activation_token
+        self.assertEqual(user.activate(uuid_token), True)
+        self.assertEqual(user.activate(uuid_token), True)
+        config.activation_token_format = 'signed'
+        config.activation_token_keys = 'k1:secret'
+        auth_handler = self._get_initialized_test_auth_handler(config)
+        # the UPDATE of an activated user changes no row on MySQL
+        signed_token = auth_handler.token_signer.create(TestConfig.EMAIL_ADDRESS)
+        user = auth_handler.get_user(TestConfig.EMAIL_ADDRESS)
+        self.assertEqual(user.activate(signed_token), True)
+        self.assertEqual(user.activate(signed_token), True)
+        missing = auth_handler.get_user('missing@example.com')
+        self.assertEqual(missing.activate(
+            auth_handler.token_signer.create(missing.email)), False)
+
     def test_login(self):
         auth_handler = auth.AuthHandler(Files.CLEAN_CONFIG)
         user = auth_handler.login('abc', 'password')
@@ -317,7 +1315,40 @@ class AuthTest(unittest.TestCase):
         )
         self.assertEqual(get_login_count, 6)
 
+    def test_single_query_login(self):
+        password = 'abcdef'
+        wrong_password = 'wrong_password'
+        config = auth.Config(Files.CLEAN_CONFIG)
+        config.login_single_query = True
+        auth_handler = self._get_initialized_test_auth_handler(config)
+        user = auth_handler.create_user(TestConfig.EMAIL_ADDRESS, password)
+        self.assertEqual(user.login(password), False)
+        self.assertEqual(
+            user.login_result,
+            auth.LoginResult.USER_IS_NOT_ACTIVATED
+        )
+        user.activate(user.mail_dispatcher.activation_token)
+        self.assertEqual(user.login(password), True)
+        self.assertEqual(user.login_result, auth.LoginResult.SUCCESS)
+        for i in range(config.login_max_attempts):
+            user.login(wrong_password)
+            self.assertEqual(
+                user.login_result,
+                auth.LoginResult.USER_OR_PASSWORD_WRONG
+            )
+        self.assertEqual(user.login(password), False)
+        self.assertEqual(
+            user.login_result,
+            auth.LoginResult.USER_IS_LOCKED_OUT
+        )
+        user = auth_handler.login('unknown@domain.com', password)
+        self.assertEqual(
+            user.login_result,
+            auth.LoginResult.USER_IS_NOT_ACTIVATED
+        )
+
     def _insert_login_attempt_with_date(self, config, login, date):
+        import MySQLdb
         connection = MySQLdb.connect(
             config.db_host,
             config.db_user,
@@ -343,8 +1374,950 @@ class AuthTest(unittest.TestCase):
         self.assertEqual(settings.password_min_length, value)
 
 
+class BatchMailDispatcher(object):
+    def __init__(self, failing_emails=()):
+        self.failing_emails = failing_emails
+        self.tokens = {}
+        self.sent = []
+
+    def send_many(self, messages):
+        errors = []
+        for message in messages:
+            self.sent.append(message[1])
+            self.tokens[message[1]] = message[3]["{ACTIVATION_TOKEN}"]
+            if message[1] in self.failing_emails:
+                errors.append(smtplib.SMTPRecipientsRefused({}))
+            else:
+                errors.append(None)
+        return errors
+
+
+class InterruptingMailDispatcher(BatchMailDispatcher):
+    # hands the batch to the SMTP server, then the campaign is interrupted
+    def send_many(self, messages):
+        super(InterruptingMailDispatcher, self).send_many(messages)
+        raise KeyboardInterrupt()
+
+
+class BackendTestMixin(object):
+    # the options selecting the backend under test
+    backend_options = {}
+
+    def _get_config(self):
+        config = auth.Config()
+        for name, value in self.backend_options.items():
+            setattr(config, name, value)
+        return config
+
+    def _get_auth_handler(self, config=None):
+        config = config if config else self._get_config()
+        auth_handler = auth.AuthHandler(config)
+        auth_handler.mail_dispatcher = TestMailDispatcher(
+            auth.MailConfig(config)
+        )
+        return auth_handler
+
+    def test_create_and_login(self):
+        auth_handler = self._get_auth_handler()
+        password = 'abcdefgh'
+        user = auth_handler.create_user(TestConfig.EMAIL_ADDRESS, password)
+        with self.assertRaises(EmailAlreadyInUseError):
+            auth_handler.create_user(TestConfig.EMAIL_ADDRESS, password)
+        self.assertEqual(user.login(password), False)
+        self.assertEqual(
+            user.login_result,
+            auth.LoginResult.USER_IS_NOT_ACTIVATED
+        )
+        self.assertEqual(user.activate('wrong_token'), False)
+        user.resend_activation_email()
+        self.assertEqual(
+            user.activate(user.mail_dispatcher.activation_token),
+            True
+        )
+        self.assertEqual(user.login(password), True)
+        self.assertEqual(user.login('wrong_password'), False)
+        self.assertEqual(
+            user.login_result,
+            auth.LoginResult.USER_OR_PASSWORD_WRONG
+        )
+        auth_handler.shutdown()
+
+    def test_lockout(self):
+        config = self._get_config()
+        auth_handler = self._get_auth_handler(config)
+        password = 'abcdefgh'
+        user = auth_handler.create_user(TestConfig.EMAIL_ADDRESS, password)
+        user.activate(user.mail_dispatcher.activation_token)
+        for i in range(config.login_max_attempts):
+            user.login('wrong_password')
+        self.assertEqual(
+            auth_handler._db_context.login_attempt.get_count(
+                user.email,
+                config.login_attempt_expire
+            ),
+            config.login_max_attempts
+        )
+        self.assertEqual(user.login(password), False)
+        self.assertEqual(
+            user.login_result,
+            auth.LoginResult.USER_IS_LOCKED_OUT
+        )
+        config.login_single_query = True
+        user = self._get_auth_handler(config).login(user.email, password)
+        self.assertEqual(
+            user.login_result,
+            auth.LoginResult.USER_IS_LOCKED_OUT
+        )
+        auth_handler.shutdown()
+
+
+    def test_create_users(self):
+        auth_handler = self._get_auth_handler()
+        auth_handler.create_user('existing@domain.com', 'abcdefgh')
+        records = [
+            ('user{0}@domain.com'.format(i), 'password{0}'.format(i))
+            for i in range(7)
+        ]
+        records += [
+            ('existing@domain.com', 'abcdefgh'),
+            ('user1@domain.com', 'abcdefgh'),
+            ('...@wz', 'abcdefgh'),
+            ('short@domain.com', '123'),
+            ('{0}@domain.com'.format('a' * 100), 'abcdefgh')
+        ]
+        results = auth_handler.create_users(records, 3)
+        self.assertEqual([result.status for result in results],
+                         [auth.ImportStatus.CREATED] * 7 + [
+                             auth.ImportStatus.ALREADY_EXISTS,
+                             auth.ImportStatus.ALREADY_EXISTS,
+                             auth.ImportStatus.EMAIL_IS_INVALID,
+                             auth.ImportStatus.PASSWORD_TOO_SHORT,
+                             auth.ImportStatus.EMAIL_TOO_LONG])
+        self.assertEqual([len(batch) for batch in
+                          auth_handler.mail_dispatcher.batches], [3, 3, 1])
+        self.assertEqual([result.mail_error for result in results[:7]],
+                         [None] * 7)
+        user = auth_handler.get_user('user6@domain.com')
+        self.assertEqual(user.mail_dispatcher.activation_token,
+                         results[6].activation_token)
+        user.activate(results[6].activation_token)
+        self.assertEqual(user.login('password6'), True)
+        auth_handler.shutdown()
+
+    def test_create_users_without_mail(self):
+        auth_handler = self._get_auth_handler()
+        records = [('user@domain.com', 'abcdefgh'),
+                   ('user@domain.com', 'abcdefgh')]
+        results = auth_handler.create_users(
+            records,
+            mail_mode=auth.ImportMailMode.SKIP,
+            hash_workers=2
+        )
+        self.assertEqual(results[1].status,
+                         auth.ImportStatus.DUPLICATE_IN_IMPORT)
+        self.assertEqual(auth_handler.mail_dispatcher.activation_token, None)
+        user = auth_handler.get_user('user@domain.com')
+        self.assertEqual(user.login('abcdefgh'), True)
+        auth_handler.shutdown()
+
+
+    def test_rehash_on_login(self):
+        config = self._get_config()
+        config.login_single_query = True
+        auth_handler = self._get_auth_handler(config)
+        results = auth_handler.create_users(
+            [(TestConfig.EMAIL_ADDRESS, 'abcdefgh')],
+            mail_mode=auth.ImportMailMode.SKIP
+        )
+        self.assertEqual(results[0].status, auth.ImportStatus.CREATED)
+        auth_handler.shutdown()
+        for single_query in (True, False):
+            config.password_kdf = crypto.PBKDF2_KDF
+            config.password_kdf_iterations = 1000 if single_query else 2000
+            config.login_single_query = single_query
+            auth_handler = self._get_auth_handler(config)
+            user = auth_handler.login(TestConfig.EMAIL_ADDRESS, 'abcdefgh')
+            self.assertEqual(user.login_result, auth.LoginResult.SUCCESS)
+            state = auth_handler._db_context.get_login_state(
+                user.email, config.login_attempt_expire
+            )
+            self.assertEqual(
+                state.password.startswith('$pbkdf2-sha512$i={0}$'.format(
+                    config.password_kdf_iterations)),
+                True
+            )
+            self.assertEqual(user.login('abcdefgh'), True)
+            self.assertEqual(user.login('wrong_password'), False)
+            auth_handler.shutdown()
+
+    def test_user_cache(self):
+        config = self._get_config()
+        config.user_cache_size = 10
+        auth_handler = self._get_auth_handler(config)
+        password = 'abcdefgh'
+        user = auth_handler.create_user(TestConfig.EMAIL_ADDRESS, password)
+        self.assertEqual(user.login(password), False)
+        self.assertEqual(
+            user.activate(user.mail_dispatcher.activation_token),
+            True
+        )
+        self.assertEqual(user.is_activated, 1)
+        self.assertEqual(user.login(password), True)
+        self.assertEqual(user.login('wrong_password'), False)
+        stats = auth_handler.db_context.user_cache.get_stats()
+        self.assertEqual(stats['size'], 1)
+        # the activation invalidated the row, the next read loaded it again
+        self.assertEqual(stats['misses'], 2)
+        self.assertTrue(stats['hits'] >= 4)
+        # not cached, answered by the backend
+        self.assertEqual(
+            auth_handler.db_context.user.find_existing(
+                [TestConfig.EMAIL_ADDRESS, 'other@domain.com']),
+            set([TestConfig.EMAIL_ADDRESS])
+        )
+        auth_handler.shutdown()
+
+    def test_signed_activation_token(self):
+        config = self._get_config()
+        auth_handler = self._get_auth_handler(config)
+        auth_handler.create_user('other@example.com', 'abcdefgh')
+        uuid_token = auth_handler.mail_dispatcher.activation_token
+        auth_handler.create_user(TestConfig.EMAIL_ADDRESS, 'abcdefgh')
+        config.activation_token_format = 'signed'
+        config.activation_token_keys = 'k1:secret'
+        auth_handler = self._get_auth_handler(config)
+        # links sent before the switch are checked against the database
+        other = auth_handler.get_user('other@example.com')
+        self.assertEqual(other.activate(uuid_token), True)
+        self.assertEqual(other.activate(uuid_token), True)
+        user = auth_handler.resend_activation_email(TestConfig.EMAIL_ADDRESS)
+        signed_token = auth_handler.mail_dispatcher.activation_token
+        self.assertTrue(signed_token.startswith('k1.'))
+        self.assertEqual(user.activate(signed_token + 'x'), False)
+        self.assertEqual(user.is_activated, 0)
+        self.assertEqual(user.activate(signed_token), True)
+        self.assertEqual(user.is_activated, 1)
+        # a second click on the link
+        self.assertEqual(user.activate(signed_token), True)
+        # MySQL reports no updated row for a user which was activated already
+        auth_handler.db_context.user.mark_activated = lambda email: 0
+        self.assertEqual(user.activate(signed_token), True)
+        self.assertEqual(user.login('abcdefgh'), True)
+        # a valid signature of an email without a user
+        missing = auth_handler.get_user('missing@example.com')
+        self.assertEqual(missing.activate(
+            auth_handler.token_signer.create(missing.email)), False)
+        config.activation_token_format = 'jwt'
+        with self.assertRaises(crypto.UnknownActivationTokenFormatError):
+            auth.AuthHandler(config)
+
+    def test_session_token(self):
+        config = self._get_config()
+        config.session_tokens = True
+        config.session_token_keys = 's1:secret'
+        auth_handler = self._get_auth_handler(config)
+        user = auth_handler.create_user(TestConfig.EMAIL_ADDRESS, 'abcdefgh')
+        user.activate(user.mail_dispatcher.activation_token)
+        self.assertEqual(user.session_token, None)
+        for single_query in (False, True):
+            config.login_single_query = single_query
+            auth_handler = self._get_auth_handler(config)
+            self.assertEqual(
+                auth_handler.login(TestConfig.EMAIL_ADDRESS, 'wrong').session_token,
+                None
+            )
+            user = auth_handler.login(TestConfig.EMAIL_ADDRESS, 'abcdefgh')
+            session = auth_handler.validate_session(user.session_token)
+            self.assertEqual(session.email, TestConfig.EMAIL_ADDRESS)
+            self.assertEqual(
+                session.user_id,
+                auth_handler._db_context.user.get_record(user.email).user_id
+            )
+            self.assertEqual(auth_handler.validate_session('s1.1.2.3.4'), None)
+            auth_handler.shutdown()
+        with self.assertRaises(auth.SessionTokensDisabledError):
+            self._get_auth_handler().validate_session(user.session_token)
+
+    def test_session_store(self):
+        config = self._get_config()
+        config.session_store = True
+        auth_handler = self._get_auth_handler(config)
+        user = auth_handler.create_user(TestConfig.EMAIL_ADDRESS, 'abcdefgh')
+        user.activate(user.mail_dispatcher.activation_token)
+        first = auth_handler.login(TestConfig.EMAIL_ADDRESS, 'abcdefgh').session_id
+        second = auth_handler.login(TestConfig.EMAIL_ADDRESS, 'abcdefgh').session_id
+        session = auth_handler.validate_session_id(first)
+        self.assertEqual(session.email, TestConfig.EMAIL_ADDRESS)
+        auth_handler.logout(first)
+        self.assertEqual(auth_handler.validate_session_id(first), None)
+        self.assertEqual(auth_handler.validate_session_id(second).session_id, second)
+        # a second handler (process) loads the session from the database
+        other_handler = self._get_auth_handler(config)
+        self.assertEqual(other_handler.validate_session_id(first), None)
+        self.assertEqual(other_handler.validate_session_id(second).user_id,
+                         session.user_id)
+        self.assertEqual(auth_handler.revoke_sessions(TestConfig.EMAIL_ADDRESS), 1)
+        self.assertEqual(auth_handler.validate_session_id(second), None)
+        other_handler.session_store.refresh_revoked()
+        self.assertEqual(other_handler.validate_session_id(second), None)
+        self.assertEqual(auth_handler.validate_session_id('unknown'), None)
+        other_handler.shutdown()
+        auth_handler.shutdown()
+        with self.assertRaises(auth.SessionStoreDisabledError):
+            self._get_auth_handler().logout(second)
+
+    def test_list_users(self):
+        auth_handler = self._get_auth_handler()
+        auth_handler.create_users(
+            [('user{0}@example.com'.format(i), 'abcdefgh') for i in range(5)],
+            mail_mode=auth.ImportMailMode.SKIP
+        )
+        auth_handler.create_user(TestConfig.EMAIL_ADDRESS, 'abcdefgh')
+        auth_handler.login('user4@example.com', 'wrong_password')
+        user_admin = UserAdmin(auth_handler)
+        page = user_admin.list_users(limit=4)
+        self.assertEqual(len(page.users), 4)
+        page = user_admin.list_users(page.next_after_id, 4)
+        self.assertEqual([user.email for user in page.users],
+                         ['user4@example.com', TestConfig.EMAIL_ADDRESS])
+        self.assertEqual(page.next_after_id, None)
+        self.assertTrue(abs(page.users[0].last_failed_attempt - time.time()) < 5)
+        self.assertEqual(page.users[1].last_failed_attempt, None)
+        self.assertTrue(abs(page.users[1].created - time.time()) < 5)
+        self.assertEqual(len(list(user_admin.iter_users(page_size=2))), 6)
+        self.assertEqual(
+            [user.email for user in user_admin.iter_users(False, 2)],
+            [TestConfig.EMAIL_ADDRESS]
+        )
+        output = StringIO.StringIO()
+        self.assertEqual(user_admin.export_users(output, True, 2), 5)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[0], 'id,email,is_activated,created,last_failed_attempt')
+        self.assertEqual(len(lines), 6)
+        auth_handler.shutdown()
+
+    def test_activation_campaign(self):
+        auth_handler = self._get_auth_handler()
+        emails = ['user{0}@example.com'.format(i) for i in range(7)]
+        auth_handler.create_users([(email, 'abcdefgh') for email in emails],
+                                  mail_mode=auth.ImportMailMode.DEFER)
+        auth_handler.create_users([('active@example.com', 'abcdefgh')],
+                                  mail_mode=auth.ImportMailMode.SKIP)
+        dispatcher = BatchMailDispatcher(['user3@example.com'])
+        auth_handler.mail_dispatcher = dispatcher
+        campaign_config = CampaignConfig(chunk_size=3, batch_size=2, rate=0)
+        directory = tempfile.mkdtemp()
+        try:
+            checkpoint = CampaignCheckpoint(
+                os.path.join(directory, 'campaign.json'))
+            progress = ActivationCampaign(
+                auth_handler, campaign_config, checkpoint).run(4)
+            self.assertEqual(progress.sent, 3)
+            self.assertEqual(progress.failed_emails, ['user3@example.com'])
+            self.assertFalse(progress.finished)
+            # a new campaign continues from the checkpoint
+            progress = ActivationCampaign(
+                auth_handler, campaign_config, checkpoint).run()
+            self.assertEqual(progress.sent, 6)
+            self.assertTrue(progress.finished)
+            self.assertEqual(dispatcher.sent, emails)
+            self.assertTrue(auth_handler.get_user('user5@example.com').activate(
+                dispatcher.tokens['user5@example.com']))
+            with self.assertRaises(CheckpointMismatchError):
+                ActivationCampaign(auth_handler,
+                                   CampaignConfig(created_after=1), checkpoint)
+        finally:
+            shutil.rmtree(directory)
+        old_users = CampaignConfig(created_before=int(time.time()) - 3600)
+        progress = ActivationCampaign(auth_handler, old_users).run()
+        self.assertEqual((progress.sent, progress.finished), (0, True))
+        auth_handler.shutdown()
+
+    def test_campaign_resumes_batch_in_flight(self):
+        auth_handler = self._get_auth_handler()
+        emails = ['user{0}@example.com'.format(i) for i in range(5)]
+        auth_handler.create_users([(email, 'abcdefgh') for email in emails],
+                                  mail_mode=auth.ImportMailMode.DEFER)
+        interrupted = InterruptingMailDispatcher()
+        auth_handler.mail_dispatcher = interrupted
+        campaign_config = CampaignConfig(batch_size=2, rate=0)
+        directory = tempfile.mkdtemp()
+        try:
+            checkpoint = CampaignCheckpoint(
+                os.path.join(directory, 'campaign.json'))
+            with self.assertRaises(KeyboardInterrupt):
+                ActivationCampaign(auth_handler, campaign_config,
+                                   checkpoint).run()
+            self.assertEqual(interrupted.sent, emails[:2])
+            dispatcher = BatchMailDispatcher()
+            auth_handler.mail_dispatcher = dispatcher
+            progress = ActivationCampaign(auth_handler, campaign_config,
+                                          checkpoint).run()
+            self.assertEqual((progress.sent, progress.finished), (5, True))
+            self.assertEqual(dispatcher.sent, emails)
+            # the batch in flight is sent again with the tokens already sent
+            for email in emails[:2]:
+                self.assertEqual(dispatcher.tokens[email],
+                                 interrupted.tokens[email])
+                self.assertTrue(auth_handler.get_user(email).activate(
+                    interrupted.tokens[email]))
+        finally:
+            shutil.rmtree(directory)
+        auth_handler.shutdown()
+
+    def test_email_index(self):
+        config = self._get_config()
+        config.email_index = True
+        config.email_index_refresh_interval = 0
+        auth_handler = self._get_auth_handler(config)
+        user = auth_handler.create_user(TestConfig.EMAIL_ADDRESS, 'abcdefgh')
+        self.assertTrue(user.activate(user.mail_dispatcher.activation_token))
+        self.assertTrue(auth_handler.login(TestConfig.EMAIL_ADDRESS,
+                                           'abcdefgh').is_logged_in)
+        user = auth_handler.login('unknown@domain.com', 'abcdefgh')
+        self.assertEqual(user.login_result,
+                         auth.LoginResult.USER_IS_NOT_ACTIVATED)
+        self.assertFalse(auth_handler.activate_user(
+            crypto.b64_encode('unknown@domain.com'), 'token'))
+        # users created by another process are picked up by the next refresh
+        other_handler = self._get_auth_handler()
+        other_handler.create_users([('other@domain.com', 'abcdefgh')],
+                                   mail_mode=auth.ImportMailMode.SKIP)
+        email_index = auth_handler._db_context.email_index
+        self.assertFalse(email_index.might_exist('other@domain.com'))
+        self.assertEqual(email_index.refresh(), 1)
+        self.assertTrue(auth_handler.login('other@domain.com',
+                                           'abcdefgh').is_logged_in)
+        email_index.rebuild()
+        stats = email_index.get_stats()
+        self.assertEqual((stats['count'], stats['capacity']), (2, 1000))
+        self.assertTrue(stats['false_positive_rate'] < 0.001)
+        # not indexed, answered by the backend
+        self.assertEqual(
+            auth_handler.db_context.user.find_existing(
+                ['other@domain.com', 'unknown@domain.com']),
+            set(['other@domain.com'])
+        )
+        other_handler.shutdown()
+        auth_handler.shutdown()
+
+
+class MemoryBackendTest(BackendTestMixin, unittest.TestCase):
+    backend_options = {'db_backend': 'memory', 'db_catalog': 'test'}
+
+    def setUp(self):
+        MemoryStore.get('test').clear()
+
+    def test_unknown_backend(self):
+        config = self._get_config()
+        config.db_backend = 'unknown'
+        with self.assertRaises(UnknownBackendError):
+            auth.DbContext(config)
+
+
+class PasswordHasherTest(unittest.TestCase):
+    def test_versioned_format(self):
+        hasher = crypto.PasswordHasher(
+            crypto.KdfConfig(crypto.PBKDF2_KDF, 1000)
+        )
+        hashed = hasher.hash('password', 'SALT1234')
+        self.assertTrue(hashed.startswith('$pbkdf2-sha512$i=1000$'))
+        self.assertEqual(hasher.verify('password', 'SALT1234', hashed), True)
+        self.assertEqual(hasher.verify('passwore', 'SALT1234', hashed), False)
+        self.assertEqual(hasher.needs_rehash(hashed), False)
+        stronger = crypto.PasswordHasher(
+            crypto.KdfConfig(crypto.PBKDF2_KDF, 2000)
+        )
+        self.assertEqual(stronger.verify('password', 'SALT1234', hashed), True)
+        self.assertEqual(stronger.needs_rehash(hashed), True)
+
+    def test_legacy_hash(self):
+        legacy = crypto.create_hash('password', 'SALT1234')
+        hasher = crypto.PasswordHasher(
+            crypto.KdfConfig(crypto.PBKDF2_KDF, 1000)
+        )
+        self.assertEqual(hasher.verify('password', 'SALT1234', legacy), True)
+        self.assertEqual(hasher.needs_rehash(legacy), True)
+        self.assertEqual(
+            crypto.PasswordHasher().needs_rehash(legacy),
+            False
+        )
+
+    def test_process_pool(self):
+        hasher = crypto.PasswordHasher(
+            crypto.KdfConfig(crypto.PBKDF2_KDF, 1000, workers=2)
+        )
+        try:
+            pairs = [('password{0}'.format(i), 'SALT1234') for i in range(5)]
+            hashes = hasher.hash_many(pairs)
+            self.assertEqual(hashes[3], hasher.hash('password3', 'SALT1234'))
+            self.assertEqual(
+                hasher.verify('password3', 'SALT1234', hashes[3]),
+                True
+            )
+        finally:
+            hasher.close()
+
+    def test_unknown_kdf(self):
+        with self.assertRaises(crypto.UnknownKdfError):
+            crypto.PasswordHasher(crypto.KdfConfig('md5'))
+
+
+class AsyncAuthHandlerTest(unittest.TestCase):
+    def setUp(self):
+        MemoryStore.get('async').clear()
+        config = auth.Config()
+        config.db_backend = 'memory'
+        config.db_catalog = 'async'
+        config.async_workers = 4
+        self.handler = auth.AsyncAuthHandler(auth.AuthHandler(config))
+        self.handler.auth_handler.mail_dispatcher = TestMailDispatcher(
+            auth.MailConfig(config)
+        )
+
+    def tearDown(self):
+        self.handler.shutdown()
+        self.handler.auth_handler.shutdown()
+
+    def test_create_and_login(self):
+        password = 'abcdefgh'
+        user = self.handler.create_user(
+            TestConfig.EMAIL_ADDRESS, password
+        ).result(5)
+        failed = self.handler.create_user(TestConfig.EMAIL_ADDRESS, password)
+        self.assertIsInstance(failed.exception(5), EmailAlreadyInUseError)
+        activated = self.handler.activate_user(
+            crypto.b64_encode(user.email),
+            user.mail_dispatcher.activation_token
+        )
+        self.assertEqual(activated.result(5), True)
+        logins = [self.handler.login(user.email, password)
+                  for i in range(20)]
+        logins.append(self.handler.login(user.email, 'wrong_password'))
+        results = [login.result(5).login_result for login in logins]
+        self.assertEqual(results, [auth.LoginResult.SUCCESS] * 20 +
+                         [auth.LoginResult.USER_OR_PASSWORD_WRONG])
+
+    def test_callback(self):
+        results = []
+        done = threading.Event()
+
+        def on_login(future):
+            results.append(future.result().login_result)
+            done.set()
+        self.handler.login('unknown@domain.com', 'abcdefgh').add_done_callback(
+            on_login
+        )
+        self.assertTrue(done.wait(5))
+        self.assertEqual(results, [auth.LoginResult.USER_IS_NOT_ACTIVATED])
+
+
+class LruTtlCacheTest(unittest.TestCase):
+    def test_lru_eviction(self):
+        cache = LruTtlCache(2, 60)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.get_stats(),
+                         {'size': 2, 'hits': 3, 'misses': 1, 'evictions': 1})
+
+    def test_ttl(self):
+        cache = LruTtlCache(2, 0.05)
+        cache.put('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        time.sleep(0.1)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get_stats()['size'], 0)
+
+
+class BloomFilterTest(unittest.TestCase):
+    def test_membership(self):
+        bloom_filter = BloomFilter(2000, 0.01)
+        emails = ['user{0}@example.com'.format(i) for i in range(2000)]
+        for email in emails:
+            bloom_filter.add(email)
+        bloom_filter.add(u'\xfcser@example.com')
+        self.assertTrue(all(email in bloom_filter for email in emails))
+        self.assertTrue(u'\xfcser@example.com' in bloom_filter)
+        false_positives = len([i for i in range(10000)
+                               if 'other{0}@example.com'.format(i) in bloom_filter])
+        self.assertTrue(false_positives < 300)
+        self.assertTrue(0.005 < bloom_filter.false_positive_rate < 0.02)
+        # about 9.6 bits per entry for 1%
+        self.assertEqual(bloom_filter.memory_bytes, 2397)
+
+
+class CommittedEmails(object):
+    # the (id, email) rows other processes have committed so far
+    def __init__(self):
+        self.rows = []
+
+    def iter_emails(self, after_id, limit):
+        return iter(sorted(row for row in self.rows if row[0] > after_id)[:limit])
+
+
+class EmailIndexTest(unittest.TestCase):
+    def test_refresh_out_of_order(self):
+        committed = CommittedEmails()
+        committed.rows = [(1, 'first@domain.com'), (3, 'third@domain.com')]
+        email_index = EmailIndex(committed, EmailIndexConfig(
+            refresh_interval=0, page_size=2, refresh_overlap=5))
+        committed.rows.append((4, 'fourth@domain.com'))
+        self.assertEqual(email_index.refresh(), 1)
+        # id 2 was taken before id 3 and 4, but committed after them
+        committed.rows.append((2, 'second@domain.com'))
+        self.assertFalse(email_index.might_exist('second@domain.com'))
+        self.assertEqual(email_index.refresh(), 1)
+        self.assertTrue(email_index.might_exist('second@domain.com'))
+        self.assertEqual(email_index.get_stats()['count'], 4)
+        email_index.close()
+
+
+class MetricsTest(unittest.TestCase):
+    def tearDown(self):
+        metrics.registry.enabled = False
+        metrics.registry.reset()
+
+    def test_disabled(self):
+        registry = MetricsRegistry()
+        registry.inc('counter')
+        with registry.timer('histogram'):
+            pass
+        self.assertEqual(registry.get_metrics(), [])
+
+    def test_prometheus_text(self):
+        registry = MetricsRegistry(True)
+        registry.inc('login_total', result='success')
+        registry.inc('login_total', 2, result='success')
+        registry.observe('login_seconds', 0.003)
+        text = format_prometheus_text(registry)
+        self.assertIn('login_total{result="success"} 3', text)
+        self.assertIn('login_seconds_bucket{le="0.0025"} 0', text)
+        self.assertIn('login_seconds_bucket{le="0.005"} 1', text)
+        self.assertIn('login_seconds_count 1', text)
+
+    def test_login_and_queries(self):
+        directory = tempfile.mkdtemp()
+        try:
+            config = auth.Config()
+            config.db_backend = 'sqlite'
+            config.db_path = os.path.join(directory, 'auth.db')
+            config.db_schema_mode = 'migrate'
+            metrics.registry.enabled = True
+            auth_handler = auth.AuthHandler(config)
+            auth_handler.login('unknown@domain.com', 'abcdefgh')
+            auth_handler.login('unknown@domain.com', 'abcdefgh')
+            auth_handler.shutdown()
+        finally:
+            shutil.rmtree(directory)
+        registry = metrics.registry
+        self.assertEqual(
+            registry.get_metric('login_total',
+                                result='user_is_not_activated').value,
+            2
+        )
+        self.assertEqual(registry.get_metric('login_seconds').count, 2)
+        names = set(name for name, labels, metric in registry.get_metrics())
+        self.assertIn('db_query_seconds', names)
+        self.assertEqual(
+            registry.get_metric('pool_connections_opened_total',
+                                pool='db').value,
+            registry.get_metric('pool_connections_closed_total',
+                                pool='db').value
+        )
+
+    def test_statement_labels(self):
+        from database import _get_statement_label
+        self.assertEqual(
+            _get_statement_label('SELECT email FROM users WHERE email IN (%s, %s)'),
+            'SELECT email FROM users WHERE email IN (...)'
+        )
+        self.assertEqual(
+            _get_statement_label('INSERT INTO t (a) VALUES (%s), (%s)'),
+            'INSERT INTO t (a) VALUES ...'
+        )
+
+
+class StatementTest(unittest.TestCase):
+    def test_format_all_dialects(self):
+        for dialect in (MySqlDialect(), SqliteDialect()):
+            cache = StatementCache(dialect)
+            for name in STATEMENTS.get_names():
+                sql = cache.get_sql(name, 2)
+                self.assertNotIn('{', sql)
+                self.assertIs(cache.get_sql(name, 2), sql)
+        cache = StatementCache(SqliteDialect())
+        self.assertEqual(
+            cache.get_sql('user.find_existing', 3),
+            'SELECT email FROM users WHERE email IN (%s, %s, %s)'
+        )
+
+    def test_execution_counts(self):
+        directory = tempfile.mkdtemp()
+        try:
+            config = auth.Config()
+            config.db_backend = 'sqlite'
+            config.db_path = os.path.join(directory, 'auth.db')
+            config.db_schema_mode = 'migrate'
+            auth_handler = auth.AuthHandler(config)
+            auth_handler.mail_dispatcher = TestMailDispatcher(
+                auth.MailConfig(config)
+            )
+            auth_handler.create_user(TestConfig.EMAIL_ADDRESS, 'abcdefgh')
+            auth_handler.login(TestConfig.EMAIL_ADDRESS, 'abcdefgh')
+            auth_handler.login(TestConfig.EMAIL_ADDRESS, 'abcdefgh')
+            counts = auth_handler._db_context.db_connection.statements.get_counts()
+            auth_handler.shutdown()
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(counts['user.insert'], 1)
+        self.assertEqual(counts['user.is_activated'], 2)
+        self.assertEqual(counts['login_attempt.count'], 2)
+        self.assertNotIn('user.activate', counts)
+
+
+class SchemaTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.directory, 'auth.db')
+        self.connection = SqliteConnection(self.db_path)
+
+    def tearDown(self):
+        self.connection.dispose()
+        shutil.rmtree(self.directory)
+
+    def test_migrate(self):
+        schema_manager = schema.SchemaManager(self.connection)
+        self.assertEqual(schema_manager.get_version(), 0)
+        with self.assertRaises(schema.SchemaOutdatedError):
+            schema_manager.check()
+        self.assertEqual(schema_manager.migrate(),
+                         range(1, schema.LATEST_VERSION + 1))
+        self.assertEqual(schema_manager.migrate(), [])
+        self.assertEqual(schema_manager.get_version(), schema.LATEST_VERSION)
+        schema_manager.check()
+        plan = self.connection.execute_query_row(
+            "EXPLAIN QUERY PLAN SELECT COUNT(id) FROM login_attempts "
+            "WHERE login = %s AND timestamp > datetime('now')",
+            TestConfig.EMAIL_ADDRESS
+        )
+        self.assertIn('IX_login_attempts_login_timestamp', str(plan))
+
+    def test_existing_tables(self):
+        # a database created before the schema was versioned
+        statements = schema.MIGRATIONS[0].statements['sqlite']
+        for statement in statements:
+            self.connection.execute_non_query(statement)
+        schema_manager = schema.SchemaManager(self.connection)
+        self.assertEqual(schema_manager.migrate(),
+                         range(1, schema.LATEST_VERSION + 1))
+        schema_manager.check()
+
+    def test_missing_index(self):
+        schema_manager = schema.SchemaManager(self.connection)
+        schema_manager.migrate()
+        self.connection.execute_non_query(
+            "DROP INDEX IX_login_attempts_timestamp"
+        )
+        with self.assertRaises(schema.SchemaMismatchError):
+            schema_manager.check()
+
+    def test_failed_migration(self):
+        for statement in schema.MIGRATIONS[0].statements['sqlite']:
+            self.connection.execute_non_query(statement)
+        self.connection.execute_non_query(
+            "CREATE INDEX IX_login_attempts_timestamp ON login_attempts (timestamp)"
+        )
+        schema_manager = schema.SchemaManager(self.connection)
+        # the error of the failed statement, not one of the rollback
+        with self.assertRaisesRegexp(sqlite3.OperationalError, 'already exists'):
+            schema_manager.migrate()
+        self.assertEqual(schema_manager.get_version(), 0)
+
+    def test_lock_result(self):
+        dialect = MySqlDialect()
+        self.assertTrue(dialect.is_schema_locked(1))
+        self.assertFalse(dialect.is_schema_locked(0))
+        self.assertFalse(dialect.is_schema_locked(None))
+
+    def test_failed_startup_releases_resources(self):
+        config = auth.Config()
+        config.db_backend = 'sqlite'
+        config.db_path = self.db_path
+        config.db_schema_mode = 'check'
+        resources = SharedResources()
+        with self.assertRaises(schema.SchemaOutdatedError):
+            auth.DbContext(config, resources)
+        self.assertEqual(resources.count, 0)
+
+    def test_startup_modes(self):
+        config = auth.Config()
+        config.db_backend = 'sqlite'
+        config.db_path = self.db_path
+        # by default the schema is only checked
+        with self.assertRaises(schema.SchemaOutdatedError):
+            auth.DbContext(config)
+        config.db_schema_mode = 'unknown'
+        with self.assertRaises(schema.UnknownSchemaModeError):
+            auth.DbContext(config)
+        config.db_schema_mode = 'migrate'
+        auth.DbContext(config).close()
+        config.db_schema_mode = 'check'
+        auth.DbContext(config).close()
+
+
+class SqliteBackendTest(BackendTestMixin, unittest.TestCase):
+    backend_options = {'db_backend': 'sqlite', 'db_schema_mode': 'migrate'}
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _get_config(self):
+        # a new database file per test
+        config = super(SqliteBackendTest, self)._get_config()
+        config.db_path = os.path.join(self.directory, 'auth.db')
+        return config
+
+    def test_bucketed_lockout(self):
+        config = self._get_config()
+        config.login_attempt_storage = 'buckets'
+        config.login_attempt_bucket_seconds = 60
+        auth_handler = self._get_auth_handler(config)
+        password = 'abcdefgh'
+        user = auth_handler.create_user(TestConfig.EMAIL_ADDRESS, password)
+        user.activate(user.mail_dispatcher.activation_token)
+        for i in range(config.login_max_attempts):
+            user.login('wrong_password')
+        rows = auth_handler._db_context.db_connection.execute_scalar(
+            "SELECT COUNT(*) FROM login_attempt_buckets"
+        )
+        self.assertTrue(rows <= 2)
+        self.assertEqual(user.login(password), False)
+        self.assertEqual(user.login_result, auth.LoginResult.USER_IS_LOCKED_OUT)
+        config.login_single_query = True
+        user = self._get_auth_handler(config).login(user.email, password)
+        self.assertEqual(user.login_result, auth.LoginResult.USER_IS_LOCKED_OUT)
+        auth_handler.shutdown()
+
+    def test_import_within_variable_limit(self):
+        auth_handler = self._get_auth_handler()
+        records = [('user{0}@domain.com'.format(i), 'abcdefgh')
+                   for i in range(450)]
+        results = auth_handler.create_users(
+            records, mail_mode=auth.ImportMailMode.DEFER)
+        self.assertEqual([result.status for result in results],
+                         [auth.ImportStatus.CREATED] * 450)
+        self.assertEqual(
+            auth_handler._db_context.db_connection.statements.get_counts()[
+                'user.insert_many'],
+            3
+        )
+        auth_handler.shutdown()
+
+    def test_campaign_within_variable_limit(self):
+        auth_handler = self._get_auth_handler()
+        emails = ['user{0}@domain.com'.format(i) for i in range(400)]
+        auth_handler.create_users([(email, 'abcdefgh') for email in emails],
+                                  mail_mode=auth.ImportMailMode.DEFER)
+        dispatcher = BatchMailDispatcher()
+        auth_handler.mail_dispatcher = dispatcher
+        progress = ActivationCampaign(
+            auth_handler, CampaignConfig(batch_size=500, rate=0)).run()
+        self.assertEqual(progress.sent, 400)
+        self.assertEqual(
+            auth_handler._db_context.db_connection.statements.get_counts()[
+                'user.renew_activation_tokens'],
+            2
+        )
+        self.assertTrue(auth_handler.get_user('user399@domain.com').activate(
+            dispatcher.tokens['user399@domain.com']))
+        auth_handler.shutdown()
+
+    def test_prune(self):
+        config = self._get_config()
+        auth_handler = self._get_auth_handler(config)
+        connection = auth_handler._db_context.db_connection
+        for age in (10, 100000, 100001, 100002, 100003, 100004):
+            connection.execute_non_query(
+                "INSERT INTO login_attempts (login, timestamp) "
+                "VALUES (%s, datetime('now', '-' || %s || ' seconds'))",
+                (TestConfig.EMAIL_ADDRESS, age)
+            )
+            connection.execute_non_query(
+                "INSERT INTO login_attempt_buckets (login, bucket, attempts) "
+                "VALUES (%s, %s, 1)",
+                (TestConfig.EMAIL_ADDRESS, int(time.time()) - age)
+            )
+        pruner = RetentionPruner(connection, config.login_attempt_expire,
+                                 RetentionConfig(2, batch_pause=0))
+        self.assertEqual(pruner.prune(), {'login_attempts': 5,
+                                          'login_attempt_buckets': 5,
+                                          'sessions': 0})
+        self.assertEqual(pruner.prune(), {'login_attempts': 0,
+                                          'login_attempt_buckets': 0,
+                                          'sessions': 0})
+        self.assertEqual(auth_handler._db_context.login_attempt.get_count(
+            TestConfig.EMAIL_ADDRESS, config.login_attempt_expire), 1)
+        auth_handler.shutdown()
+
+    def test_signed_activation_without_query(self):
+        config = self._get_config()
+        config.activation_token_format = 'signed'
+        config.activation_token_keys = 'k1:secret'
+        auth_handler = self._get_auth_handler(config)
+        user = auth_handler.create_user(TestConfig.EMAIL_ADDRESS, 'abcdefgh')
+        statements = auth_handler._db_context.db_connection.statements
+        counts = statements.get_counts()
+        self.assertEqual(user.activate('k1.0.forged'), False)
+        self.assertEqual(user.activate('not a token'), False)
+        self.assertEqual(statements.get_counts(), counts)
+        self.assertEqual(user.activate(user.mail_dispatcher.activation_token), True)
+        self.assertEqual(statements.get_counts()['user.activate'], 1)
+        self.assertFalse('user.activation_token' in statements.get_counts())
+        auth_handler.shutdown()
+
+    def test_execute_query_iter(self):
+        auth_handler = self._get_auth_handler()
+        connection = auth_handler._db_context.db_connection
+        for i in range(7):
+            connection.execute_non_query(
+                "INSERT INTO login_attempts (login) VALUES (%s)",
+                'user{0}@example.com'.format(i)
+            )
+        rows = connection.execute_query_iter(
+            "SELECT login FROM login_attempts WHERE login LIKE %s ORDER BY id",
+            'user%', batch_size=3
+        )
+        self.assertEqual(next(rows), ('user0@example.com',))
+        # the streaming query holds a connection of its own until it is exhausted
+        self.assertEqual(connection.execute_scalar(
+            "SELECT COUNT(*) FROM login_attempts"), 7)
+        self.assertEqual(len(list(rows)), 6)
+        auth_handler.shutdown()
+
+    def test_list_users_with_buckets(self):
+        config = self._get_config()
+        config.login_attempt_storage = 'buckets'
+        auth_handler = self._get_auth_handler(config)
+        user = auth_handler.create_user(TestConfig.EMAIL_ADDRESS, 'abcdefgh')
+        user.activate(user.mail_dispatcher.activation_token)
+        user.login('wrong_password')
+        users = UserAdmin(auth_handler).list_users().users
+        self.assertEqual(len(users), 1)
+        self.assertTrue(abs(users[0].last_failed_attempt - time.time()) < 400)
+        auth_handler.shutdown()
+
+
 def truncate_tables():
     if TestConfig.TRUNCATE_TABLES:
+        import MySQLdb
         config = auth.Config(Files.CLEAN_CONFIG)
         connection = MySQLdb.connect(
             config.db_host,